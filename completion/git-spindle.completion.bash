@@ -23,6 +23,7 @@ _git_hub() {
         create
         create-token
         deploy-keys
+        each
         edit-hook
         fetch
         fork
@@ -88,6 +89,7 @@ _git_lab() {
         cat
         clone
         create
+        each
         fetch
         fork
         issue
@@ -144,6 +146,7 @@ _git_bb() {
         config
         create
         deploy-keys
+        each
         fetch
         fork
         forks
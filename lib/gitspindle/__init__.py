@@ -1,17 +1,33 @@
+import gitspindle.lazy
 import gitspindle.monkey
+import gitspindle.cache
+import gitspindle.daemon
+import gitspindle.stats
+import gitspindle.trace
+from gitspindle.config import ConfigFile, ConfigError, normalize as config_key
+from gitspindle.backoff import Backoff
+from gitspindle.catfile import CatFile
 import docopt
 import os
+import pickle
 import re
 import shlex
 import sys
 import tempfile
-import time
 import whelk
 import importlib.util
+import marshal
+import types
 import urllib.parse
 
-__all__ = ['GitSpindle', 'Credential', 'command', 'wants_parent']
+__all__ = ['GitSpindle', 'Credential', 'command', 'wants_parent', 'changes_directory']
 NO_VALUE_SENTINEL = 'NO_VALUE_SENTINEL'
+REGISTRY_VERSION = 2
+REPO_CACHE_VERSION = 1
+REPO_CACHE_TTL = 300
+IDENTITY_CACHE_VERSION = 1
+IDENTITY_CACHE_TTL = 86400
+HTTP_CACHE_SIZE = 100 # MiB
 PLUGIN_PATH = os.path.join(os.path.expanduser('~'), '.local', 'lib', 'git-spindle')
 
 def err(msg):
@@ -29,6 +45,8 @@ def command(fnc):
         fnc.no_login = False
     if not hasattr(fnc, 'wants_parent'):
         fnc.wants_parent = False
+    if not hasattr(fnc, 'changes_directory'):
+        fnc.changes_directory = False
     return fnc
 hidden_command = lambda fnc: os.getenv('GIT_SPINDLE_DEBUG') and command(fnc)
 
@@ -40,6 +58,12 @@ def no_login(fnc):
     fnc.no_login = True
     return fnc
 
+# Commands that chdir can't run side by side in one process, each runs them one
+# by one
+def changes_directory(fnc):
+    fnc.changes_directory = True
+    return fnc
+
 class DocoptExit(SystemExit):
     help = ''
     commands = {}
@@ -62,6 +86,35 @@ def extras(help, version, options, doc):
 
 docopt.extras = extras
 
+def compile_usage(usage, exclude=()):
+    # The parsing half of docopt.docopt, the matching half is in GitSpindle.parse_args.
+    # Options in exclude are not part of [options], like options that other
+    # commands use explicitly.
+    options = docopt.parse_defaults(usage)
+    pattern = docopt.parse_pattern(docopt.formal_usage(docopt.printable_usage(usage)), options)
+    pattern_options = set(pattern.flat(docopt.Option))
+    for ao in pattern.flat(docopt.AnyOptions):
+        ao.children = [opt for opt in set(docopt.parse_defaults(usage)) - pattern_options if opt.name not in exclude]
+    return pattern.fix(), options
+
+def like_default(value, default):
+    # In the full usage pattern, arguments and options that any command
+    # repeats are lists or counts for all commands. Single command patterns
+    # don't know that, so convert their values.
+    if isinstance(default, list) and not isinstance(value, list):
+        return [] if value is None else [value]
+    if type(default) is int and type(value) is bool:
+        return int(value)
+    return value
+
+def explicit_options(pattern):
+    """Names of the options used in a pattern, other than via [options]"""
+    if isinstance(pattern, docopt.AnyOptions):
+        return set()
+    if isinstance(pattern, docopt.Option):
+        return set([pattern.name])
+    return set().union(*[explicit_options(child) for child in getattr(pattern, 'children', [])])
+
 GitSpindlePlugin = None
 class GitSpindlePluginLoader(type):
     def __new__(cls, name, parents, attrs):
@@ -79,67 +132,200 @@ class GitSpindlePluginLoader(type):
         else:
             GitSpindlePluginLoader.currently_loading = attrs
             GitSpindlePluginLoader.currently_loading['__plugin_init__'] = []
+            GitSpindlePluginLoader.currently_loading['__plugin_files__'] = []
+            attrs['__plugin_manifest__'] = {}
             path = os.path.join(PLUGIN_PATH, name.lower())
-            if os.path.exists(path):
-                for file in os.listdir(path):
-                    if file.endswith('.py'):
-                        spec = importlib.util.spec_from_file_location('temp_module', os.path.join(path, file))
-                        module = importlib.util.module_from_spec(spec)
-                        GitSpindlePluginLoader.current_plugin = file
-                        try:
-                            spec.loader.exec_module(module)
-                        except Exception as e:
-                            print("Failed to load plugin %s: %s" % (file, str(e)))
+            plugins, changed = cls.compiled_plugins(path)
+            for (file, key, code, manifest) in plugins:
+                attrs['__plugin_files__'].append(file)
+                GitSpindlePluginLoader.current_plugin = os.path.basename(file)
+                before = set(attrs)
+                try:
+                    if isinstance(code, str):
+                        raise SyntaxError(code)
+                    module = types.ModuleType('gitspindle_plugin_%s' % os.path.basename(file)[:-3])
+                    module.__file__ = file
+                    exec(marshal.loads(code), module.__dict__)
+                except Exception as e:
+                    print("Failed to load plugin %s: %s" % (GitSpindlePluginLoader.current_plugin, str(e)))
+                manifest[:] = sorted(set(attrs) - before)
+                attrs['__plugin_manifest__'][file] = manifest
+            if changed:
+                gitspindle.cache.store('plugins-%s' % name.lower(), cls.plugin_cache_key(path), plugins)
 
             return super(GitSpindlePluginLoader, cls).__new__(cls, name, parents, attrs)
 
+    @staticmethod
+    def plugin_cache_key(path):
+        try:
+            return (importlib.util.MAGIC_NUMBER, path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+
+    @classmethod
+    def compiled_plugins(cls, path):
+        """Returns a list of (file, key, code, manifest) tuples for all plugins
+           in path. Code is compiled once and cached for as long as neither
+           the directory nor the files change. Manifest is the list of
+           attributes the plugin contributed when last loaded"""
+        key = cls.plugin_cache_key(path)
+        if key is None:
+            return [], False
+        plugins = gitspindle.cache.load('plugins-%s' % os.path.basename(path), key)
+        if plugins is not None and all(gitspindle.cache.file_key(file) == key_ for (file, key_, _, _) in plugins):
+            return plugins, False
+
+        # Something changed, recompile what needs recompiling
+        cached = dict([(plugin[1], plugin) for plugin in plugins or []])
+        plugins = []
+        for file in sorted(os.listdir(path)):
+            if not file.endswith('.py'):
+                continue
+            file = os.path.join(path, file)
+            key = gitspindle.cache.file_key(file)
+            if key in cached:
+                plugins.append(cached[key])
+                continue
+            try:
+                with open(file, 'rb') as fd:
+                    code = marshal.dumps(compile(fd.read(), file, 'exec', dont_inherit=True))
+            except (SyntaxError, ValueError) as e:
+                code = str(e)
+            plugins.append((file, key, code, []))
+        return plugins, True
+
 class GitSpindlePlugin(metaclass=GitSpindlePluginLoader):
      pass
 
+class GitContext(object):
+    """A snapshot of the repository and configuration git sees in a directory,
+       so we don't need a git process for every question we ask about it"""
+    # Subcommands that may change the configuration we have a snapshot of
+    invalidated_by = ('config', 'remote', 'push', 'branch', 'checkout', 'switch', 'init', 'submodule', 'worktree')
+
+    def __init__(self, git):
+        self.cwd = os.getcwd()
+        self.git_dir = self.common_dir = self.root = None
+        result = git('rev-parse', '--git-dir', '--git-common-dir', '--is-inside-work-tree', '--show-cdup')
+        if result.returncode == 0:
+            git_dir, common_dir, work_tree, cdup = (result.stdout.split('\n') + ['', ''])[:4]
+            self.git_dir = os.path.abspath(git_dir)
+            self.common_dir = os.path.abspath(common_dir)
+            self.root = os.path.abspath(cdup) if work_tree == 'true' else self.git_dir
+        self.config = []
+        for entry in git('config', '--list', '-z').stdout.split('\0'):
+            if entry:
+                key, _, value = entry.partition('\n')
+                self.config.append((key, value))
+
+    def get(self, key, default=''):
+        values = self.get_all(key)
+        return values[-1] if values else default
+
+    def get_all(self, key):
+        key = config_key(key)
+        return [value for (key_, value) in self.config if key_ == key]
+
+    def get_regexp(self, regexp):
+        regexp = re.compile(regexp)
+        return [(key, value) for (key, value) in self.config if regexp.search(key)]
+
+    @classmethod
+    def is_invalidated_by(klass, args):
+        args = [str(arg) for arg in args]
+        while args and args[0].startswith('-'):
+            if args.pop(0) in ('-C', '-c', '--git-dir', '--work-tree', '--namespace'):
+                args = args[1:]
+        if not args or args[0] not in klass.invalidated_by:
+            return False
+        if args[0] == 'config':
+            # Reading values, or writing another file, leaves our snapshot intact
+            if '--file' in args or '-f' in args:
+                return False
+            writes = ('--unset', '--unset-all', '--add', '--replace-all', '--remove-section', '--rename-section')
+            return any(arg in writes for arg in args) or len([arg for arg in args if not arg.startswith('-')]) > 2
+        return True
+
 class GitSpindle(metaclass=GitSpindlePluginLoader):
+    # Filled in by git-spindle daemon: session_key() -> attributes set by login()
+    sessions = {}
+
     def __init__(self):
         self.shell = whelk.Shell(encoding='utf-8')
-        self.git = self.shell.git
-        self.git_dir = self.git('rev-parse', '--git-dir')
-        if self.git_dir.returncode == 0:
-            self.git_dir = os.path.abspath(self.git_dir.stdout.strip())
-        else:
-            self.git_dir = None
+        self._git = self.shell.git
+        self._context = None
+        self._objects = {}
+        self.git_dir = self.context.git_dir
         self.in_repo = bool(self.git_dir)
         self.config_file = os.path.join(os.path.expanduser('~'), '.gitspindle')
         xdg_dir = os.environ.get('XDG_CONFIG_HOME', os.path.join(os.path.expanduser('~'), '.config'))
         xdg_file = os.path.join(xdg_dir, 'git', 'spindle')
         if os.path.exists(xdg_file):
             self.config_file = xdg_file
+        # It holds credentials
+        self.spindle_config = ConfigFile(self.config_file, mode=0o600)
         self.commands = {}
         self.accounts = {}
         self.my_login = {}
-        helper = self.git('config', 'credential.helper').stdout.strip().split()
+        # Off when each runs commands, there's nobody to answer questions
+        self.interactive = True
+        # On when each captures the output of commands, git's included
+        self.capture_output = False
+        helper = self.context.get('credential.helper').strip().split()
         helper = helper[0] if helper else None
         self.use_credential_helper = helper not in (None, 'cache', 'netrc')
 
-        self.usage = DocoptExit.help = """%s - %s integration for git
+        self.load_registry()
+        for m in self.__plugin_init__:
+            m(self)
+
+    def load_registry(self):
+        # Building the usage text and parsing it with docopt is the most
+        # expensive part of startup, so the result is cached until the code or
+        # any of the plugins change.
+        files = [sys.modules[cls.__module__].__file__ for cls in type(self).__mro__[:-1]]
+        files += [gitspindle.monkey.__file__] + self.__plugin_files__
+        key = (REGISTRY_VERSION, self.prog, bool(os.getenv('GIT_SPINDLE_DEBUG')), docopt.__version__, gitspindle.cache.file_key(*files))
+        name = 'registry-%s' % self.prog.replace(' ', '-')
+        registry = gitspindle.cache.load(name, key)
+        if not registry:
+            registry = self.build_registry()
+            gitspindle.cache.store(name, key, registry)
+        self.registry = registry
+        self.registry_cache = (name, key)
+        self.usage = registry['usage']
+        DocoptExit.help = registry['help']
+        DocoptExit.commands = registry['commands']
+        for name, attr in registry['attrs'].items():
+            self.commands[name] = getattr(self, attr)
+
+    def build_registry(self):
+        usage = help = """%s - %s integration for git
 A full manual can be found on https://git-spindle.seveas.net/
 
 Usage:\n""" % (self.prog, self.what)
-        DocoptExit.help += "  %s [options] <command> [command-options]\n\nCommands:\n" % (self.prog)
-        for name in sorted(dir(self)):
-            fnc = getattr(self, name)
-            if not getattr(fnc, 'is_command', False):
+        help += "  %s [options] <command> [command-options]\n\nCommands:\n" % (self.prog)
+        commands = {}
+        attrs = {}
+        for attr in sorted(dir(self.__class__)):
+            fnc = getattr(self.__class__, attr)
+            # Don't poke at non-callables like self.api, it's imported lazily
+            if not callable(fnc) or not getattr(fnc, 'is_command', False):
                 continue
+            name = attr
             if name.endswith('_'):
                 name = name[:-1]
             name = name.replace('_', '-')
-            self.commands[name] = fnc
+            attrs[name] = attr
             doc = [line.strip() for line in fnc.__doc__.splitlines()]
             if self.__class__.__name__ == 'BitBucket' and name == 'add-account':
                 doc[0] = doc[0].replace('[--host=<host>] ', '')
             if doc[0]:
                 doc[0] = ' ' + doc[0]
-            help = '%s:\n  %s %s %s%s\n' % (doc[1], self.prog, '[options]', name, doc[0])
-            self.usage += help
-            DocoptExit.commands[name] = help
-            DocoptExit.help += '  %-25s%s\n' % (name, doc[1])
+            cmdhelp = '%s:\n  %s %s %s%s\n' % (doc[1], self.prog, '[options]', name, doc[0])
+            usage += cmdhelp
+            commands[name] = cmdhelp
+            help += '  %-25s%s\n' % (name, doc[1])
         tail = """
 Options:
   -h --help              Show this help message and exit
@@ -150,11 +336,81 @@ Options:
   --http                 Use https:// urls for cloning 3rd party repos
   --ssh                  Use ssh:// urls for cloning 3rd party repos
   --git                  Use git:// urls for cloning 3rd party repos
-  --account=<account>    Use another account than the default\n"""
-        self.usage += tail
-        DocoptExit.help += tail
-        for m in self.__plugin_init__:
-            m(self)
+  --account=<account>    Use another account than the default
+  --stats                Show the API requests and processes used at exit\n"""
+        usage += tail
+        help += tail
+        # The full pattern gives us all options and the defaults for all
+        # arguments. Patterns for single commands are compiled when needed.
+        pattern, options = compile_usage(usage)
+        defaults = dict((a.name, a.value) for a in pattern.flat())
+        return {'usage': usage, 'help': help, 'commands': commands, 'attrs': attrs, 'tail': tail,
+                'options': options, 'defaults': defaults, 'explicit_options': explicit_options(pattern), 'parsers': {}}
+
+    def command_parser(self, command):
+        """The compiled usage pattern for a single command"""
+        parsers = self.registry['parsers']
+        if command not in parsers:
+            usage = 'Usage:\n' + self.registry['commands'][command] + self.registry['tail']
+            parsers[command] = pickle.dumps(compile_usage(usage, self.registry['explicit_options']))
+            gitspindle.cache.store(self.registry_cache[0], self.registry_cache[1], self.registry)
+        # Patterns are stored pickled, so loading the registry doesn't
+        # unpickle patterns for all commands
+        return pickle.loads(parsers[command])
+
+    def parse_args(self, argv):
+        # The equivalent of docopt.docopt, but with precompiled patterns. The
+        # first argument is the command, only its pattern needs matching.
+        DocoptExit.usage = self.usage
+        argv = docopt.parse_argv(docopt.TokenStream(argv, DocoptExit), list(self.registry['options']), False)
+        docopt.extras(True, None, argv, self.usage)
+        command = next((arg.value for arg in argv[1:] if type(arg) is docopt.Argument), None)
+        if command not in self.commands:
+            raise DocoptExit()
+        pattern, options = self.command_parser(command)
+        matched, left, collected = pattern.match(argv)
+        if matched and left == []:
+            defaults = self.registry['defaults']
+            opts = docopt.Dict((name, list(value) if isinstance(value, list) else value) for (name, value) in defaults.items())
+            opts.update((a.name, like_default(a.value, defaults.get(a.name))) for a in (pattern.flat() + collected))
+            opts['command'] = command
+            if isinstance(opts[command], list):
+                opts['extra-opts'] = opts[command]
+                opts[command] = True
+            else:
+                opts['extra-opts'] = []
+            opts['--maybe-parent'] = self.commands[command].wants_parent
+            return opts
+        raise DocoptExit()
+
+    @property
+    def context(self):
+        """The GitContext for the current directory"""
+        if not self._context or self._context.cwd != os.getcwd():
+            self._context = GitContext(self._git)
+        return self._context
+
+    @property
+    def objects(self):
+        """Reads objects from the current repository via long-running git
+           cat-file processes, see gitspindle.catfile"""
+        git_dir = self.context.git_dir
+        if git_dir not in self._objects:
+            self._objects[git_dir] = CatFile(git_dir)
+        return self._objects[git_dir]
+
+    def git(self, *args, **kwargs):
+        """Run a git command"""
+        if self._context and GitContext.is_invalidated_by(args):
+            self._context = None
+        if self.capture_output and kwargs.get('redirect') is False:
+            # Show its output where ours goes
+            kwargs['redirect'] = True
+            result = self._git(*args, **kwargs)
+            sys.stdout.write(result.stdout)
+            sys.stderr.write(result.stderr)
+            return whelk.Result(result.returncode, None, None)
+        return self._git(*args, **kwargs)
 
     def gitm(self, *args, **kwargs):
         """A git command that must be successful"""
@@ -165,6 +421,40 @@ Options:
             sys.exit(result.returncode)
         return result
 
+    def mirror_dir(self, repo):
+        return repo.name + '.git'
+
+    def mirror_repos(self, repos, opts, bulk=False):
+        """Mirror repositories, or update mirrors made earlier"""
+        import gitspindle.aio
+        repos = list(repos)
+        # Output of concurrent git commands is shown when they're done, but a
+        # single one can show its progress, unless our output is captured
+        redirect = len(repos) > 1 or self.capture_output
+        async def mirror(repo):
+            return await self.mirror_repo(repo, opts, redirect)
+        self.fan_out(mirror, repos, gitspindle.aio.show_git, bulk=bulk)
+
+    async def mirror_repo(self, repo, opts, redirect=True):
+        import gitspindle.aio
+        git_dir = self.mirror_dir(repo)
+        cur_dir = os.path.basename(os.path.abspath(os.getcwd()))
+        if cur_dir != git_dir and not os.path.exists(git_dir):
+            url = self.clone_url(repo, opts)
+            result = await gitspindle.aio.git('clone', '--mirror', url, git_dir, redirect=redirect)
+        else:
+            if git_dir == cur_dir:
+                git_dir = '.'
+            # Update the current, mirrored repo
+            if (await gitspindle.aio.git('--git-dir', git_dir, 'config', 'core.bare')).stdout.strip() != 'true' or \
+               (await gitspindle.aio.git('--git-dir', git_dir, 'config', 'remote.origin.mirror')).stdout.strip() != 'true':
+                   err("This is not a mirrored repository")
+            result = await gitspindle.aio.git('--git-dir', git_dir, 'fetch', '-q', '--prune', 'origin', redirect=redirect)
+        if result:
+            with open(os.path.join(git_dir, 'description'), 'w') as fd:
+                fd.write(repo.description or "")
+        return result
+
     def config(self, key, value=NO_VALUE_SENTINEL):
         if key in ('token', 'password') and self.use_credential_helper:
             return self.config_secret(key, value)
@@ -172,24 +462,24 @@ Options:
         if self.account:
             section = '%s.%s' % (self.spindle, self.account)
         key = '%s.%s' % (section, key)
-        if value is NO_VALUE_SENTINEL:
-            result = self.git('config', '--file', self.config_file, key)
-            if result.returncode not in (0, 1): # 128 is returned for parse errors
-                print(result.stderr.rstrip())
-                sys.exit(result.returncode)
-            return result.stdout.strip()
-        elif value is None:
-            self.gitm('config', '--file', self.config_file, '--unset', key)
-        else:
-            try:
-                umask = os.umask(63) # 0x077
-                return self.gitm('config', '--file', self.config_file, key, value)
-            finally:
-                os.umask(umask)
+        try:
+            if value is NO_VALUE_SENTINEL:
+                return self.spindle_config.get(key, '').strip()
+            elif value is None:
+                self.spindle_config.unset(key)
+            else:
+                self.spindle_config.set(key, value)
+        except KeyError:
+            sys.exit(5) # Like git config --unset
+        except ConfigError as e:
+            print("fatal: %s" % e)
+            sys.exit(128)
 
     def config_secret(self, key, value=NO_VALUE_SENTINEL):
         url = urllib.parse.urlparse(self.api_root())
-        credential = Credential(protocol=url.scheme, host=url.hostname, path=url.path, username=self.my_login or self.config('user'), password=value)
+        timeout = self.config('credential-cache')
+        timeout = int(timeout) if timeout.isdigit() else 0
+        credential = Credential(protocol=url.scheme, host=url.hostname, path=url.path, username=self.my_login or self.config('user'), password=value, cache_timeout=timeout)
         if value == NO_VALUE_SENTINEL:
             credential.password = ''
             credential.fill_noninteractive()
@@ -209,12 +499,9 @@ Options:
         return [url.hostname] + self.parse_url(url)
 
     def remotes(self):
-        confremotes = self.git('config', '--get-regexp', 'remote\..*\.url').stdout.strip().splitlines()
         ret = {}
-        for remote in confremotes:
-            remote, url = remote.split()
-            remote = remote.split('.')[1]
-            ret[remote] = url
+        for key, url in self.context.get_regexp(r'^remote\..*\.url$'):
+            ret[key[7:-4]] = url
         return ret
 
     def repository(self, opts, hostname_only=False):
@@ -237,11 +524,8 @@ Options:
             # Let git tell the user that we don't know what to do
             self.gitm('rev-parse')
         else:
-            confremotes = self.git('config', '--get-regexp', 'remote\..*\.url').stdout.strip().splitlines()
             first = origin = None
-            for remote in confremotes:
-                remote, url = remote.split()
-                remote = remote.split('.')[1]
+            for remote, url in self.remotes().items():
                 host, user, repo = self._parse_url(url)
                 if repo and not first:
                     first = remote, host, user, repo
@@ -262,7 +546,7 @@ Options:
         if repo and repo.endswith('.git'):
             repo = repo[:-4]
 
-        repo_ = self.get_repo(remote, user, repo)
+        repo_ = self.cached_repo('%s/%s' % (user, repo), lambda: self.get_repo(remote, user, repo))
 
         if not repo_:
             err("Repository %s/%s could not be found on %s" % (user, repo, self.what))
@@ -278,35 +562,163 @@ Options:
 
         return repo_
 
+    @property
+    def repo_cache(self):
+        if not hasattr(self, '_repo_cache'):
+            # Different accounts can see different repositories
+            account = re.sub(r'[^-\w.]', '_', self.account or 'default')
+            key = (REPO_CACHE_VERSION, self.api_root(), self.my_login)
+            self._repo_cache = gitspindle.cache.Store('repos-%s-%s' % (self.spindle, account), key, expire=30*86400)
+        return self._repo_cache
+
+    def cached_repo(self, name, fetch):
+        """Find a repository via the repository cache. Entries younger than
+           repo-cache-ttl seconds are used as-is, older ones are revalidated
+           and fetch() is called for repositories we haven't seen yet."""
+        ttl = self.config('repo-cache-ttl')
+        ttl = int(ttl) if ttl.isdigit() else REPO_CACHE_TTL
+        if not ttl:
+            return fetch()
+        name = name.lower()
+        entry = self.repo_cache.get(name)
+        if entry and self.repo_cache.age(name) < ttl:
+            return self.repo_from_cache(entry)
+        repo = entry and self.revalidate_repo(entry) or fetch()
+        if repo:
+            entry = self.repo_cache_entry(repo)
+            if entry:
+                self.repo_cache[name] = entry
+        elif name in self.repo_cache.data:
+            del self.repo_cache[name]
+        return repo
+
+    @property
+    def identity_cache(self):
+        if not hasattr(self, '_identity_cache'):
+            self._identity_cache = gitspindle.cache.Store('identities-%s' % self.spindle, IDENTITY_CACHE_VERSION, expire=30*86400)
+        return self._identity_cache
+
+    def cached_identity(self, secret, fetch):
+        """Find out who we are logged in as via the identity cache. Entries
+           are per token or password and are used for identity-cache-ttl
+           seconds, or until the API tells us our credentials are wrong."""
+        ttl = self.config('identity-cache-ttl')
+        ttl = int(ttl) if ttl.isdigit() else IDENTITY_CACHE_TTL
+        if not ttl:
+            return fetch()
+        self.identity_key = (self.api_root(), self.account, gitspindle.cache.digest(secret))
+        entry = self.identity_cache.get(self.identity_key)
+        if entry and self.identity_cache.age(self.identity_key) < ttl:
+            return self.identity_from_cache(entry)
+        me = fetch()
+        self.identity_cache[self.identity_key] = self.identity_cache_entry(me)
+        return me
+
+    def unauthorized(self, response, *args, **kwargs):
+        """A requests response hook. A 401 means our credentials stopped
+           working, so don't trust the identity we cached for them; the next
+           login will check them again."""
+        if response.status_code == 401 and getattr(self, 'identity_key', None):
+            del self.identity_cache[self.identity_key]
+            self.identity_key = None
+
+    def fan_out(self, func, items, show=None, limit=None, bulk=False):
+        """Call func for many items at once and show the results in order, see
+           gitspindle.aio. The concurrency setting limits how many calls run at
+           the same time. Bulk jobs, like each, let other commands go first
+           when rate limited."""
+        import gitspindle.aio
+        if bulk:
+            import gitspindle.ratelimit
+            gitspindle.ratelimit.bulk = True
+        return gitspindle.aio.fan_out(func, items, show, limit or self.concurrency())
+
+    def concurrency(self):
+        import gitspindle.aio
+        limit = self.config('concurrency')
+        return int(limit) if limit.isdigit() else gitspindle.aio.CONCURRENCY
+
+    def configure_session(self, session):
+        """Set up a requests session we use to talk to the API. It can
+           revalidate responses it saw before instead of downloading them
+           again, the cache is shared by all services and limited to
+           http-cache-size MiB. It keeps connections alive for as many
+           requests as the concurrency setting makes at the same time.
+           Requests are paced to stay within rate limits, and wait for at most
+           rate-limit-wait seconds when limited. Requests that fail for
+           transient reasons are tried again. When recording or replaying
+           requests, that happens on top of all that."""
+        from gitspindle.ratelimit import RateLimitAdapter, MAX_WAIT
+        from gitspindle.retry import RetryAdapter
+        import requests.adapters
+        # Connections that don't fit in the pool are closed after use
+        pool = max(self.concurrency(), requests.adapters.DEFAULT_POOLSIZE)
+        size = self.config('http-cache-size')
+        size = int(size) if size.isdigit() else HTTP_CACHE_SIZE
+        if size:
+            from gitspindle.httpcache import CachingAdapter
+            adapter = CachingAdapter(size * 1024 * 1024, pool_maxsize=pool)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        wait = self.config('rate-limit-wait')
+        wait = int(wait) if wait.isdigit() else MAX_WAIT
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, RetryAdapter(RateLimitAdapter(session.get_adapter(prefix), wait)))
+        if os.environ.get('GIT_SPINDLE_RECORD') or os.environ.get('GIT_SPINDLE_REPLAY'):
+            from gitspindle.cassette import CassetteAdapter
+            for prefix in ('http://', 'https://'):
+                session.mount(prefix, CassetteAdapter(session.get_adapter(prefix)))
+
+    def session(self):
+        """A requests session for requests that don't go through the API
+           library, set up like the one it uses"""
+        import requests
+        session = requests.Session()
+        self.configure_session(session)
+        return session
+
+    def https_host(self, host):
+        """The url for a host configured without protocol, which must be
+           reachable via https"""
+        import requests
+        try:
+            self.session().get('https://' + host)
+        except requests.exceptions.ConnectionError:
+            err("%s is not reachable via https. Use http://%s to use the insecure http protocol" % (host, host))
+        return 'https://' + host
+
     def wait_for_repo(self, user, repo_, opts):
+        with gitspindle.trace.span('wait for repository', repo='%s/%s' % (user, repo_)):
+            self._wait_for_repo(user, repo_, opts)
+
+    def _wait_for_repo(self, user, repo_, opts):
         warned = False
-        tries = 120/5
         repo = None
-        while tries and not repo:
-            repo = self.get_repo('', user, repo_)
-            if repo:
-                res = self.git('ls-remote', self.clone_url(repo, opts))
-                if res:
-                    if warned:
-                        print("")
-                    return
-                repo = None
+        for attempt in Backoff(timeout=120):
+            # Ask the API first, that's a lot cheaper than an ls-remote
+            repo = repo or self.get_repo('', user, repo_)
+            if repo and self.git('ls-remote', self.clone_url(repo, opts)):
+                if warned:
+                    print("")
+                return
             if not warned:
                 sys.stdout.write("Waiting for repository creation...")
                 warned = True
             else:
                 sys.stdout.write('.')
             sys.stdout.flush()
-            tries -= 1
-            time.sleep(5)
         print("")
-        err("%s failed to create the %s/%s repository" % (self.what, user, repo))
+        err("%s failed to create the %s/%s repository" % (self.what, user, repo_))
 
     def question(self, question, default=True):
         yn = ['y/N', 'Y/n'][default or self.assume_yes]
         if self.assume_yes:
             print("%s [%s] Y" % (question, yn))
             return True
+        if not self.interactive:
+            err("%s [%s] Use --yes to answer yes" % (question, yn))
         answer = input("%s [%s] " % (question, yn))
         if not answer:
             return default
@@ -322,8 +734,8 @@ Options:
         msg = body.rstrip() + extra
         if title:
             msg = title + '\n\n' + msg
-        if self.git('rev-parse'):
-            temp_file = os.path.join(self.gitm('rev-parse', '--git-dir').stdout.strip(), filename)
+        if self.context.git_dir:
+            temp_file = os.path.join(self.context.git_dir, filename)
         else:
             fd, temp_file = tempfile.mkstemp(prefix=filename)
             os.close(fd)
@@ -353,11 +765,7 @@ Options:
         return temp_file
 
     def repo_root(self):
-        root = self.shell.git('rev-parse', '--show-toplevel').stdout.strip()
-        if not root:
-            root = self.shell.git('rev-parse', '--git-dir').stdout.strip()
-        root = os.path.abspath(root)
-        return root
+        return self.context.root or os.path.abspath('')
 
     def rel2root(self, path):
         if path.startswith('/'):
@@ -373,22 +781,33 @@ Options:
         if triangular and upstream:
             pushremote = remote
             pullremote = upstream
-            self.gitm('config', 'remote.pushDefault', pushremote)
         else:
             pushremote = None
             pullremote = remote
             upstream_branch = None
 
-        for branch in self.git('for-each-ref', 'refs/heads/**').stdout.strip().splitlines():
-            branch = branch.split(None, 2)[-1][11:]
-
-            if upstream_branch and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pullremote, upstream_branch)).stdout.strip():
+        # Take one snapshot of all refs and decide what to do in memory,
+        # repositories can have thousands of branches. A pattern given to
+        # for-each-ref matches a ref or a whole hierarchy of refs, so we
+        # remember all the prefixes too.
+        refs = self.git('for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/remotes').stdout.splitlines()
+        known = set()
+        for ref in refs:
+            parts = ref.split('/')
+            known.update(['/'.join(parts[:num]) for num in range(3, len(parts)+1)])
+        exists = lambda remote, branch: 'refs/remotes/%s/%s' % (remote, branch) in known
+
+        changes = []
+        if pushremote:
+            changes.append(('remote.pushDefault', pushremote))
+        for branch in [ref[11:] for ref in refs if ref.startswith('refs/heads/')]:
+            if upstream_branch and exists(pullremote, upstream_branch):
                 tracking_remote = pullremote
                 tracking_branch = upstream_branch
-            elif self.git('for-each-ref', 'refs/remotes/%s/%s' % (pullremote, branch)).stdout.strip():
+            elif exists(pullremote, branch):
                 tracking_remote = pullremote
                 tracking_branch = branch
-            elif pushremote and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pushremote, branch)).stdout.strip():
+            elif pushremote and exists(pushremote, branch):
                 tracking_remote = pushremote
                 tracking_branch = branch
             else:
@@ -396,29 +815,43 @@ Options:
                 tracking_branch = None
 
             if tracking_remote and tracking_branch:
-                current = self.git('config', 'branch.%s.remote' % branch).stdout.strip()
+                current = self.context.get('branch.%s.remote' % branch).strip()
                 if current in [remote, upstream, '']:
                     print("Configuring branch %s to track branch %s on remote %s" % (branch, tracking_branch, tracking_remote))
-                    self.gitm('config', 'branch.%s.remote' % branch, tracking_remote)
-                    self.gitm('config', 'branch.%s.merge' % branch, 'refs/heads/%s' % tracking_branch)
+                    changes.append(('branch.%s.remote' % branch, tracking_remote))
+                    changes.append(('branch.%s.merge' % branch, 'refs/heads/%s' % tracking_branch))
 
-            if pushremote and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pushremote, branch)).stdout.strip():
-                current = self.git('config', 'branch.%s.pushremote' % branch).stdout.strip()
+            if pushremote and exists(pushremote, branch):
+                current = self.context.get('branch.%s.pushremote' % branch).strip()
                 if current in [remote, upstream, '']:
                     print("Configuring branch %s to push to remote %s" % (branch, pushremote))
-                    self.gitm('config', 'branch.%s.pushremote' % branch, pushremote)
+                    changes.append(('branch.%s.pushremote' % branch, pushremote))
+
+        # And write all changes at once
+        config = ConfigFile(os.path.join(self.context.common_dir, 'config'))
+        try:
+            with config.batch():
+                for key, value in changes:
+                    config.set(key, value)
+        except ConfigError as e:
+            err("fatal: %s" % e)
+        self._context = None
 
     def main(self):
         argv = self.prog.split()[1:] + sys.argv[1:]
-        opts = docopt.docopt(self.usage, argv)
+        with gitspindle.trace.span('parse arguments'):
+            opts = self.parse_args(argv)
         self.assume_yes = opts['--yes']
-        hosts = self.git('config', '--file', self.config_file, '--get-regexp', '%s\..*\.host' % self.spindle).stdout.strip()
+        try:
+            hosts = self.spindle_config.get_regexp(r'^%s\..*\.host$' % re.escape(self.spindle))
+        except ConfigError as e:
+            print("fatal: %s" % e)
+            sys.exit(128)
 
-        for (account, host) in [x.split() for x in hosts.splitlines()]:
-            account = account.split('.')
+        for (account, host) in hosts:
             if host.startswith(('http://', 'https://')):
                 host = urllib.parse.urlparse(host).hostname
-            self.accounts[host] = account[1]
+            self.accounts[host] = account[len(self.spindle)+1:-5]
             self.hosts.append(host)
 
         # Which account do we use?
@@ -436,9 +869,9 @@ Options:
 
         # 3: If we have no [gitXXX], but do have [gitXXX "url"], use it.
         if not self.account and not self.config('user'):
-            accounts = self.git('config', '--file', self.config_file, '--get-regexp', '%s\..*\.user' % self.spindle).stdout.strip()
+            accounts = self.spindle_config.get_regexp(r'^%s\..*\.user$' % re.escape(self.spindle))
             if accounts:
-                self.account = accounts.splitlines()[0].split('.')[1]
+                self.account = accounts[0][0][len(self.spindle)+1:-5]
 
         os.environ['GITSPINDLE_ACCOUNT'] = self.account or self.spindle
         host = self.config('host')
@@ -448,22 +881,24 @@ Options:
                 host = 'ssh://' + host.replace(':', '/')
             self.hosts = [urllib.parse.urlparse(host).hostname]
 
-        for command, func in self.commands.items():
-            if opts[command]:
-                if not func.no_login:
+        command = opts['command']
+        func = self.commands[command]
+        if not func.no_login:
+            session = self.sessions.get(self.session_key())
+            if session:
+                # Logged in already by git-spindle daemon
+                self.__dict__.update(session)
+            else:
+                with self.spindle_config.batch(), gitspindle.trace.span('login'):
                     self.login()
-                opts['command'] = command
-                if isinstance(opts[command], list):
-                    opts['extra-opts'] = opts[command]
-                    opts[command] = True
-                else:
-                    opts['extra-opts'] = []
-                opts['--maybe-parent'] = func.wants_parent
-                try:
-                    func(opts)
-                except KeyboardInterrupt:
-                    sys.exit(1)
-                break
+        try:
+            with gitspindle.trace.span(command, 'command'):
+                func(opts)
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+    def session_key(self):
+        return (self.spindle, self.config_file, self.account, self.config('host'), self.config('user'))
 
     @command
     @no_login
@@ -471,9 +906,10 @@ Options:
         """[--host=<host>] <alias>
            Add an account to the configuration"""
         self.account = opts['<alias>']
-        if opts.get('--host', None):
-            self.config('host', opts['--host'])
-        self.login()
+        with self.spindle_config.batch():
+            if opts.get('--host', None):
+                self.config('host', opts['--host'])
+            self.login()
 
     @command
     @no_login
@@ -491,6 +927,106 @@ Options:
         else:
             print(self.config(key))
 
+    @command
+    def each(self, opts):
+        """<repos> -- <arguments>...
+           Run a command for many repositories"""
+        import copy
+        import time
+        import traceback
+        import gitspindle.aio
+        from gitspindle.ansi import wrap, attr, fgcolor
+        args = opts['<arguments>']
+        command = args[0]
+        if command == 'each' or command not in self.commands:
+            err("%s is not a %s command" % (command, self.prog))
+        repos = self.each_repos(opts['<repos>'])
+        if not repos:
+            err("No repositories match %s" % opts['<repos>'])
+
+        # Parse all arguments first, so mistakes are found before anything
+        # runs. Commands that take a repository get it as argument, others use
+        # it as if it were the repository in the current directory.
+        prefix = self.prog.split()[1:]
+        jobs = []
+        for repo in repos:
+            if '<repo>' in self.registry['commands'][command]:
+                opts_ = self.parse_args(prefix + [command, repo] + args[1:])
+            else:
+                opts_ = self.parse_args(prefix + args)
+                opts_['<repo>'] = repo
+            jobs.append((repo, opts_))
+
+        method = self.registry['attrs'][command]
+        serial = self.commands[command].changes_directory
+        cwd = os.getcwd()
+        def run(job):
+            repo, opts = job
+            # A copy, as commands may set attributes. Sessions and caches are
+            # shared.
+            worker = copy.copy(self)
+            worker.interactive = False
+            worker.capture_output = True
+            worker.assume_yes = self.assume_yes or opts['--yes']
+            start = time.time()
+            status = 0
+            with gitspindle.aio.capture() as output:
+                try:
+                    with gitspindle.trace.span(command, 'command', repo=repo):
+                        getattr(worker, method)(opts)
+                except SystemExit as e:
+                    status = e.code
+                    if isinstance(status, str):
+                        sys.stderr.write(status + "\n")
+                        status = 1
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    if serial:
+                        os.chdir(cwd)
+            return status or 0, output.getvalue(), time.time() - start
+
+        def show(job, result):
+            status, output, elapsed = result
+            print(wrap(job[0], attr.bright))
+            sys.stdout.flush()
+            sys.stdout.buffer.write(output)
+            sys.stdout.buffer.flush()
+
+        with gitspindle.aio.thread_output():
+            # Commands that chdir can't run side by side
+            results = self.fan_out(run, jobs, show, 1 if serial else None, bulk=True)
+
+        maxlen = max([len(repo) for repo in repos])
+        failed = 0
+        sys.stderr.write("\n")
+        for repo, (status, output, elapsed) in zip(repos, results):
+            if status:
+                failed += 1
+                status = wrap("failed (%d)" % status, fgcolor.red)
+            else:
+                status = "ok"
+            sys.stderr.write("%-*s %7.2fs  %s\n" % (maxlen, repo, elapsed, status))
+        sys.stderr.write("%d of %d failed\n" % (failed, len(repos)))
+        if failed:
+            sys.exit(1)
+
+    def each_repos(self, repos):
+        """The repositories each should run a command for: the ones listed in
+           a file, one per line, or the ones matching a pattern like owner/*"""
+        import fnmatch
+        if os.path.isfile(repos):
+            with open(repos) as fd:
+                lines = [line.split('#', 1)[0].strip() for line in fd]
+            return [line for line in lines if line]
+        if '/' not in repos:
+            err("%s is neither a file nor a pattern like owner/*" % repos)
+        owner = repos.rsplit('/', 1)[0]
+        if not any(char in repos for char in '*?['):
+            return [repos]
+        return sorted(repo for repo in self.list_repos(owner) if fnmatch.fnmatchcase(repo.lower(), repos.lower()))
+
     # And debugging
     @hidden_command
     def run_shell(self, opts):
@@ -547,13 +1083,10 @@ Options:
                 # this is a bug GitHub is working on to get a fix, maybe some caching issue on their side
                 # so this code might be removed in the future
                 # wait for the deletions to be recognized, or the test assertions might fail later on
-                tries = 120/5
-                clean = False
-                while tries and not clean:
+                for attempt in Backoff(timeout=120):
                     clean = namespace not in [x.owner.login for x in self.gh.repositories()]
-                    if not clean:
-                        tries -= 1
-                        time.sleep(5)
+                    if clean:
+                        break
                 if not clean:
                     raise RuntimeError("Deleting repositories failed, try again in some minutes or increase the wait timeout in test_cleanup")
             if opts['--gists']:
@@ -590,13 +1123,16 @@ Options:
 class Credential(object):
     shell = whelk.Shell(encoding='utf-8')
     params = ['protocol', 'host', 'path', 'username', 'password']
+    # Passwords looked up by this process, so we ask the helpers only once
+    cache = {}
 
-    def __init__(self, protocol, host, path='', username='', password=''):
+    def __init__(self, protocol, host, path='', username='', password='', cache_timeout=0):
         self.protocol = protocol
         self.host = host
         self.path = path
         self.username = username
         self.password = password
+        self.cache_timeout = cache_timeout
 
     def __str__(self):
         return '%s://%s:%s@%s/%s' % (self.protocol, self.username, self.password, self.host, self.path)
@@ -605,26 +1141,75 @@ class Credential(object):
         return '<Credential %s>' % str(self)
 
     def fill(self):
-        self.communicate('fill')
+        if not self.cached():
+            self.communicate('fill')
+            self.remember()
 
     def fill_noninteractive(self):
+        if self.cached():
+            return
         env = os.environ.copy()
         env['GIT_TERMINAL_PROMPT'] = '0'
         env.pop('GIT_ASKPASS', None)
         env.pop('SSH_ASKPASS', None)
         self.communicate('fill', env=env)
+        self.remember()
 
     def approve(self):
         if not self.username or not self.password:
             raise ValueError("No username or password specified")
         self.communicate('approve')
+        self.remember()
 
     def reject(self):
         if not self.username:
             raise ValueError("No username specified")
+        self.forget()
         self.communicate('reject')
         self.password = ''
 
+    @property
+    def cache_key(self):
+        return (self.protocol, self.host, self.path, self.username)
+
+    def cached(self):
+        """Fill in the password from our caches, returns whether that worked"""
+        if self.cache_key not in Credential.cache and self.cache_timeout:
+            self.shared_cache('get')
+            if self.password:
+                Credential.cache[self.cache_key] = self.password
+        if self.cache_key not in Credential.cache:
+            return False
+        self.password = Credential.cache[self.cache_key]
+        return True
+
+    def remember(self):
+        Credential.cache[self.cache_key] = self.password
+        if self.password and self.cache_timeout:
+            self.shared_cache('store')
+
+    def forget(self):
+        Credential.cache.pop(self.cache_key, None)
+        if self.cache_timeout:
+            self.shared_cache('erase')
+
+    def shared_cache(self, action):
+        # Slow helpers (keychains, vaults) are slow on every invocation, so
+        # secrets can be shared with the next few invocations through git's
+        # credential cache daemon, on a socket of our own.
+        path = gitspindle.cache.cache_dir()
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        except OSError:
+            return
+        socket = os.path.join(path, 'credential-socket')
+        ret = self.shell.git('credential-cache', '--timeout=%d' % self.cache_timeout, '--socket=%s' % socket,
+                             action, input=self.format() + '\n\n')
+        if ret and action == 'get':
+            for key, val in [line.split('=', 1) for line in ret.stdout.splitlines() if '=' in line]:
+                if key in ('username', 'password'):
+                    setattr(self, key, val)
+
     def communicate(self, action, env=os.environ):
         data = self.format() + '\n\n'
         if env.get('GIT_TERMINAL_PROMPT', None) == '0':
@@ -653,18 +1238,26 @@ if os.getenv('GIT_SPINDLE_DEBUG'):
 
 # The main entrypoints
 def hub():
+    gitspindle.daemon.forward('hub')
     from gitspindle.github import GitHub
+    gitspindle.lazy.mark('startup')
     GitHub().main()
 
 def lab():
+    gitspindle.daemon.forward('lab')
     from gitspindle.gitlab import GitLab
+    gitspindle.lazy.mark('startup')
     GitLab().main()
 
 def bucket():
+    gitspindle.daemon.forward('bucket')
     from gitspindle.bitbucket import BitBucket
+    gitspindle.lazy.mark('startup')
     BitBucket().main()
 
 def bb():
+    gitspindle.daemon.forward('bb')
     from gitspindle.bitbucket import BitBucket
+    gitspindle.lazy.mark('startup')
     BitBucket.prog = 'git bb'
     BitBucket().main()
@@ -0,0 +1,142 @@
+# Commands that work on many users, repositories or forks spend most of their
+# time waiting for the network. This lets them do that work concurrently: API
+# calls run in a pool of threads, as the API libraries don't do asyncio, and git
+# runs as asyncio subprocesses. Results are handed back in the order of the
+# input, so the output of a command doesn't depend on what finished first.
+
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import io
+import sys
+import threading
+
+import whelk
+
+__all__ = ['fan_out', 'call', 'git', 'show_git', 'thread_output', 'capture', 'CONCURRENCY']
+
+CONCURRENCY = 8
+
+def fan_out(func, items, show=None, limit=CONCURRENCY):
+    """Call func for all items, with at most limit calls running at the same
+       time, and return the results in order. func is a coroutine function or,
+       for blocking calls, a plain function that is run in a thread. If show is
+       given, it is called with each item and its result, in order, as soon as
+       all earlier items are done. If func fails for an item, results of earlier
+       items are still shown before its exception is raised."""
+    items = list(items)
+    if not items:
+        return []
+    return asyncio.run(_fan_out(func, items, show, max(1, limit)))
+
+async def _fan_out(func, items, show, limit):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(limit, thread_name_prefix='git-spindle'))
+    semaphore = asyncio.Semaphore(limit)
+
+    async def one(item):
+        async with semaphore:
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    return True, await func(item)
+                return True, await loop.run_in_executor(None, func, item)
+            # Including SystemExit from err(), it's raised in order below
+            except BaseException as e:
+                return False, e
+
+    tasks = [asyncio.ensure_future(one(item)) for item in items]
+    results = []
+    try:
+        for item, task in zip(items, tasks):
+            ok, result = await task
+            if not ok:
+                raise result
+            if show:
+                show(item, result)
+            results.append(result)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+async def call(func, *args, **kwargs):
+    """Call a blocking function, like an API call, from a coroutine"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def git(*args, input=None, env=None, cwd=None, redirect=True):
+    """The asyncio version of shell.git: run git and return a whelk Result.
+       Like with whelk, redirect=False leaves its output alone instead of
+       capturing it."""
+    output = asyncio.subprocess.PIPE if redirect else None
+    proc = await asyncio.create_subprocess_exec('git', *[str(arg) for arg in args], cwd=cwd, env=env,
+                                                stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                                                stdout=output, stderr=output)
+    try:
+        out, err = await proc.communicate(input.encode('utf-8') if input is not None else None)
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return whelk.Result(proc.returncode, (out or b'').decode('utf-8', 'replace'), (err or b'').decode('utf-8', 'replace'))
+
+def show_git(item, result):
+    """For fan_out with a func that returns the result of git: show its output
+       and, like GitSpindle.gitm, exit if it failed"""
+    sys.stdout.write(result.stdout)
+    sys.stdout.flush()
+    sys.stderr.write(result.stderr)
+    if not result:
+        sys.exit(result.returncode)
+
+class ThreadOutput(object):
+    """Stands in for sys.stdout or sys.stderr, writing to the buffer of the
+       current thread if it captures its output, or to the real stream"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, 'buffer', None) or self.stream, name)
+
+class Buffer(io.TextIOWrapper):
+    """Captured output. Like sys.stdout, it takes text, and bytes via its
+       buffer attribute, and keeps both in the order they were written."""
+    def __init__(self, stream):
+        super(Buffer, self).__init__(io.BytesIO(), encoding=getattr(stream, 'encoding', None) or 'utf-8',
+                                     errors=getattr(stream, 'errors', None) or 'strict', write_through=True)
+        self.stream = stream
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+@contextlib.contextmanager
+def thread_output():
+    """Let threads capture what they write to stdout and stderr"""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadOutput(stdout), ThreadOutput(stderr)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+@contextlib.contextmanager
+def capture():
+    """Capture what this thread writes to stdout and stderr, inside
+       thread_output(). Both end up in the same buffer, in the order they were
+       written, and getvalue() returns them as bytes. Output of subprocesses
+       isn't captured, unless it's redirected."""
+    stdout, stderr = sys.stdout, sys.stderr
+    if not isinstance(stdout, ThreadOutput) or not isinstance(stderr, ThreadOutput):
+        raise RuntimeError("capture() can only be used inside thread_output()")
+    buffer = Buffer(stdout.stream)
+    stdout.local.buffer = stderr.local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        stdout.local.buffer = stderr.local.buffer = None
@@ -0,0 +1,38 @@
+# Waiting for something to happen on the server side, such as a fork becoming
+# available. We poll quickly at first, as most things are ready within a
+# second or two, and back off exponentially (with some jitter, so parallel
+# invocations don't poll in lockstep) until a deadline.
+
+import random
+import time
+
+__all__ = ['Backoff']
+
+class Backoff(object):
+    """Iterating over a Backoff yields the attempt number, sleeping between
+       attempts, until the deadline has passed. Alternatively, call wait()
+       after each failed attempt and give up when it returns False."""
+    def __init__(self, timeout=120, initial=0.25, maximum=8, factor=2, jitter=0.5):
+        self.deadline = time.monotonic() + timeout
+        self.delay = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def __iter__(self):
+        yield self.attempt
+        while self.wait():
+            yield self.attempt
+
+    def wait(self, minimum=0):
+        """Sleep before the next attempt, for at least minimum seconds if the
+           server asked for that"""
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        delay = max(self.delay * (1 - self.jitter * random.random()), minimum)
+        time.sleep(min(delay, remaining))
+        self.delay = min(self.delay * self.factor, self.maximum)
+        self.attempt += 1
+        return True
@@ -1,3 +1,5 @@
+from gitspindle.backoff import Backoff
+import concurrent.futures
 import json
 from operator import attrgetter
 import requests
@@ -19,10 +21,32 @@ def check(resp):
         return resp.content
     return resp.json()
 
+# The urls below are for bitbucket.org, Bitbucket objects can point them elsewhere
+API_ROOTS = ('https://bitbucket.org/api/2.0', 'https://api.bitbucket.org/2.0')
+# Seconds to wait for a connection, and for the server to send something
+TIMEOUT = (10, 60)
+# The most items Bitbucket sends per page, pull requests come in 50s
+PAGELEN = 100
+
+class Session(requests.Session):
+    """A requests session that doesn't wait forever for the server"""
+    timeout = TIMEOUT
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(Session, self).request(method, url, **kwargs)
+
 class Bitbucket(object):
-    def __init__(self, username, passwd):
+    def __init__(self, username, passwd, api_root=API_ROOTS[0]):
         self.username = username
         self.passwd = passwd
+        self.api_root = api_root.rstrip('/')
+        # Passed to requests, e.g. to notice that our credentials stopped working
+        self.hooks = {'response': []}
+        # Shared by all objects, so they reuse its kept-alive connections
+        self.session = Session()
+        self.session.auth = (username, passwd)
+        self.session.hooks = self.hooks
 
     def user(self, username=None):
         return User(self, username=username)
@@ -33,6 +57,12 @@ class Bitbucket(object):
     def workspace(self, workspace):
         return Workspace(self, workspace=workspace)
 
+    def url(self, url):
+        for root in API_ROOTS:
+            if url.startswith(root + '/'):
+                return self.api_root + url[len(root):]
+        return url
+
 class BitBucketError(Exception):
     pass
 
@@ -50,13 +80,14 @@ class BBobject(object):
         if mode == 'fetch':
             for arg in kwargs:
                 setattr(self, arg, kwargs[arg])
-            self.url = kwargs.get('url', uritemplate.expand(self.uri, **kwargs)).replace('!api', 'api')
-            self.data = self.get(self.url)
+            self.url = self.bb.url(kwargs.get('url', uritemplate.expand(self.uri, **kwargs)).replace('!api', 'api'))
+            resp = self.bb.session.get(self.url)
+            self.etag = resp.headers.get('ETag', None)
+            self.data = check(resp)
         elif mode == 'list':
-            self.url = kwargs.get('url', uritemplate.expand(self.list_uri, **kwargs)).replace('!api', 'api')
+            self.url = self.bb.url(kwargs.get('url', uritemplate.expand(self.list_uri, **kwargs)).replace('!api', 'api'))
             self.instances = []
-            # FIXME properly handle pagination
-            for instance in self.get(self.url)["values"]:
+            for instance in self.paginate(self.url):
                 kw = kwargs.copy()
                 kw.update(instance)
                 instance = type(self)(self.bb, mode=None, **kw)
@@ -74,28 +105,52 @@ class BBobject(object):
     def list(klass, bb, **kwargs):
         return klass(bb, mode="list", **kwargs).instances
 
-    def get(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.get(*args, **kwargs))
-
-    def post(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.post(*args, **kwargs))
-
-    def put(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.put(*args, **kwargs))
-
-    def delete_(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.delete(*args, **kwargs))
+    def paginate(self, url, pagelen=PAGELEN, **kwargs):
+        """The values of all pages of a list, fetched as they're needed. The
+           next page is fetched while the values of this one are used."""
+        url = self.bb.url(url)
+        url += '%spagelen=%d' % ('&' if '?' in url else '?', pagelen)
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            page = self.get(url, **kwargs)
+            while True:
+                next_page = executor.submit(self.get, page['next'], **kwargs) if page.get('next') else None
+                for value in page['values']:
+                    yield value
+                if not next_page:
+                    return
+                page = next_page.result()
+
+    def refresh(self):
+        """Fetch the object again, unless it hasn't changed since we fetched it"""
+        headers = {}
+        if getattr(self, 'etag', None):
+            headers['If-None-Match'] = self.etag
+        resp = self.bb.session.get(self.url, headers=headers)
+        if resp.status_code == 304:
+            return self
+        new = type(self)(self.bb, mode=None, **check(resp))
+        new.url, new.etag = self.url, resp.headers.get('ETag', None)
+        return new
+
+    def get(self, url, *args, **kwargs):
+        return check(self.bb.session.get(self.bb.url(url), *args, **kwargs))
+
+    def post(self, url, *args, **kwargs):
+        return check(self.bb.session.post(self.bb.url(url), *args, **kwargs))
+
+    def put(self, url, *args, **kwargs):
+        return check(self.bb.session.put(self.bb.url(url), *args, **kwargs))
+
+    def delete_(self, url, *args, **kwargs):
+        return check(self.bb.session.delete(self.bb.url(url), *args, **kwargs))
 
 class User(BBobject):
     uri = 'https://bitbucket.org/api/2.0/users/{id}'
 
-    def __init__(self, bb, username):
-        team = bb.team(username)
-        super(User, self).__init__(bb, id=team.account_id)
+    def __init__(self, bb, username=None, mode='fetch', **kwargs):
+        if mode == 'fetch':
+            kwargs['id'] = bb.team(username).account_id
+        super(User, self).__init__(bb, mode=mode, **kwargs)
 
     def __eq__(self, other):
         if isinstance(other, str):
@@ -124,13 +179,11 @@ class User(BBobject):
 
     def repositories(self):
         url = 'https://bitbucket.org/api/2.0/repositories?role=member'
-        data = self.get(url)['values']
-        return [Repository(self.bb, mode=None, **entry) for entry in data]
+        return [Repository(self.bb, mode=None, **entry) for entry in self.paginate(url)]
 
     def snippets(self):
         url = 'https://bitbucket.org/api/2.0/snippets/'
-        data = self.get(url)['values']
-        return [Snippet(self.bb, mode=None, **snippet) for snippet in data]
+        return [Snippet(self.bb, mode=None, **snippet) for snippet in self.paginate(url)]
 
     def create_snippet(self, description, files):
         url = 'https://bitbucket.org/api/2.0/snippets/'
@@ -162,29 +215,29 @@ class Repository(BBobject):
     def __init__(self, *args, **kwargs):
         self.parent = None
         super(Repository, self).__init__(*args, **kwargs)
-        if not hasattr(self, 'links'):
+        if not hasattr(self, 'links') or isinstance(self.links['clone'], dict):
+            # Not fetched yet, or recreated from already processed data
             return
         links, self.links['clone'] = self.links['clone'], {}
         for link in links:
             self.links['clone'][link['name']] = ssh_fix(link['href'])
 
-
     def fork(self):
         self.post(self.url + '/forks', data={'name': self.name})
-        for _ in range(5):
+        for attempt in Backoff(timeout=30):
             try:
                 return self.bb.workspace(self.bb.username).repository(self.name)
             except BitBucketError:
-                print("Waiting for repository to be forked...")
+                if not attempt:
+                    print("Waiting for repository to be forked...")
 
     def branches(self):
-        branches = self.get(self.url + '/refs')['values']
+        branches = self.paginate(self.url + '/refs')
         return dict([(branch['name'], Branch(self.bb, mode=None, repository=self, **branch)) for branch in branches if branch['type'] == 'branch'])
 
     def pull_requests(self, **params):
         url = 'https://bitbucket.org/api/2.0/repositories/%s/pullrequests?state=OPEN' % self.full_name
-        data = self.get(url)['values']
-        return [PullRequest(self.bb, mode=None, **pr) for pr in data]
+        return [PullRequest(self.bb, mode=None, **pr) for pr in self.paginate(url, pagelen=50)]
 
     def pull_request(self, number):
         owner, slug = self.full_name.split('/')
@@ -198,12 +251,12 @@ class Repository(BBobject):
         return PullRequest(self.bb, mode=None, **pr)
 
     def forks(self):
-        data = self.get(self.links['forks']['href'].replace('!api', 'api'))['values']
+        data = self.paginate(self.links['forks']['href'].replace('!api', 'api'))
         return [Repository(self.bb, mode=None, **repo) for repo in data]
 
     def issues(self, **params):
         url = 'https://bitbucket.org/api/2.0/repositories/%s/issues' % self.full_name
-        data = self.get(url, data=params)['values']
+        data = self.paginate(url, data=params)
         return [Issue(self.bb, mode=None, **issue) for issue in data]
 
     def issue(self, id):
@@ -232,7 +285,7 @@ class Repository(BBobject):
     def permissions(self):
         data = {'workspace': self.owner['nickname'], 'slug': self.name}
         url = uritemplate.expand('https://bitbucket.org/api/2.0/workspaces/{workspace}/permissions/repositories/{slug}', data)
-        return self.get(url)['values']
+        return list(self.paginate(url))
 
     def add_deploy_key(self, key, label):
         url = self.url + '/deploy-keys'
@@ -244,7 +297,7 @@ class Repository(BBobject):
 
     def deploy_keys(self):
         url = self.url + '/deploy-keys'
-        return self.get(url)['values']
+        return list(self.paginate(url))
 
 class Branch(BBobject):
     pass
@@ -271,7 +324,8 @@ class Snippet(BBobject):
 
     def __init__(self, *args, **kwargs):
         super(Snippet, self).__init__(*args, **kwargs)
-        if not hasattr(self, 'links'):
+        if not hasattr(self, 'links') or isinstance(self.links['clone'], dict):
+            # Not fetched yet, or recreated from already processed data
             return
         links, self.links['clone'] = self.links['clone'], {}
         for link in links:
@@ -1,12 +1,13 @@
 from gitspindle import *
 from gitspindle.ansi import *
-import gitspindle.bbapi as bbapi
+from gitspindle.lazy import lazy_import
 import getpass
 import glob
 import os
 import sys
-import webbrowser
 import binascii
+bbapi = lazy_import('gitspindle.bbapi')
+webbrowser = lazy_import('webbrowser')
 
 class BitBucket(GitSpindle):
     prog = 'git bucket'
@@ -27,7 +28,7 @@ class BitBucket(GitSpindle):
             print("Generate an application password at https://bitbucket.org/account/settings/app-passwords/ and enter it below")
             password = getpass.getpass("BitBucket password: ")
             try:
-                bbapi.Bitbucket(user, password).user(user)
+                bbapi.Bitbucket(user, password, self.api_root() + '2.0').user(user)
             except:
                 err("Authentication failed")
             self.config('password', password)
@@ -36,8 +37,10 @@ class BitBucket(GitSpindle):
                 location = 'git\'s credential helper'
             print("Your BitBucket authentication password is now stored in %s" % location)
 
-        self.bb = bbapi.Bitbucket(user, password)
-        self.me = self.bb.user(user)
+        self.bb = bbapi.Bitbucket(user, password, self.api_root() + '2.0')
+        self.bb.hooks['response'].append(self.unauthorized)
+        self.configure_session(self.bb.session)
+        self.me = self.cached_identity(password, lambda: self.bb.user(user))
         self.my_login = self.me.nickname
 
     def parse_url(self, url):
@@ -49,9 +52,34 @@ class BitBucket(GitSpindle):
         except bbapi.BitBucketError:
             pass
 
+    def list_repos(self, owner):
+        return [repo.full_name for repo in self.bb.workspace(owner).repositories()]
+
     def parent_repo(self, repo):
         if repo.parent:
-            return bbapi.Repository(self.bb, url=repo.parent['links']['self']['href'])
+            return self.cached_repo(repo.parent['full_name'], lambda: bbapi.Repository(self.bb, url=repo.parent['links']['self']['href']))
+
+    def repo_cache_entry(self, repo):
+        return {'id': repo.uuid, 'full_name': repo.full_name, 'parent': repo.parent and repo.parent['full_name'],
+                'etag': getattr(repo, 'etag', None), 'updated_at': repo.updated_on, 'data': repo.data}
+
+    def repo_from_cache(self, entry):
+        repo = bbapi.Repository(self.bb, mode=None, **entry['data'])
+        repo.url = repo.links['self']['href']
+        repo.etag = entry['etag']
+        return repo
+
+    def revalidate_repo(self, entry):
+        try:
+            return self.repo_from_cache(entry).refresh()
+        except bbapi.BitBucketError:
+            return None
+
+    def identity_cache_entry(self, me):
+        return me.data
+
+    def identity_from_cache(self, entry):
+        return bbapi.User(self.bb, mode=None, **entry)
 
     def clone_url(self, repo, opts):
         if opts['--ssh'] or repo.is_private:
@@ -63,7 +91,10 @@ class BitBucket(GitSpindle):
         return repo.links['clone']['https']
 
     def api_root(self):
-        return 'https://bitbucket.org/api/'
+        host = self.config('host')
+        if not host:
+            return 'https://bitbucket.org/api/'
+        return host.rstrip('/') + '/api/'
 
     # Commands
     @command
@@ -132,13 +163,13 @@ class BitBucket(GitSpindle):
                 sys.exit(1)
 
         # Fetch PR if needed
-        sha = self.git('rev-parse', '--verify', 'refs/pull/%d/head' % pr.id).stdout.strip()
+        sha = self.objects.sha('refs/pull/%d/head' % pr.id) or ''
         if not sha.startswith(pr.source['commit']['hash']):
             print("Fetching pull request")
             ws, repo = pr.source['repository']['full_name'].split('/')
             url = self.clone_url(self.bb.workspace(ws).repository(repo), opts)
             self.gitm('fetch', url, 'refs/heads/%s:refs/pull/%d/head' % (pr.source['branch']['name'], pr.id), redirect=False)
-        head_sha = self.gitm('rev-parse', 'HEAD').stdout.strip()
+        head_sha = self.objects.sha('HEAD')
         if self.git('merge-base', pr.source['commit']['hash'], head_sha).stdout.strip() == head_sha:
             print("Fast-forward merging %s..refs/pull/%d/head" % (pr.destination['branch']['name'], pr.id))
             self.gitm('merge', '--ff-only', 'refs/pull/%d/head' % pr.id, redirect=False)
@@ -178,9 +209,10 @@ class BitBucket(GitSpindle):
                 err("No such file: %s" % arg)
             if not isinstance(content, bytes):
                 err("Not a regular file: %s" % arg)
-            os.write(sys.stdout.fileno(), content)
+            sys.stdout.buffer.write(content)
 
     @command
+    @changes_directory
     def clone(self, opts, repo=None):
         """[--ssh|--http] [--triangular [--upstream-branch=<branch>]] [--parent] [git-clone-options] <repo> [<dir>]
            Clone a repository by name"""
@@ -248,6 +280,7 @@ class BitBucket(GitSpindle):
                 self.gitm('fetch', url, refspec, redirect=False)
 
     @command
+    @changes_directory
     def fork(self, opts):
         """[--ssh|--http] [--triangular [--upstream-branch=<branch>]] [<repo>]
            Fork a repo and clone it"""
@@ -326,10 +359,10 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
             repos = self.me.repositories()
         else:
             repos = [self.repository(opts)]
-        for repo in repos:
+        filters = dict([x.split('=', 1) for x in opts['<filter>']])
+        def fetch(repo):
             if repo.fork and opts['--parent']:
                 repo = self.parent_repo(repo) or repo
-            filters = dict([x.split('=', 1) for x in opts['<filter>']])
             try:
                 issues = repo.issues(**filters)
             except bbapi.BitBucketError:
@@ -338,7 +371,9 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
                 pullrequests = repo.pull_requests()
             except bbapi.BitBucketError:
                 pullrequests = None
-
+            return repo, issues, pullrequests
+        def show(_, result):
+            repo, issues, pullrequests = result
             if issues:
                 print(wrap("Issues for %s" % repo.full_name, attr.bright))
                 for issue in issues:
@@ -347,6 +382,7 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
                 print(wrap("Pull requests for %s" % repo.full_name, attr.bright))
                 for pr in pullrequests:
                     print("[%d] %s %s" % (pr.id, pr.title.encode(sys.stdout.encoding, errors='backslashreplace').decode(sys.stdout.encoding), pr.html_url))
+        self.fan_out(fetch, repos, show)
 
 
     @command
@@ -380,27 +416,9 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
            Mirror a repository, or all repositories for a user"""
         if opts['<repo>'] and opts['<repo>'].endswith('/*'):
             user = opts['<repo>'].rsplit('/', 2)[-2]
-            for repo in self.bb.user(user).repositories():
-                opts['<repo>'] = repo.full_name
-                self.mirror(opts)
+            self.mirror_repos(self.bb.user(user).repositories(), opts, bulk=True)
             return
-        repo = self.repository(opts)
-        git_dir = repo.name + '.git'
-        cur_dir = os.path.basename(os.path.abspath(os.getcwd()))
-        if cur_dir != git_dir and not os.path.exists(git_dir):
-            url = self.clone_url(repo, opts)
-            self.gitm('clone', '--mirror', url, git_dir, redirect=False)
-        else:
-            if git_dir == cur_dir:
-                git_dir = '.'
-            # Update the current, mirrored repo
-            if self.git('--git-dir', git_dir, 'config', 'core.bare').stdout.strip() != 'true' or \
-               self.git('--git-dir', git_dir, 'config', 'remote.origin.mirror').stdout.strip() != 'true':
-                   err("This is not a mirrored repository")
-            self.gitm('--git-dir', git_dir, 'fetch', '-q', '--prune', 'origin', redirect=False)
-
-        with open(os.path.join(git_dir, 'description'), 'w') as fd:
-            fd.write(repo.description or "")
+        self.mirror_repos([self.repository(opts)], opts)
 
     @command
     def permissions(self, opts):
@@ -454,7 +472,9 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
             err("Cannot file a pull request on the same branch")
 
         # Try to get the local commit
-        commit = self.gitm('show-ref', 'refs/heads/%s' % src).stdout.split()[0]
+        commit = self.objects.sha('refs/heads/%s' % src)
+        if not commit:
+            err("Branch %s does not exist" % src)
         # Do they exist on bitbucket?
         srcb = repo.branches().get(src, None)
         if not srcb:
@@ -483,8 +503,7 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
             err("Branch %s does not exist in %s/%s" % (dst, parent.owner.login, parent.name))
 
         # Do we have the dst locally?
-        for remote in self.gitm('remote').stdout.strip().split("\n"):
-            url = self.gitm('config', 'remote.%s.url' % remote).stdout.strip()
+        for remote, url in sorted(self.remotes().items()):
             if url in parent.links['clone'].values():
                 if parent.is_private and url != parent.links['clone']['ssh']:
                     err("You should configure %s to fetch via ssh, it is a private repo" % parent.full_name)
@@ -502,9 +521,9 @@ be ignored, the first line will be used as title for the issue.""" % repo.full_n
 
         # 1 commit: title/body from commit
         if len(commits) == 1:
-            title, body = self.gitm('log', '--pretty=%s\n%b', '%s^..%s' % (commits[0], commits[0])).stdout.split('\n', 1)
-            title = title.strip()
-            body = body.strip()
+            first = self.objects.commit(commits[0])
+            title = first.subject.strip()
+            body = first.body.strip()
             accept_empty_body = not bool(body)
 
         # More commits: title from branchname (titlecased, s/-/ /g), body comments from shortlog
@@ -577,7 +596,7 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.ow
                     pass
 
         url = self.clone_url(repo, opts)
-        if self.git('config', 'remote.%s.url' % remote).stdout.strip() != url:
+        if self.context.get('remote.%s.url' % remote) != url:
             print("Pointing %s to %s" % (remote, url))
             self.gitm('config', 'remote.%s.url' % remote, url)
         self.gitm('config', '--replace-all', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
@@ -585,7 +604,7 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.ow
         if repo.parent:
             parent = self.parent_repo(repo)
             url = self.clone_url(parent, opts)
-            if self.git('config', 'remote.upstream.url').stdout.strip() != url:
+            if self.context.get('remote.upstream.url') != url:
                 print("Pointing upstream to %s" % url)
                 self.gitm('config', 'remote.upstream.url', url)
             self.gitm('config', 'remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
@@ -635,20 +654,25 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.ow
     def whois(self, opts):
         """<user>...
            Display Bitbucket user info"""
-        for user_ in opts['<user>']:
-            user = self.bb.user(user_)
+        def fetch(login):
+            user = self.bb.user(login)
             if not user:
-                print("No such user: %s" % user_)
-                continue
+                return None
+            try:
+                keys = user.keys()
+            except bbapi.BitBucketError:
+                keys = []
+            return user, keys
+        def show(login, result):
+            if not result:
+                print("No such user: %s" % login)
+                return
+            user, keys = result
             print(wrap(user.display_name or user.nickname, attr.bright, attr.underline))
             print("UUID:     %s" % user.account_id)
             print("Profile:  %s" % user.links['html']['href'])
             if user.location:
                 print("Location: %s" % user.location)
-            try:
-                keys = user.keys()
-            except bbapi.BitBucketError:
-                keys = []
             for pkey in keys:
                 algo, key = pkey.key.split()[:2]
                 algo = algo[4:].upper()
@@ -656,3 +680,4 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.ow
                     print("%s key%s...%s (%s)" % (algo, ' ' * (6 - len(algo)), key[-10:], pkey.label))
                 else:
                     print("%s key%s...%s" % (algo, ' ' * (6 - len(algo)), key[-10:]))
+        self.fan_out(fetch, opts['<user>'], show)
@@ -0,0 +1,121 @@
+# Small on-disk caches that make repeated invocations cheaper. Everything in
+# here is best-effort: a missing, corrupt or unwritable cache simply means we
+# do the work again.
+
+import hashlib
+import hmac
+import os
+import pickle
+import tempfile
+import time
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'git-spindle')
+
+def load(name, key):
+    """Return the data stored under name, if it was stored with the same key"""
+    try:
+        with open(os.path.join(cache_dir(), name), 'rb') as fd:
+            data = pickle.load(fd)
+    except Exception:
+        return None
+    if not isinstance(data, tuple) or len(data) != 2 or data[0] != key:
+        return None
+    return data[1]
+
+def store(name, key, data):
+    path = cache_dir()
+    tmp = None
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path, prefix='.' + name)
+        with os.fdopen(fd, 'wb') as fd:
+            pickle.dump((key, data), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, os.path.join(path, name))
+    except Exception:
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+
+_secret_key = None
+
+def secret_key():
+    """A random key for digest, created once per cache directory"""
+    global _secret_key
+    if _secret_key:
+        return _secret_key
+    path = os.path.join(cache_dir(), 'secret-key')
+    tmp = None
+    try:
+        os.makedirs(cache_dir(), mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir(), prefix='.secret-key')
+        with os.fdopen(fd, 'wb') as fd:
+            fd.write(os.urandom(32))
+        # Linking fails if another process got there first, then use theirs
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        with open(path, 'rb') as fd:
+            key = fd.read()
+        if len(key) != 32:
+            raise ValueError("Corrupt key")
+    except (OSError, ValueError):
+        # Digests will only match within this process
+        key = os.urandom(32)
+    finally:
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+    _secret_key = key
+    return key
+
+def digest(data):
+    """Tells apart credentials, or data that contains them, without storing
+       something that can be checked against guesses offline"""
+    return hmac.new(secret_key(), data.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def file_key(*paths):
+    """A cache key that changes whenever one of the files changes"""
+    key = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            key.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            key.append((path, None, None))
+    return tuple(key)
+
+class Store(object):
+    """A dict of timestamped entries that persists in the cache directory.
+       Every change is written out immediately, entries older than expire
+       seconds are dropped when writing."""
+    def __init__(self, name, key, expire=None):
+        self.name = name
+        self.key = key
+        self.expire = expire
+        self.data = load(name, key) or {}
+
+    def get(self, item):
+        if item in self.data:
+            return self.data[item][1]
+
+    def age(self, item):
+        return time.time() - self.data[item][0]
+
+    def __setitem__(self, item, value):
+        self.update(item, (time.time(), value))
+
+    def __delitem__(self, item):
+        self.update(item, None)
+
+    def update(self, item, value):
+        # Another process may have written the store since we loaded it
+        self.data = load(self.name, self.key) or self.data
+        if value is None:
+            self.data.pop(item, None)
+        else:
+            self.data[item] = value
+        if self.expire:
+            now = time.time()
+            self.data = dict([(item, value) for (item, value) in self.data.items() if now - value[0] < self.expire])
+        store(self.name, self.key, self.data)
@@ -0,0 +1,135 @@
+# Record the API requests git-spindle makes and replay them later, without
+# touching the network. This makes performance measurements repeatable: record
+# a session against the real service once, then replay it as often as needed.
+#
+# GIT_SPINDLE_RECORD=<file> records all requests and responses to a file, and
+# GIT_SPINDLE_REPLAY=<file> replays them. Replays are strict: a request that
+# wasn't recorded, or was recorded fewer times, is an error. Requests are
+# matched on method and url only, so replays work with other credentials.
+# Since the on-disk caches influence which requests are made, record and replay
+# with the same cache state, e.g. an empty XDG_CACHE_HOME.
+#
+# Replays are as fast as possible, unless GIT_SPINDLE_REPLAY_LATENCY is set. It
+# is multiplied with the time each response took when it was recorded, so 1
+# replays with the recorded latencies, and 2 simulates a slower connection.
+
+import atexit
+import base64
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+
+__all__ = ['CassetteAdapter', 'CassetteError']
+
+VERSION = 1
+# Not meaningful for a body we stored decoded
+SKIP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive')
+
+class CassetteError(requests.exceptions.RequestException):
+    pass
+
+class Cassette(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = os.environ.get('GIT_SPINDLE_REPLAY')
+        self.replaying = bool(self.path)
+        if self.replaying:
+            latency = os.environ.get('GIT_SPINDLE_REPLAY_LATENCY', '') or '0'
+            try:
+                self.latency = float(latency)
+            except ValueError:
+                raise CassetteError("GIT_SPINDLE_REPLAY_LATENCY must be a number, not %s" % latency)
+            try:
+                with open(self.path) as fd:
+                    data = json.load(fd)
+            except (OSError, ValueError) as e:
+                raise CassetteError("Cannot replay %s: %s" % (self.path, e))
+            if data.get('version') != VERSION:
+                raise CassetteError("Cannot replay %s: recorded with an incompatible version" % self.path)
+            self.interactions = collections.defaultdict(collections.deque)
+            for interaction in data['interactions']:
+                self.interactions[interaction['method'], interaction['url']].append(interaction)
+            atexit.register(self.check)
+        else:
+            self.path = os.environ['GIT_SPINDLE_RECORD']
+            self.interactions = []
+            atexit.register(self.save)
+
+    def record(self, request, response):
+        headers = dict((k, v) for (k, v) in response.headers.items() if k.lower() not in SKIP_HEADERS)
+        with self.lock:
+            self.interactions.append({'method': request.method, 'url': request.url, 'status': response.status_code,
+                                      'reason': response.reason, 'headers': headers, 'elapsed': response.elapsed.total_seconds(),
+                                      'body': base64.b64encode(response.content).decode('ascii')})
+
+    def play(self, request):
+        with self.lock:
+            recorded = self.interactions.get((request.method, request.url))
+            if not recorded:
+                raise CassetteError("Request not found in %s: %s %s" % (self.path, request.method, request.url), request=request)
+            interaction = recorded.popleft()
+        if self.latency:
+            time.sleep(interaction['elapsed'] * self.latency)
+        return interaction
+
+    def save(self):
+        with self.lock:
+            interactions = list(self.interactions)
+        try:
+            with open(self.path, 'w') as fd:
+                json.dump({'version': VERSION, 'interactions': interactions}, fd, indent=1)
+        except OSError as e:
+            sys.stderr.write("Could not save recorded requests: %s\n" % e)
+
+    def check(self):
+        left = sum(len(recorded) for recorded in self.interactions.values())
+        if left:
+            sys.stderr.write("%d recorded request%s not replayed\n" % (left, {1: ' was'}.get(left, 's were')))
+
+_cassette = None
+def cassette():
+    global _cassette
+    if not _cassette:
+        _cassette = Cassette()
+    return _cassette
+
+class CassetteAdapter(requests.adapters.BaseAdapter):
+    """A transport adapter that records the responses of the adapter it
+       wraps, or replays them without using that adapter at all."""
+    def __init__(self, adapter):
+        super(CassetteAdapter, self).__init__()
+        self.adapter = adapter
+        self.cassette = cassette()
+
+    def send(self, request, **kwargs):
+        if self.cassette.replaying:
+            return self.build_response(request, self.cassette.play(request))
+        response = self.adapter.send(request, **kwargs)
+        self.cassette.record(request, response)
+        return response
+
+    def build_response(self, request, interaction):
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(interaction['headers'])
+        response._content = base64.b64decode(interaction['body'])
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = datetime.timedelta(seconds=interaction['elapsed'])
+        return response
+
+    def close(self):
+        self.adapter.close()
@@ -0,0 +1,135 @@
+# Read git objects through long-running git cat-file processes, so reading
+# many objects costs a pipe round-trip per object instead of a fork.
+
+import atexit
+import subprocess
+
+import gitspindle.trace
+
+__all__ = ['CatFile']
+
+class TreeEntry(object):
+    def __init__(self, mode, name, sha):
+        self.mode = mode
+        self.name = name
+        self.sha = sha
+        self.type = {'40000': 'tree', '160000': 'commit'}.get(mode, 'blob')
+
+    def __repr__(self):
+        return '<TreeEntry %s %s %s %s>' % (self.mode, self.type, self.sha, self.name)
+
+class Commit(object):
+    def __init__(self, sha, data):
+        self.sha = sha
+        self.parents = []
+        self.headers = {}
+        headers, _, message = data.partition(b'\n\n')
+        key = None
+        for line in headers.split(b'\n'):
+            if line.startswith(b' '):
+                # Continuation of a multi-line header, such as gpgsig. One
+                # without a header to continue is garbage, ignore it.
+                if key in self.headers:
+                    self.headers[key] += '\n' + line[1:].decode('utf-8', 'replace')
+                continue
+            key, _, value = line.decode('utf-8', 'replace').partition(' ')
+            if key == 'parent':
+                self.parents.append(value)
+            else:
+                self.headers[key] = value
+        self.tree = self.headers.get('tree')
+        self.author = self.headers.get('author')
+        self.committer = self.headers.get('committer')
+        self.message = message.decode(self.headers.get('encoding', 'utf-8'), 'replace')
+        # Like git log's %s and %b
+        paragraphs = self.message.strip('\n').split('\n\n', 1)
+        self.subject = ' '.join(line.strip() for line in paragraphs[0].splitlines())
+        self.body = paragraphs[1] if len(paragraphs) > 1 else ''
+
+    def __repr__(self):
+        return '<Commit %s %s>' % (self.sha, self.subject)
+
+class CatFile(object):
+    """Object access for one repository. Objects can be named with anything
+       git rev-parse understands, such as HEAD, refs/heads/master or
+       master:README"""
+    instances = []
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.procs = {}
+        CatFile.instances.append(self)
+
+    def _request(self, mode, name):
+        if '\n' in name:
+            return None, None, None
+        proc = self.procs.get(mode)
+        if not proc or proc.poll() is not None:
+            git = ['git', '--git-dir', self.git_dir] if self.git_dir else ['git']
+            proc = self.procs[mode] = subprocess.Popen(git + ['cat-file', mode], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with gitspindle.trace.span('git cat-file %s' % mode, 'subprocess', object=name):
+            proc.stdin.write(name.encode('utf-8') + b'\n')
+            proc.stdin.flush()
+            header = proc.stdout.readline().decode('utf-8').rstrip('\n')
+        # <name> missing or <name> ambiguous, where name may contain spaces
+        header = header.rsplit(' ', 2)
+        if len(header) != 3 or header[-1] in ('missing', 'ambiguous') or not header[2].isdigit():
+            return None, None, None
+        sha, type, size = header[0], header[1], int(header[2])
+        if mode == '--batch-check':
+            return sha, type, size
+        return sha, type, proc.stdout.read(size + 1)[:-1]
+
+    def info(self, name):
+        """Returns a (sha, type, size) tuple, or None if the object doesn't exist"""
+        sha, type, size = self._request('--batch-check', name)
+        if sha:
+            return sha, type, size
+
+    def sha(self, name):
+        return self._request('--batch-check', name)[0]
+
+    def type(self, name):
+        return self._request('--batch-check', name)[1]
+
+    def read(self, name):
+        """Returns a (sha, type, data) tuple, or None if the object doesn't exist"""
+        sha, type, data = self._request('--batch', name)
+        if sha:
+            return sha, type, data
+
+    def blob(self, name, encoding='utf-8'):
+        sha, type, data = self._request('--batch', name)
+        if type == 'blob':
+            return data.decode(encoding, 'replace') if encoding else data
+
+    def tree(self, name):
+        """Returns a list of TreeEntry objects, or None if name isn't a tree-ish"""
+        sha, type, data = self._request('--batch', name + '^{tree}')
+        if type != 'tree':
+            return None
+        entries = []
+        size = len(sha) // 2 # 20 for sha1, 32 for sha256 repositories
+        while data:
+            header, _, data = data.partition(b'\0')
+            mode, _, path = header.decode('utf-8', 'replace').partition(' ')
+            entries.append(TreeEntry(mode, path, data[:size].hex()))
+            data = data[size:]
+        return entries
+
+    def commit(self, name):
+        sha, type, data = self._request('--batch', name + '^{commit}')
+        if type == 'commit':
+            return Commit(sha, data)
+
+    def close(self):
+        for proc in self.procs.values():
+            if proc.poll() is None:
+                proc.stdin.close()
+                proc.wait()
+        self.procs = {}
+
+@atexit.register
+def close_all():
+    for instance in CatFile.instances:
+        instance.close()
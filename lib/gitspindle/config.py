@@ -0,0 +1,293 @@
+# A reader and writer for git-config style files such as ~/.gitspindle, so we
+# don't need to run git config for every key we look up or set. Edits only
+# touch the lines of the keys involved, comments and layout are preserved.
+
+import contextlib
+import os
+import re
+
+__all__ = ['ConfigFile', 'ConfigError']
+
+section_re = re.compile(r'^\s*\[\s*([-.a-zA-Z0-9]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+key_re = re.compile(r'^\s*([a-zA-Z][-a-zA-Z0-9]*)\s*(=|$|[#;])')
+escapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+class ConfigError(Exception):
+    pass
+
+class ConfigFile(object):
+    """A config file. Without a mode, existing files keep theirs and new
+       ones get 0666 minus the umask, like git does."""
+    def __init__(self, path, mode=None):
+        self.path = path
+        self.mode = mode
+        self.stat = None
+        self.lines = []
+        self.entries = []
+        self.sections = []
+        self.pending = []
+        self.batched = 0
+
+    def __repr__(self):
+        return '<ConfigFile %s>' % self.path
+
+    # Reading
+    def get(self, key, default=None):
+        key = normalize(key)
+        for key_, value in reversed(self.pending):
+            if normalize(key_) == key:
+                return default if value is None else value
+        self.refresh()
+        for key_, value, _, _ in reversed(self.entries):
+            if key_ == key:
+                return value
+        return default
+
+    def get_regexp(self, regexp):
+        self.refresh()
+        entries = self.entries
+        if self.pending:
+            entries = parse(self.apply(self.pending), self.path)[0]
+        regexp = re.compile(regexp)
+        return [(key, value) for (key, value, _, _) in entries if regexp.search(key)]
+
+    def refresh(self):
+        """(Re)read the file if it changed since we last read it"""
+        try:
+            st = os.stat(self.path)
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            stat = None
+        if stat == self.stat:
+            return
+        self.stat = stat
+        self.lines = []
+        if stat:
+            with open(self.path, encoding='utf-8') as fd:
+                self.lines = fd.read().splitlines(True)
+        self.entries, self.sections = parse(self.lines, self.path)
+
+    # Writing
+    def set(self, key, value):
+        self.change(key, value)
+
+    def unset(self, key):
+        self.refresh()
+        key_ = normalize(key)
+        matches = [entry for entry in self.entries if entry[0] == key_]
+        if self.get(key) is None:
+            raise KeyError(key)
+        if len(matches) > 1:
+            raise ConfigError("%s has multiple values" % key)
+        self.change(key, None)
+
+    def change(self, key, value):
+        self.pending.append((key, value))
+        if not self.batched:
+            self.save()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect all changes made in this block and write them out at once"""
+        self.batched += 1
+        try:
+            yield self
+        finally:
+            self.batched -= 1
+            if not self.batched and self.pending:
+                self.save()
+
+    def save(self):
+        # Lock the file like git does, so concurrent git config calls don't
+        # overwrite our changes or vice versa
+        lock = self.path + '.lock'
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666 if self.mode is None else self.mode)
+        except FileExistsError:
+            raise ConfigError("could not lock config file %s: File exists" % self.path)
+        try:
+            # Someone may have changed the file since we read it, apply our
+            # changes to the latest version
+            self.refresh()
+            # The lock file replaces the file, so it needs the mode the file
+            # had, e.g. group-writable with core.sharedRepository
+            if self.mode is None and self.stat:
+                os.fchmod(fd, os.stat(self.path).st_mode & 0o7777)
+            with os.fdopen(fd, 'w', encoding='utf-8') as fd:
+                fd.write(''.join(self.apply(self.pending)))
+            os.replace(lock, self.path)
+        except:
+            if os.path.exists(lock):
+                os.unlink(lock)
+            raise
+        self.pending = []
+        self.refresh()
+
+    def apply(self, changes):
+        """Return our lines with a list of (key, value) changes applied, a
+           value of None removes the key. This is done in a single pass, so
+           setting thousands of keys at once is cheap."""
+        last = {}
+        for num, entry in enumerate(self.entries):
+            last[entry[0]] = num
+        # Where to add new keys to an existing section: after the last key of
+        # the last section with that name
+        section_end = {}
+        starts = [start for (_, start) in self.sections] + [len(self.lines)]
+        entries = iter(self.entries)
+        entry = next(entries, None)
+        for num, (section, start) in enumerate(self.sections):
+            end = start + 1
+            while entry and entry[2] < starts[num+1]:
+                end = max(end, entry[3])
+                entry = next(entries, None)
+            section_end[section] = end
+
+        replace = {}
+        insert = {}
+        append = {}
+        names = {}
+        for key_, value in changes:
+            # Like git, we keep the case of the key as given when writing it
+            line = None if value is None else '\t%s = %s\n' % (key_.rsplit('.', 1)[1], format_value(value))
+            key = normalize(key_)
+            section = key.rsplit('.', 1)[0]
+            if key in last:
+                replace[self.entries[last[key]][2]] = (line, self.entries[last[key]][3])
+            elif section in section_end:
+                insert.setdefault(section_end[section], {})[key] = line
+            elif value is not None or key in append.get(section, {}):
+                append.setdefault(section, {})[key] = line
+                names.setdefault(section, key_.rsplit('.', 1)[0])
+
+        source = self.lines[:]
+        if source and not source[-1].endswith('\n'):
+            source[-1] += '\n'
+        headers = set(starts)
+        lines = []
+        num = 0
+        while num <= len(source):
+            lines += [line for line in insert.get(num, {}).values() if line]
+            if num == len(source):
+                break
+            if num in replace:
+                if num in headers:
+                    # A key on the same line as its section header
+                    lines.append(section_re.match(source[num]).group(0) + '\n')
+                line, num = replace[num]
+                if line:
+                    lines.append(line)
+                continue
+            lines.append(source[num])
+            num += 1
+        for section, keys in append.items():
+            keys = [line for line in keys.values() if line]
+            if keys:
+                lines += [format_section(names[section])] + keys
+        return lines
+
+def parse(lines, path):
+    """Returns a list of (key, value, start, end) entries and a list of
+       (section, start) sections found in lines"""
+    entries = []
+    sections = []
+    section = None
+    num = 0
+    while num < len(lines):
+        line = lines[num]
+        start = num
+        num += 1
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        if stripped.startswith('['):
+            match = section_re.match(line)
+            if not match:
+                raise ConfigError("bad config line %d in file %s" % (num, path))
+            name, subsection = match.groups()
+            if subsection is not None:
+                section = '%s.%s' % (name.lower(), re.sub(r'\\(.)', r'\1', subsection))
+            elif '.' in name:
+                # Deprecated [section.subsection] syntax
+                name, subsection = name.split('.', 1)
+                section = '%s.%s' % (name.lower(), subsection.lower())
+            else:
+                section = name.lower()
+            sections.append((section, start))
+            line = line[match.end():]
+            if not line.strip() or line.strip()[0] in '#;':
+                continue
+        match = key_re.match(line)
+        if not match or not section:
+            raise ConfigError("bad config line %d in file %s" % (num, path))
+        key = '%s.%s' % (section, match.group(1).lower())
+        if match.group(2) != '=':
+            entries.append((key, 'true', start, num))
+            continue
+        value, num = parse_value(line[match.end():], lines, num, path)
+        entries.append((key, value, start, num))
+    return entries, sections
+
+def normalize(key):
+    # Section and key names are case insensitive, subsections are not
+    section, _, rest = key.partition('.')
+    subsection, _, name = rest.rpartition('.')
+    if subsection:
+        return '%s.%s.%s' % (section.lower(), subsection, name.lower())
+    return '%s.%s' % (section.lower(), name.lower())
+
+def parse_value(value, lines, num, path):
+    # Like git, treat the value as one stream of characters: a backslash at
+    # the end of a line continues it on the next one, and every unquoted run
+    # of whitespace between words is kept as that many spaces.
+    ret = ''
+    quoted = False
+    space = 0
+    value = value.rstrip('\r\n')
+    i = 0
+    while i < len(value):
+        char = value[i]
+        i += 1
+        if char in ' \t\r' and not quoted:
+            if ret:
+                space += 1
+            continue
+        if char in '#;' and not quoted:
+            break
+        ret += ' ' * space
+        space = 0
+        if char == '"':
+            quoted = not quoted
+        elif char == '\\':
+            if i == len(value):
+                # Continuation line, or the end of the file
+                if num == len(lines):
+                    break
+                value = lines[num].rstrip('\r\n')
+                num += 1
+                i = 0
+                continue
+            char = value[i]
+            i += 1
+            if char not in escapes:
+                raise ConfigError("bad config line %d in file %s" % (num, path))
+            ret += escapes[char]
+        else:
+            ret += char
+    if quoted:
+        raise ConfigError("bad config line %d in file %s" % (num, path))
+    return ret, num
+
+def format_value(value):
+    value = str(value)
+    quote = value != value.strip() or '#' in value or ';' in value
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t').replace('\b', '\\b')
+    if quote:
+        value = '"%s"' % value
+    return value
+
+def format_section(section):
+    if '.' not in section:
+        return '[%s]\n' % section
+    name, subsection = section.split('.', 1)
+    return '[%s "%s"]\n' % (name, subsection.replace('\\', '\\\\').replace('"', '\\"'))
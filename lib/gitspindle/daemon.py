@@ -0,0 +1,290 @@
+"""Run a git-spindle daemon that keeps API libraries imported and all accounts
+logged in, so git hub/lab/bb only need to hand their work to it
+
+Usage:
+  git spindle daemon [--detach]
+  git spindle stop
+
+Options:
+  -h --help  Show this help message and exit
+  --detach   Run in the background
+"""
+
+# The git hub, git lab and git bb commands check whether a daemon is listening
+# on its socket. If so, they send it their arguments, working directory,
+# environment and stdin/stdout/stderr file descriptors, and wait for the exit
+# status. The daemon forks a worker for every request, which runs the command
+# as if it were started directly, but with a session that's already logged in.
+#
+# Set GIT_SPINDLE_NO_DAEMON=1 to bypass a running daemon. Commands whose requests
+# are recorded or replayed never use the daemon, its sessions aren't set up for
+# that.
+
+import array
+import json
+import os
+import re
+import signal
+import socket
+import struct
+import sys
+import time
+
+import gitspindle.cache
+import gitspindle.lazy
+import gitspindle.stats
+import gitspindle.trace
+
+__all__ = ['forward', 'main']
+
+def socket_path():
+    return os.path.join(gitspindle.cache.cache_dir(), 'daemon-socket')
+
+def send(sock, data, fds=[]):
+    data = json.dumps(data).encode('utf-8')
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    sock.sendmsg([struct.pack('!I', len(data))], ancillary)
+    sock.sendall(data)
+
+def receive(sock, maxfds=0):
+    fds = array.array('i')
+    header, ancillary, _, _ = sock.recvmsg(4, socket.CMSG_SPACE(maxfds * fds.itemsize))
+    for level, type, data in ancillary:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if len(header) != 4:
+        return None, list(fds)
+    size = struct.unpack('!I', header)[0]
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None, list(fds)
+        data += chunk
+    return json.loads(data.decode('utf-8')), list(fds)
+
+def connect():
+    if not hasattr(socket, 'AF_UNIX') or os.environ.get('GIT_SPINDLE_NO_DAEMON', '') not in ('', '0'):
+        return None
+    if os.environ.get('GIT_SPINDLE_RECORD') or os.environ.get('GIT_SPINDLE_REPLAY'):
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+# The client side
+def forward(spindle):
+    """Let a daemon run this command, if one is running. Only returns if
+       there is no daemon to talk to."""
+    sock = connect()
+    if not sock:
+        return
+    umask = os.umask(0o22)
+    os.umask(umask)
+    try:
+        send(sock, {'spindle': spindle, 'argv': sys.argv, 'cwd': os.getcwd(), 'env': dict(os.environ), 'umask': umask}, [0, 1, 2])
+        pid, _ = receive(sock)
+    except OSError:
+        pid = None
+    if pid is None:
+        # Not a daemon, or it went away. Do the work ourselves.
+        sock.close()
+        return
+    # The worker is not in our process group, so pass on signals meant for us
+    def relay(signum, frame):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, relay)
+    status, _ = receive(sock)
+    # The worker saved its trace and stats, don't overwrite them with ours
+    del gitspindle.trace.events[:]
+    gitspindle.stats.reported = True
+    sys.exit(1 if status is None else status)
+
+# The daemon side
+class Daemon(object):
+    def __init__(self):
+        from gitspindle import GitSpindle
+        from gitspindle.github import GitHub
+        from gitspindle.gitlab import GitLab
+        from gitspindle.bitbucket import BitBucket
+        self.GitSpindle = GitSpindle
+        self.spindles = {'hub': GitHub, 'lab': GitLab, 'bucket': BitBucket, 'bb': BitBucket}
+        self.config_file = None
+        self.config_key = None
+
+    def warm_up(self):
+        """Log in to all accounts we have credentials for"""
+        sessions = {}
+        for cls in set(self.spindles.values()):
+            spindle = cls()
+            self.config_file = spindle.config_file
+            self.config_key = gitspindle.cache.file_key(spindle.config_file)
+            accounts = spindle.spindle_config.get_regexp(r'^%s\..*\.user$' % re.escape(spindle.spindle))
+            for account in [None] + [key[len(spindle.spindle)+1:-5] for (key, _) in accounts]:
+                spindle.account = account
+                # Don't start interactive logins for incomplete accounts
+                if not spindle.config('user') or not (spindle.config('token') or spindle.config('password')):
+                    continue
+                before = dict(vars(spindle))
+                try:
+                    spindle.login()
+                except (Exception, SystemExit) as e:
+                    sys.stderr.write("Could not log in to %s account %s: %s\n" % (spindle.spindle, account or 'default', e))
+                    continue
+                session = dict((attr, value) for (attr, value) in vars(spindle).items() if before.get(attr, None) is not value)
+                # Don't keep idle connections around, workers can't share them
+                for value in session.values():
+                    if hasattr(getattr(value, 'session', None), 'close'):
+                        value.session.close()
+                sessions[spindle.session_key()] = session
+        self.GitSpindle.sessions = sessions
+
+    def serve(self):
+        path = socket_path()
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            try:
+                sock.connect(path)
+                sys.stderr.write("A git-spindle daemon is already running\n")
+                sys.exit(1)
+            except OSError:
+                os.unlink(path)
+            sock.close()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        sock.bind(path)
+        os.umask(old_umask)
+        sock.listen(64)
+        # Workers are never waited for
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    if not self.handle(sock, conn):
+                        break
+                finally:
+                    conn.close()
+        finally:
+            os.unlink(path)
+
+    def handle(self, sock, conn):
+        if hasattr(socket, 'SO_PEERCRED'):
+            uid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))[1]
+            if uid != os.getuid():
+                return True
+        conn.settimeout(5)
+        try:
+            request, fds = receive(conn, 3)
+        except (OSError, ValueError):
+            return True
+        try:
+            if request == 'stop':
+                send(conn, 0)
+                return False
+            if not isinstance(request, dict) or request.get('spindle') not in self.spindles or len(fds) != 3:
+                return True
+            if gitspindle.cache.file_key(self.config_file) != self.config_key:
+                self.warm_up()
+            conn.settimeout(None)
+            if os.fork() == 0:
+                sock.close()
+                status = 1
+                try:
+                    status = self.work(conn, request, fds)
+                finally:
+                    os._exit(status)
+            return True
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def work(self, conn, request, fds):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for (num, fd) in enumerate(fds):
+            os.dup2(fd, num)
+        send(conn, os.getpid())
+        os.chdir(request['cwd'])
+        os.umask(request['umask'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = request['argv']
+        encoding = os.environ.get('PYTHONIOENCODING', '').split(':')[0] or None
+        sys.stdin = open(0, 'r', encoding=encoding, closefd=False)
+        sys.stdout = open(1, 'w', encoding=encoding, buffering=1 if os.isatty(1) else -1, closefd=False)
+        sys.stderr = open(2, 'w', encoding=encoding, buffering=1, closefd=False)
+        gitspindle.lazy.started = time.perf_counter()
+        gitspindle.trace.install()
+        gitspindle.stats.install()
+        # Secrets may have changed since we logged in, don't use stale ones
+        from gitspindle import Credential
+        Credential.cache = {}
+        cls = self.spindles[request['spindle']]
+        if request['spindle'] == 'bb':
+            cls.prog = 'git bb'
+        try:
+            cls().main()
+            status = 0
+        except SystemExit as e:
+            status = e.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                sys.stderr.write('%s\n' % status)
+                status = 1
+        except KeyboardInterrupt:
+            status = 130
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        for fd in (sys.stdout, sys.stderr):
+            try:
+                fd.flush()
+            except OSError:
+                pass
+        # We exit without running atexit handlers
+        gitspindle.trace.save()
+        gitspindle.stats.report()
+        send(conn, status)
+        return 0
+
+def stop():
+    sock = connect()
+    if not sock:
+        sys.stderr.write("No git-spindle daemon is running\n")
+        sys.exit(1)
+    send(sock, 'stop')
+    receive(sock)
+
+def main():
+    # Not docopt, gitspindle.monkey teaches that to parse git hub/lab/bb usage
+    args = sys.argv[1:]
+    if args == ['stop']:
+        return stop()
+    if args not in (['daemon'], ['daemon', '--detach']):
+        sys.stderr.write(__doc__[__doc__.index('Usage:'):])
+        sys.exit(1)
+    daemon = Daemon()
+    daemon.warm_up()
+    if '--detach' in args:
+        if os.fork():
+            return
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    daemon.serve()
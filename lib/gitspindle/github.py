@@ -1,39 +1,23 @@
 from gitspindle import *
 from gitspindle.ansi import *
+from gitspindle.lazy import lazy_import
+import gitspindle.monkey
 import datetime
 import getpass
-import github3
-import github3.gists
-import github3.session
 import glob
 import os
 import re
-import requests
 import socket
 import sys
 import tempfile
 import time
-import webbrowser
+github3 = lazy_import('github3', gitspindle.monkey.patch_github3)
+webbrowser = lazy_import('webbrowser')
 
-class RateLimitedSession(github3.session.GitHubSession):
-    """A session subclass that warns when we're approaching API rate limits"""
-    def __init__(self, *args, **kwargs):
-        super(RateLimitedSession, self).__init__(*args, **kwargs)
-        self.warned = False
-
-    def request(self, *args, **kwargs):
-        response = super(RateLimitedSession, self).request(*args, **kwargs)
-
-        limit = int(response.headers.get('x-ratelimit-limit', 0))
-        remaining = int(response.headers.get('x-ratelimit-remaining', 0))
-        reset = int(response.headers.get('x-ratelimit-reset', 0))
-
-        if limit and (remaining < 0.20 * limit) and not self.warned:
-            msg = "You are approaching the API rate limit. Only %d/%d requests remain until %s"
-            msg = msg % (remaining, limit, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(reset)))
-            print(wrap(msg, fgcolor.red, attr.bright))
-            self.warned = True
-        return response
+def issue_url(issue):
+    # Pull requests are issues too, the issue tells us their url so we don't
+    # need to fetch the pull request
+    return (issue.pull_request_urls or {}).get('html_url') or issue.html_url
 
 class GitHub(GitSpindle):
     prog = 'git hub'
@@ -48,14 +32,11 @@ class GitHub(GitSpindle):
         host = self.config('host')
         if host and host not in ('https://api.github.com', 'api.github.com'):
             if not host.startswith(('http://', 'https://')):
-                try:
-                    requests.get('https://' + host)
-                except:
-                    err("%s is not reachable via https. Use http://%s to use the insecure http protocol" % (host, host))
-                host = 'https://' + host
-            self.gh = github3.GitHubEnterprise(url=host, session=RateLimitedSession())
+                host = self.https_host(host)
+            self.gh = github3.GitHubEnterprise(url=host)
         else:
-            self.gh = github3.GitHub(session=RateLimitedSession())
+            self.gh = github3.GitHub()
+        self.configure_session(self.gh.session)
 
         user = self.config('user')
         if not user:
@@ -65,7 +46,7 @@ class GitHub(GitSpindle):
         token = self.config('token')
         if not token:
             url = self.gh._build_url('login/device/code').replace('api.github.com','github.com')
-            resp = requests.post(url,data={'client_id': self.client_id, 'scope': 'user,repo,gist,admin:public_key,admin:repo_hook,admin:org'}, headers={'Accept': 'application/json'})
+            resp = self.gh.session.post(url,data={'client_id': self.client_id, 'scope': 'user,repo,gist,admin:public_key,admin:repo_hook,admin:org'}, headers={'Accept': 'application/json'})
             if resp.status_code != 200:
                 # We don't support the device flow yet
                 print("Generate a personal access token at %s and enter it below" % self.gh._build_url('settings/tokens').replace('api.github.com','github.com'))
@@ -77,7 +58,7 @@ class GitHub(GitSpindle):
                 while True:
                     url = self.gh._build_url('login/oauth/access_token').replace('api.github.com','github.com')
                     time.sleep(data['interval'])
-                    resp = requests.post(url, data={'client_id': self.client_id, 'device_code': data['device_code'], 'grant_type': 'urn:ietf:params:oauth:grant-type:device_code'}, headers={'Accept': 'application/json'})
+                    resp = self.gh.session.post(url, data={'client_id': self.client_id, 'device_code': data['device_code'], 'grant_type': 'urn:ietf:params:oauth:grant-type:device_code'}, headers={'Accept': 'application/json'})
                     if resp.status_code != 200:
                         err("Authentication failed, http code %s" % resp.status_code)
                     data2 = resp.json()
@@ -105,8 +86,9 @@ class GitHub(GitSpindle):
         if not user or not token:
             err("No user or token specified")
         self.gh.login(username=user, token=token)
+        self.gh.session.hooks['response'].append(self.unauthorized)
         try:
-            self.me = self.gh.me()
+            self.me = self.cached_identity(token, self.gh.me)
             self.my_login = self.me.login
         except github3.GitHubError:
             raise
@@ -131,11 +113,44 @@ class GitHub(GitSpindle):
 
         return repo_
 
+    def list_repos(self, owner):
+        if owner == self.my_login:
+            repos = self.gh.repositories(type='owner')
+        else:
+            repos = self.gh.repositories_by(owner, type='owner')
+        return [repo.full_name for repo in repos]
+
     def parent_repo(self, repo):
         if repo.fork:
             # In search results or lists parent info is not returned with a repository
             return getattr(repo, 'parent', None) or self.gh.repository(repo.owner.login, repo.name).parent
 
+    def repo_cache_entry(self, repo):
+        if isinstance(repo, github3.gists.Gist):
+            return None
+        data = dict(repo.as_dict())
+        parent = getattr(repo, 'parent', None)
+        return {'id': repo.id, 'full_name': repo.full_name, 'parent': parent and parent.full_name,
+                'etag': data.pop('ETag', repo.etag), 'last_modified': data.pop('Last-Modified', repo.last_modified),
+                'updated_at': data.get('updated_at'), 'data': data}
+
+    def repo_from_cache(self, entry):
+        data = dict(entry['data'], **{'ETag': entry['etag'], 'Last-Modified': entry['last_modified']})
+        return github3.repos.Repository(data, self.gh)
+
+    def revalidate_repo(self, entry):
+        # Conditional requests that return 304 don't count against the rate limit
+        try:
+            return self.repo_from_cache(entry).refresh(conditional=True)
+        except github3.exceptions.NotFoundError:
+            return None
+
+    def identity_cache_entry(self, me):
+        return me.as_dict()
+
+    def identity_from_cache(self, entry):
+        return github3.users.AuthenticatedUser(entry, self.gh)
+
     def clone_url(self, repo, opts):
         if opts['--ssh'] or repo.private:
             return repo.ssh_url
@@ -240,12 +255,12 @@ class GitHub(GitSpindle):
             if not self.question("Continue?", default=False):
                 sys.exit(1)
         # Fetch PR if needed
-        sha = self.git('rev-parse', '--verify', 'refs/pull/%d/head' % pr.number).stdout.strip()
+        sha = self.objects.sha('refs/pull/%d/head' % pr.number)
         if sha != pr.head.sha:
             print("Fetching pull request")
             url = self.clone_url(self.gh.repository(pr.repository[0].replace('repos/', ''), pr.repository[1]), opts)
             self.gitm('fetch', url, 'refs/pull/%d/head:refs/pull/%d/head' % (pr.number, pr.number), redirect=False)
-        head_sha = self.gitm('rev-parse', 'HEAD').stdout.strip()
+        head_sha = self.objects.sha('HEAD')
         if self.git('merge-base', pr.head.sha, head_sha).stdout.strip() == head_sha:
             print("Fast-forward merging %d commit(s): %s..refs/pull/%d/head" % (pr.commits_count, pr.base.ref, pr.number))
             self.gitm('merge', '--ff-only', 'refs/pull/%d/head' % pr.number, redirect=False)
@@ -302,7 +317,9 @@ class GitHub(GitSpindle):
         rows = [[],[],[],[],[],[],[]]
         commits = []
 
-        data = requests.get('https://github.com/users/%s/contributions' % user).text
+        # Not via self.gh, that would send our token to github.com even for
+        # GitHub Enterprise accounts
+        data = self.session().get('https://github.com/users/%s/contributions' % user).text
         # Sorry, zalgo!
         data = re.findall(r'data-count="(.*?)" data-date="(.*?)"', data)
         y, m, d = [int(x) for x in data[0][1].split('-')]
@@ -395,9 +412,11 @@ class GitHub(GitSpindle):
                 err("Not a regular file: %s" % arg)
             resp = self.gh.session.get(content.download_url, stream=True)
             for chunk in resp.iter_content(4096):
-                os.write(sys.stdout.fileno(), chunk)
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
 
     @command
+    @changes_directory
     def check_pages(self, opts):
         """[<repo>] [--parent]
            Check the github pages configuration and content of your repo"""
@@ -471,8 +490,9 @@ class GitHub(GitSpindle):
         if local:
             ref = 'refs/heads/%s' % branchname
         elif remote_tracking:
-            ref = 'refs/remotes/%s/%s' % (repo.remote, branchname)
-        files = self.git('ls-tree', '-r', '--name-only', ref).stdout.splitlines()
+            ref = 'refs/remotes/%s/%s' % (repo.remote or 'origin', branchname)
+        # Everything we check for is in the top-level directory
+        files = [entry.name for entry in self.objects.tree(ref) or []]
 
         # Do we have an index.html
         if 'index.html' not in files:
@@ -498,13 +518,14 @@ class GitHub(GitSpindle):
                 if file != 'CNAME':
                     error("The CNAME file must be named in all caps",
                           "https://help.github.com/articles/adding-a-cname-file-to-your-repository/")
-                cname = self.git('--no-pager', 'show', '%s:%s' % (ref, file)).stdout.strip()
+                cname = self.objects.blob('%s:%s' % (ref, file)).strip()
                 pages_ips = self.gh.meta()['pages']
                 try:
                     import publicsuffix
                 except ImportError:
                     import gitspindle.public_suffix as publicsuffix
-                expect_cname = publicsuffix.PublicSuffixList(publicsuffix.fetch()).get_public_suffix(cname) != cname
+                suffixes = self.session().get('https://publicsuffix.org/list/public_suffix_list.dat').text.splitlines()
+                expect_cname = publicsuffix.PublicSuffixList(suffixes).get_public_suffix(cname) != cname
                 try:
                     import dns
                     import dns.resolver
@@ -543,6 +564,7 @@ class GitHub(GitSpindle):
                 break
 
     @command
+    @changes_directory
     def clone(self, opts, repo=None):
         """[--ssh|--http|--git] [--triangular [--upstream-branch=<branch>]] [--parent] [git-clone-options] <repo> [<dir>]
            Clone a repository by name"""
@@ -641,6 +663,7 @@ class GitHub(GitSpindle):
                 self.gitm('fetch', url, refspec, redirect=False)
 
     @command
+    @changes_directory
     def fork(self, opts):
         """[--ssh|--http|--git] [--triangular [--upstream-branch=<branch>]] [<repo>]
            Fork a repo and clone it"""
@@ -756,10 +779,9 @@ class GitHub(GitSpindle):
         for issue_no in opts['<issue>']:
             issue = repo.issue(issue_no)
             if issue:
-                pr = issue.pull_request()
                 print(wrap(issue.title.encode(sys.stdout.encoding, errors='backslashreplace').decode(sys.stdout.encoding), attr.bright, attr.underline))
                 print(issue.body.encode(sys.stdout.encoding, errors='backslashreplace').decode(sys.stdout.encoding))
-                print(pr.html_url if pr else issue.html_url)
+                print(issue_url(issue))
             else:
                 print('No issue with id %s found in repository %s' % (issue_no, repo.full_name))
         if not opts['<issue>']:
@@ -797,26 +819,26 @@ be ignored, the first line will be used as title for the issue.""" % (repo.owner
             repos = list(self.gh.repositories(type='all'))
         else:
             repos = [self.repository(opts)]
-        for repo in repos:
+        filters = dict([x.split('=', 1) for x in opts['<filter>']])
+        def fetch(repo):
             repo = (opts['--parent'] and self.parent_repo(repo)) or repo
-            filters = dict([x.split('=', 1) for x in opts['<filter>']])
             try:
-                issues = list(repo.issues(**filters))
+                return repo, list(repo.issues(**filters)), None
             except github3.GitHubError:
                 _, err, _ = sys.exc_info()
                 if err.code == 410:
-                    if len(repos) == 1:
-                        print(err.message)
-                    continue
-                else:
-                    raise
+                    return repo, [], err.message
+                raise
+        def show(_, result):
+            repo, issues, message = result
+            if message and len(repos) == 1:
+                print(message)
             if not issues:
-                continue
+                return
             print(wrap("Issues for %s/%s" % (repo.owner.login, repo.name), attr.bright))
             for issue in issues:
-                pr = issue.pull_request()
-                url = pr.html_url if pr else issue.html_url
-                print("[%d] %s %s" % (issue.number, issue.title.encode(sys.stdout.encoding, errors='backslashreplace').decode(sys.stdout.encoding), url))
+                print("[%d] %s %s" % (issue.number, issue.title.encode(sys.stdout.encoding, errors='backslashreplace').decode(sys.stdout.encoding), issue_url(issue)))
+        self.fan_out(fetch, repos, show)
 
     @command
     def log(self, opts):
@@ -975,32 +997,11 @@ be ignored, the first line will be used as title for the issue.""" % (repo.owner
            Mirror a repository, or all repositories for a user"""
         if opts['<repo>'] and opts['<repo>'].endswith('/*'):
             user = opts['<repo>'].rsplit('/', 2)[-2]
-            for repo in self.gh.repositories(type='all') if user == self.my_login else self.gh.repositories_by(user, type='all'):
-                if repo.owner.login != self.my_login:
-                    continue
-                opts['<repo>'] = '%s/%s' % (user, repo)
-                self.mirror(opts)
-            for repo in self.gh.gists_by(user):
-                opts['<repo>'] = 'gist/%s' % repo.name
-                self.mirror(opts)
+            repos = self.gh.repositories(type='all') if user == self.my_login else self.gh.repositories_by(user, type='all')
+            repos = [repo for repo in repos if repo.owner.login == self.my_login]
+            self.mirror_repos(repos + list(self.gh.gists_by(user)), opts, bulk=True)
             return
-        repo = self.repository(opts)
-        git_dir = repo.name + '.git'
-        cur_dir = os.path.basename(os.path.abspath(os.getcwd()))
-        if cur_dir != git_dir and not os.path.exists(git_dir):
-            url = self.clone_url(repo, opts)
-            self.gitm('clone', '--mirror', url, redirect=False)
-        else:
-            if git_dir == cur_dir:
-                git_dir = '.'
-            # Update the current, mirrored repo
-            if self.git('--git-dir', git_dir, 'config', 'core.bare').stdout.strip() != 'true' or \
-               self.git('--git-dir', git_dir, 'config', 'remote.origin.mirror').stdout.strip() != 'true':
-                   err("This is not a mirrored repository")
-            self.gitm('--git-dir', git_dir, 'fetch', '-q', '--prune', 'origin', redirect=False)
-
-        with open(os.path.join(git_dir, 'description'), 'w') as fd:
-            fd.write(repo.description or "")
+        self.mirror_repos([self.repository(opts)], opts)
 
     @command
     def network(self, opts):
@@ -1022,39 +1023,46 @@ be ignored, the first line will be used as title for the issue.""" % (repo.owner
                 level = int(opts['<level>'])
             except ValueError:
                 err("Integer argument required")
+        def fetch(person):
+            # Everyone at this level is looked at at the same time, the people
+            # we find are added in order afterwards
+            repos = [(repo, self.parent_repo(repo) if repo.fork else list(repo.forks()))
+                     for repo in self.gh.repositories_by(person.user.login, type='owner')]
+            return list(person.user.followers()), list(person.user.following()), repos
+
+        def show(person, result):
+            login = person.user.login
+            followers, following, repos = result
+            sys.stderr.write("Looking at user %s\n" % login)
+            # Followers
+            for other in followers:
+                if other.login not in people:
+                    people[other.login] = P(other)
+                people[other.login].rel_to[login].append('follows')
+            for other in following:
+                if other.login not in people:
+                    people[other.login] = P(other)
+                person.rel_to[other.login].append('follows')
+
+            # Forks
+            for repo, related in repos:
+                sys.stderr.write("Looking at repo %s\n" % repo.name)
+                if repo.fork:
+                    if repo.owner.login not in people:
+                        people[repo.owner.login] = P(repo.owner)
+                    person.rel_to[related.owner.login].append('forked %s' % related.name)
+                else:
+                    for fork in related:
+                        if fork.owner.login == login:
+                            continue
+                        if fork.owner.login not in people:
+                            people[fork.owner.login] = P(fork.owner)
+                        people[fork.owner.login].rel_to[login].append('forked %s' % repo.name)
+            person.done = True
+
         people = {self.my_login: P(self.me)}
         for i in range(level):
-            for login, person in list(people.items()):
-                if person.done:
-                    continue
-
-                sys.stderr.write("Looking at user %s\n" % login)
-                # Followers
-                for other in person.user.followers():
-                    if other.login not in people:
-                        people[other.login] = P(other)
-                    people[other.login].rel_to[login].append('follows')
-                for other in person.user.following():
-                    if other.login not in people:
-                        people[other.login] = P(other)
-                    person.rel_to[other.login].append('follows')
-
-                # Forks
-                for repo in self.gh.repositories_by(login, type='owner'):
-                    sys.stderr.write("Looking at repo %s\n" % repo.name)
-                    if repo.fork:
-                        if repo.owner.login not in people:
-                            people[repo.owner.login] = P(repo.owner)
-                        parent = self.parent_repo(repo)
-                        person.rel_to[parent.owner.login].append('forked %s' % parent.name)
-                    else:
-                        for fork in repo.forks():
-                            if fork.owner.login == login:
-                                continue
-                            if fork.owner.login not in people:
-                                people[fork.owner.login] = P(fork.owner)
-                            people[fork.owner.login].rel_to[login].append('forked %s' % repo.name)
-                person.done = True
+            self.fan_out(fetch, [person for person in people.values() if not person.done], show)
 
         # Now we create a graph
         graph = ["digraph network {"]
@@ -1126,7 +1134,9 @@ be ignored, the first line will be used as title for the issue.""" % (repo.owner
             err("Cannot file a pull request on the same branch")
 
         # Try to get the local commit
-        commit = self.gitm('show-ref', 'refs/heads/%s' % src).stdout.split()[0]
+        commit = self.objects.sha('refs/heads/%s' % src)
+        if not commit:
+            err("Branch %s does not exist" % src)
         # Do they exist on github?
         try:
             srcb = repo.branch(src)
@@ -1156,8 +1166,7 @@ be ignored, the first line will be used as title for the issue.""" % (repo.owner
             err("Branch %s does not exist in %s/%s" % (dst, parent.owner.login, parent.name))
 
         # Do we have the dst locally?
-        for remote in self.gitm('remote').stdout.strip().split("\n"):
-            url = self.gitm('config', 'remote.%s.url' % remote).stdout.strip()
+        for remote, url in sorted(self.remotes().items()):
             if url in [parent.git_url, parent.ssh_url, parent.clone_url]:
                 if parent.private and url != parent.ssh_url:
                     err("You should configure %s/%s to fetch via ssh, it is a private repo" % (parent.owner.login, parent.name))
@@ -1180,9 +1189,9 @@ be ignored, the first line will be used as title for the issue.""" % (repo.owner
 
         # 1 commit: title/body from commit
         if len(commits) == 1:
-            title, body = self.gitm('log', '--pretty=%s\n%b', '%s^..%s' % (commits[0], commits[0])).stdout.split('\n', 1)
-            title = title.strip()
-            body = body.strip()
+            first = self.objects.commit(commits[0])
+            title = first.subject.strip()
+            body = first.body.strip()
             accept_empty_body = not bool(body)
 
         # More commits: title from branchname (titlecased, s/-/ /g), body comments from shortlog
@@ -1224,7 +1233,7 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.ow
         repo = self.repository(opts)
         readme = repo.readme()
         if readme:
-            os.write(sys.stdout.fileno(), readme.decoded)
+            sys.stdout.buffer.write(readme.decoded)
         else:
             err("No readme found")
 
@@ -1238,16 +1247,15 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.ow
             tag = tag[10:]
         name = opts['<releasename>'] or tag
         ref = 'refs/tags/' + tag
-        ret = self.git('rev-parse', '--quiet', '--verify', ref + '^0')
-        if not ret:
+        sha = self.objects.sha(ref + '^0')
+        if not sha:
             err("Tag %s does not exist yet" % tag)
-        sha = ret.stdout.strip()
         if not self.git('ls-remote', repo.remote, ref).stdout.strip():
             if self.question("Tag %s does not exist in your GitHub repo, shall I push?" % tag):
                 self.gitm('push', repo.remote, '%s:%s' % (ref, ref), redirect=False)
         body = ''
-        if self.git('cat-file', '-t', ref).stdout.strip() == 'tag':
-            body = self.git('--no-pager', 'log', '-1', '--format=%B', ref).stdout
+        if self.objects.type(ref) == 'tag':
+            body = self.objects.commit(ref).message
         extra = """Creating release %s based on tag %s
 Please enter a text to accompany your release. Lines starting with '#'
 will be ignored""" % (name, tag)
@@ -1393,7 +1401,7 @@ will be ignored""" % (name, tag)
                     repo = my_repo
 
         url = self.clone_url(repo, opts)
-        if self.git('config', 'remote.%s.url' % remote).stdout.strip() != url:
+        if self.context.get('remote.%s.url' % remote) != url:
             print("Pointing %s to %s" % (remote, url))
             self.gitm('config', 'remote.%s.url' % remote, url)
         self.gitm('config', '--replace-all', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
@@ -1401,7 +1409,7 @@ will be ignored""" % (name, tag)
         if repo.fork:
             parent = self.parent_repo(repo)
             url = self.clone_url(parent, opts)
-            if self.git('config', 'remote.upstream.url').stdout.strip() != url:
+            if self.context.get('remote.upstream.url') != url:
                 print("Pointing upstream to %s" % url)
                 self.gitm('config', 'remote.upstream.url', url)
             self.gitm('config', 'remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
@@ -1463,15 +1471,21 @@ will be ignored""" % (name, tag)
     def whois(self, opts):
         """<user>...
            Display GitHub user info"""
-        for user_ in opts['<user>']:
-            user = self.gh.user(user_)
+        def fetch(login):
+            user = self.gh.user(login)
             if not user:
-                print("No such user: %s" % user_)
-                continue
-            emails = {}
-            if user.login == self.my_login:
-                for email in self.gh.emails():
-                    emails[email.email] = email
+                return None
+            mine = user.login == self.my_login
+            emails = dict((email.email, email) for email in self.gh.emails()) if mine else {}
+            keys = list(self.gh.keys() if mine else user.keys())
+            orgs = list(self.gh.organizations() if mine else user.organizations())
+            members = list(self.gh.organization(user.login).members()) if user.type == 'Organization' else []
+            return user, emails, keys, orgs, members
+        def show(login, result):
+            if not result:
+                print("No such user: %s" % login)
+                return
+            user, emails, keys, orgs, members = result
             print(wrap(user.name or user.login, attr.bright, attr.underline))
             print('Profile   %s' % user.html_url)
             if user.email:
@@ -1494,10 +1508,6 @@ will be ignored""" % (name, tag)
                 print('Company   %s' % user.company)
             print('Repos     %d' % user.public_repos_count)
             print('Gists     %d' % user.public_gists_count)
-            if user.login == self.my_login:
-                keys = self.gh.keys()
-            else:
-                keys = user.keys()
             for pkey in keys:
                 algo, key = pkey.key.split()[:2]
                 algo = algo[4:].upper()
@@ -1505,16 +1515,13 @@ will be ignored""" % (name, tag)
                     print("%s key%s...%s (%s)" % (algo, ' ' * (6 - len(algo)), key[-10:], pkey.title))
                 else:
                     print("%s key%s...%s" % (algo, ' ' * (6 - len(algo)), key[-10:]))
-            if user.login == self.my_login:
-                orgs = self.gh.organizations()
-            else:
-                orgs = list(user.organizations())
             if orgs:
                 print("Member of %s" % ', '.join([x.login for x in orgs]))
             if user.type == 'Organization':
                 print('Members:')
-                for member in self.gh.organization(user.login).members():
+                for member in members:
                     print(" - %s" % member.login)
+        self.fan_out(fetch, opts['<user>'], show)
 
     def graphql_method(self, name, query):
         def method(**args):
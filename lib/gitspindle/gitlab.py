@@ -1,17 +1,16 @@
 from __future__ import absolute_import
 from gitspindle import *
 from gitspindle.ansi import *
-import gitlab
+from gitspindle.lazy import lazy_import
 import base64
 import datetime
 import getpass
 import glob
 import json
 import os
-import requests
 import sys
-import time
-import webbrowser
+gitlab = lazy_import('gitlab')
+webbrowser = lazy_import('webbrowser')
 
 class GitLab(GitSpindle):
     prog = 'git lab'
@@ -33,11 +32,7 @@ class GitLab(GitSpindle):
         self.gl = None
         host = self.config('host') or 'https://gitlab.com'
         if not host.startswith(('http://', 'https://')):
-            try:
-                requests.get('https://' + host)
-            except:
-                err("%s is not reachable via https. Use http://%s to use the insecure http protocol" % (host, host))
-            host = 'https://' + host
+            host = self.https_host(host)
         self.host = host
 
         user = self.config('user')
@@ -50,6 +45,7 @@ class GitLab(GitSpindle):
             print("Generate a personal access token at %s/-/profile/personal_access_tokens and enter it below" % host)
             token = getpass.getpass("GitLab personal access token: ")
             self.gl = gitlab.Gitlab(host, private_token=token)
+            self.configure_session(self.gl.session)
             self.gl.auth()
             self.config('token', token)
             location = '%s - do not share this file' % self.config_file
@@ -62,21 +58,30 @@ class GitLab(GitSpindle):
 
         if not self.gl:
             self.gl = gitlab.Gitlab(host, private_token=token)
-            try:
+            self.configure_session(self.gl.session)
+            def fetch():
                 self.gl.auth()
+                return self.gl.user
+            try:
+                self.gl.user = self.cached_identity(token, fetch)
             except gitlab.GitlabAuthenticationError:
                 # Token obsolete
                 self.config('token', None)
                 self.login()
+                return
+        self.gl.session.hooks['response'].append(self.unauthorized)
         self.me = self.gl.user
         self.my_login = self.me.username
 
+    def mirror_dir(self, repo):
+        return repo.path + '.git'
+
     def parse_url(self, url):
         return ([self.my_login] + url.path.rsplit('/',1))[-2:]
 
     def get_repo(self, remote, user, repo):
         if remote:
-            id = self.git('config', 'remote.%s.gitlab-id' % remote).stdout.strip()
+            id = self.context.get('remote.%s.gitlab-id' % remote)
             if id and id.isdigit():
                 return self.gl.projects.get(id)
 
@@ -88,6 +93,16 @@ class GitLab(GitSpindle):
             self.gitm('config', 'remote.%s.gitlab-id' % remote, repo_.id)
         return repo_
 
+    def list_repos(self, owner):
+        try:
+            repos = self.gl.groups.get(owner).projects.list(all=True, include_subgroups=True)
+        except gitlab.exceptions.GitlabGetError:
+            users = self.gl.users.list(username=owner)
+            if not users:
+                err("No user or group named %s found" % owner)
+            repos = users[0].projects.list(all=True)
+        return [repo.path_with_namespace for repo in repos]
+
     def clone_url(self, repo, opts):
         if opts['--ssh'] or not repo.visibility == 'public':
             return repo.ssh_url_to_repo
@@ -98,8 +113,31 @@ class GitLab(GitSpindle):
         return repo.http_url_to_repo
 
     def parent_repo(self, repo):
-       if getattr(repo, 'forked_from_project', False):
-           return self.gl.projects.get(repo.forked_from_project['id'])
+       parent = getattr(repo, 'forked_from_project', None)
+       if parent:
+           return self.cached_repo(parent['path_with_namespace'], lambda: self.gl.projects.get(parent['id']))
+
+    def repo_cache_entry(self, repo):
+        parent = getattr(repo, 'forked_from_project', None)
+        return {'id': repo.id, 'full_name': repo.path_with_namespace, 'parent': parent and parent['path_with_namespace'],
+                'etag': None, 'updated_at': repo.attributes.get('last_activity_at'), 'data': repo.attributes}
+
+    def repo_from_cache(self, entry):
+        return gitlab.v4.objects.Project(self.gl.projects, entry['data'])
+
+    def revalidate_repo(self, entry):
+        # GitLab doesn't support conditional requests for projects, but
+        # fetching by id is cheaper than a lookup by path
+        try:
+            return self.gl.projects.get(entry['id'])
+        except gitlab.exceptions.GitlabGetError:
+            return None
+
+    def identity_cache_entry(self, me):
+        return me.attributes
+
+    def identity_from_cache(self, entry):
+        return gitlab.v4.objects.CurrentUser(gitlab.v4.objects.CurrentUserManager(self.gl), entry)
 
     # There's no way to fetch a group by name. Abuse search.
     def find_group(self, name):
@@ -198,12 +236,12 @@ class GitLab(GitSpindle):
             if not self.question("Continue?", default=False):
                 sys.exit(1)
         # Fetch mr if needed
-        sha = self.git('rev-parse', '--verify', 'refs/merge/%d/head' % mr.iid).stdout.strip()
+        sha = self.objects.sha('refs/merge/%d/head' % mr.iid)
         if not sha:
             print("Fetching merge request")
             url = self.clone_url(self.gl.projects.get(mr.source_project_id), opts)
             self.gitm('fetch', url, 'refs/heads/%s:refs/merge/%d/head' % (mr.source_branch, mr.iid), redirect=False)
-        head_sha = self.gitm('rev-parse', 'HEAD').stdout.strip()
+        head_sha = self.objects.sha('HEAD')
         if self.git('merge-base', 'refs/merge/%d/head' % mr.iid, head_sha).stdout.strip() == head_sha:
             print("Fast-forward merging %s..refs/merge/%d/head" % (mr.target_branch, mr.iid))
             self.gitm('merge', '--ff-only', 'refs/merge/%d/head' % mr.iid, redirect=False)
@@ -238,7 +276,7 @@ class GitLab(GitSpindle):
         commits = []
         url = self.gl._url
         url = '%s/%s/%s/calendar' % (url[:url.find('/api')], 'users', user.username)
-        data = requests.get(url).json()
+        data = self.session().get(url).json()
 
 
         first = datetime.datetime.today() - datetime.timedelta(365)
@@ -329,11 +367,12 @@ class GitLab(GitSpindle):
 
             try:
                 file = repo.files.get(ref=ref or repo.default_branch, file_path=file)
-                os.write(sys.stdout.fileno(), base64.b64decode(file.content))
+                sys.stdout.buffer.write(base64.b64decode(file.content))
             except gitlab.GitlabGetError:
                 sys.stderr.write("No such file: %s\n" % file)
 
     @command
+    @changes_directory
     def clone(self, opts, repo=None):
         """[--ssh|--http] [--triangular [--upstream-branch=<branch>]] [--parent] [git-clone-options] <repo> [<dir>]
            Clone a repository by name"""
@@ -373,22 +412,10 @@ class GitLab(GitSpindle):
             if not group:
                 err("Group %s could not be found" % opts['--group'])
             kwargs['namespace_id'] = group.id
-        i = 0
-        while True:
-            try:
-                repo = self.gl.projects.create(kwargs)
-                repo.save()
-                break
-            except gitlab.exceptions.GitlabCreateError as gce:
-                i += 1
-                time.sleep(1)
-                if (gce.response_code != 400) \
-                        or (not isinstance(gce.error_message, dict)) \
-                        or (not 'base' in gce.error_message) \
-                        or (not isinstance(gce.error_message['base'], list)) \
-                        or (not 'The project is still being deleted. Please try again later.' in gce.error_message['base']) \
-                        or (i >= 120):
-                    raise
+        # Creating a project named like one that's still being deleted is
+        # retried by gitspindle.retry
+        repo = self.gl.projects.create(kwargs)
+        repo.save()
         if 'origin' in self.remotes():
             print("Remote 'origin' already exists, adding the GitLab repository as 'gitlab'")
             self.set_origin(opts, repo=repo, remote='gitlab')
@@ -415,6 +442,7 @@ class GitLab(GitSpindle):
         self.gitm('fetch', url, refspec, redirect=False)
 
     @command
+    @changes_directory
     def fork(self, opts):
         """[--ssh|--http] [--triangular [--upstream-branch=<branch>]] [<repo>]
            Fork a repo and clone it"""
@@ -429,22 +457,7 @@ class GitLab(GitSpindle):
         except gitlab.exceptions.GitlabGetError:
             pass
 
-        i = 0
-        success = False
-        while not success:
-            try:
-                my_fork = repo.forks.create({})
-                success = True
-            except gitlab.GitlabForkError as gfe:
-                i += 1
-                time.sleep(1)
-                if (gfe.response_code != 409) \
-                        or (not isinstance(gfe.error_message, dict)) \
-                        or (not 'base' in gfe.error_message) \
-                        or (not isinstance(gfe.error_message['base'], list)) \
-                        or (not 'The project is still being deleted. Please try again later.' in gfe.error_message['base']) \
-                        or (i >= 120):
-                    raise
+        my_fork = repo.forks.create({})
 
         self.wait_for_repo(my_fork.owner['username'], my_fork.name, opts)
 
@@ -499,14 +512,13 @@ be ignored, the first line will be used as title for the issue.""" % (repo.names
             repos = list(self.gl.projects.list())
         else:
             repos = [self.repository(opts)]
-        for repo in repos:
+        filters = dict([x.split('=', 1) for x in opts['<filter>']])
+        def fetch(repo):
             if opts['--parent']:
                 repo = self.parent_repo(repo) or repo
-            filters = dict([x.split('=', 1) for x in opts['<filter>']])
-            issues = repo.issues.list(**filters)
-            mergerequests = repo.mergerequests.list(state='opened')
-            if not issues and not mergerequests:
-                continue
+            return repo, repo.issues.list(**filters), repo.mergerequests.list(state='opened')
+        def show(_, result):
+            repo, issues, mergerequests = result
             if issues:
                 print(wrap("Issues for %s/%s" % (repo.namespace['full_path'], repo.path), attr.bright))
                 for issue in issues:
@@ -515,6 +527,7 @@ be ignored, the first line will be used as title for the issue.""" % (repo.names
                 print(wrap("Merge requests for %s/%s" % (repo.namespace['full_path'], repo.path), attr.bright))
                 for mr in mergerequests:
                     print("[%d] %s %s" % (mr.iid, mr.title.encode(sys.stdout.encoding, errors='backslashreplace').decode(sys.stdout.encoding), mr.web_url))
+        self.fan_out(fetch, repos, show)
 
     @command
     def log(self, opts):
@@ -536,11 +549,9 @@ be ignored, the first line will be used as title for the issue.""" % (repo.names
             if event.action_name in ('joined', 'left'):
                 print('%s %s %s' % (ts, event.author_username, event.action_name))
             elif event.target_type == 'Issue':
-                issue = repo.issues.get(event.target_iid)
-                print('%s %s %s issue %s (%s)' % (ts, event.author_username, event.action_name, issue.iid, issue.title))
+                print('%s %s %s issue %s (%s)' % (ts, event.author_username, event.action_name, event.target_iid, event.target_title))
             elif event.target_type == 'MergeRequest':
-                issue = repo.mergerequests.get(event.target_iid)
-                print('%s %s %s merge request %s (%s)' % (ts, event.author_username, event.action_name, issue.iid, issue.title))
+                print('%s %s %s merge request %s (%s)' % (ts, event.author_username, event.action_name, event.target_iid, event.target_title))
             elif event.target_type in ('Note', 'DiscussionNote'):
                 print('%s %s created a comment' % (ts, event.author_username))
             elif event.action_name == 'pushed to':
@@ -617,7 +628,9 @@ be ignored, the first line will be used as title for the issue.""" % (repo.names
             err("Cannot file a merge request on the same branch")
 
         # Try to get the local commit
-        commit = self.gitm('show-ref', 'refs/heads/%s' % src).stdout.split()[0]
+        commit = self.objects.sha('refs/heads/%s' % src)
+        if not commit:
+            err("Branch %s does not exist" % src)
         # Do they exist on GitLab?
         try:
             srcb = repo.branches.get(src)
@@ -646,8 +659,7 @@ be ignored, the first line will be used as title for the issue.""" % (repo.names
             err("Branch %s does not exist in %s/%s" % (dst, parent.namespace['full_path'], parent.path))
 
         # Do we have the dst locally?
-        for remote in self.gitm('remote').stdout.strip().split("\n"):
-            url = self.gitm('config', 'remote.%s.url' % remote).stdout.strip()
+        for remote, url in sorted(self.remotes().items()):
             if url in [parent.ssh_url_to_repo, parent.http_url_to_repo]:
                 if not parent.visibility == 'public' and url != parent.ssh_url_to_repo:
                     err("You should configure %s/%s to fetch via ssh, it is a private repo" % (parent.namespace['full_path'], parent.path))
@@ -665,9 +677,9 @@ be ignored, the first line will be used as title for the issue.""" % (repo.names
 
         # 1 commit: title/body from commit
         if len(commits) == 1:
-            title, body = self.gitm('log', '--pretty=%s\n%b', '%s^..%s' % (commits[0], commits[0])).stdout.split('\n', 1)
-            title = title.strip()
-            body = body.strip()
+            first = self.objects.commit(commits[0])
+            title = first.subject.strip()
+            body = first.body.strip()
             accept_empty_body = not bool(body)
 
         # More commits: title from branchname (titlecased, s/-/ /g), body comments from shortlog
@@ -701,27 +713,9 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.na
         """[--ssh|--http] [<repo>]
            Mirror a repository, or all your repositories"""
         if opts['<repo>'] and opts['<repo>'] == '*':
-            for repo in self.gl.Project():
-                opts['<repo>'] = '%s/%s' % (repo.namespace['full_path'], name)
-                self.mirror(opts)
+            self.mirror_repos(self.gl.projects.list(owned=True, all=True), opts, bulk=True)
             return
-        repo = self.repository(opts)
-        git_dir = repo.path + '.git'
-        cur_dir = os.path.basename(os.path.abspath(os.getcwd()))
-        if cur_dir != git_dir and not os.path.exists(git_dir):
-            url = self.clone_url(repo, opts)
-            self.gitm('clone', '--mirror', url, git_dir, redirect=False)
-        else:
-            if git_dir == cur_dir:
-                git_dir = '.'
-            # Update the current, mirrored repo
-            if self.git('--git-dir', git_dir, 'config', 'core.bare').stdout.strip() != 'true' or \
-               self.git('--git-dir', git_dir, 'config', 'remote.origin.mirror').stdout.strip() != 'true':
-                   err("This is not a mirrored repository")
-            self.gitm('--git-dir', git_dir, 'fetch', '-q', '--prune', 'origin', redirect=False)
-
-        with open(os.path.join(git_dir, 'description'), 'w') as fd:
-            fd.write(repo.description or "")
+        self.mirror_repos([self.repository(opts)], opts)
 
     @command
     def protect(self, opts):
@@ -807,7 +801,7 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.na
                     repo = my_repo
 
         url = self.clone_url(repo, opts)
-        if self.git('config', 'remote.%s.url' % remote).stdout.strip() != url:
+        if self.context.get('remote.%s.url' % remote) != url:
             print("Pointing %s to %s" % (remote, url))
             self.gitm('config', 'remote.%s.url' % remote, url)
             self.gitm('config', 'remote.%s.gitlab-id' % remote, repo.id)
@@ -816,7 +810,7 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.na
         parent = self.parent_repo(repo)
         if parent:
             url = self.clone_url(parent, opts)
-            if self.git('config', 'remote.upstream.url').stdout.strip() != url:
+            if self.context.get('remote.upstream.url') != url:
                 print("Pointing upstream to %s" % url)
                 self.gitm('config', 'remote.upstream.url', url)
                 self.gitm('config', 'remote.upstream.gitlab-id', parent.id)
@@ -852,13 +846,23 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.na
     def whois(self, opts):
         """<user>...
            Display GitLab user info"""
-        for user in opts['<user>']:
+        def fetch(user):
             if not isinstance(user, (gitlab.v4.objects.User, gitlab.v4.objects.CurrentUser)):
                 user_ = self.gl.users.list(username=user)
                 if not user_:
-                    print("No such user: %s" % user)
-                    continue
+                    return None
                 user = user_[0]
+            try:
+                keys = user.keys.list()
+            except gitlab.GitlabListError:
+                # Permission denied, ignore
+                keys = []
+            return user, keys
+        def show(user, result):
+            if not result:
+                print("No such user: %s" % user)
+                return
+            user, keys = result
             print(wrap("%s (id %d)" % (user.name or user.username, user.id), attr.bright, attr.underline))
             print('Profile   %s' % user.web_url)
             if hasattr(user, 'email'):
@@ -876,15 +880,11 @@ with '#' will be ignored, and an empty message aborts the request.""" % (repo.na
                     else:
                         bio = user.bio
                     print('Bio       %s' % user.bio)
-            try:
-                for pkey in user.keys.list():
-                    algo, key = pkey.key.split()[:2]
-                    algo = algo[4:].upper()
-                    if pkey.title:
-                        print("%s key%s...%s (%s)" % (algo, ' ' * (6 - len(algo)), key[-10:], pkey.title))
-                    else:
-                        print("%s key%s...%s" % (algo, ' ' * (6 - len(algo)), key[-10:]))
-
-            except gitlab.GitlabListError:
-                # Permission denied, ignore
-                pass
+            for pkey in keys:
+                algo, key = pkey.key.split()[:2]
+                algo = algo[4:].upper()
+                if pkey.title:
+                    print("%s key%s...%s (%s)" % (algo, ' ' * (6 - len(algo)), key[-10:], pkey.title))
+                else:
+                    print("%s key%s...%s" % (algo, ' ' * (6 - len(algo)), key[-10:]))
+        self.fan_out(fetch, opts['<user>'], show)
@@ -0,0 +1,164 @@
+# A shared on-disk cache for API responses. Most of what we fetch (repos, forks,
+# users, templates) rarely changes between invocations, so instead of
+# downloading it again we send the ETag or Last-Modified date we saw last time
+# and use the stored response when the server says 304 Not Modified. Besides
+# being faster, conditional requests that GitHub answers with a 304 don't count
+# against the rate limit.
+#
+# The cache is an SQLite database in the cache directory, shared by all
+# services and accounts, and limited in size by evicting the least recently
+# used responses. Like the other caches, it's best-effort: if the database
+# can't be used, requests go to the server as usual.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+
+import gitspindle.cache
+
+__all__ = ['CachingAdapter']
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    status INTEGER,
+    reason TEXT,
+    headers TEXT,
+    body BLOB,
+    size INTEGER,
+    used REAL
+)'''
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since')
+# Not meaningful for a body we stored decoded
+SKIP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive')
+
+class HTTPCache(object):
+    def __init__(self, max_size):
+        self.path = os.path.join(gitspindle.cache.cache_dir(), 'http-cache.sqlite')
+        self.max_size = max_size
+        self.local = threading.local()
+
+    def connect(self):
+        # SQLite connections can't be shared with the processes the daemon
+        # forks, or between threads
+        local = self.local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            umask = os.umask(0o077)
+            try:
+                db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            finally:
+                os.umask(umask)
+            # Only keep connections that are ready for use, so a locked
+            # database is tried again next time
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute(SCHEMA)
+            except sqlite3.Error:
+                db.close()
+                raise
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    def get(self, key):
+        row = self.connect().execute('SELECT etag, last_modified, status, reason, headers, body FROM responses WHERE key=?', (key,)).fetchone()
+        if row:
+            return {'etag': row[0], 'last_modified': row[1], 'status': row[2], 'reason': row[3], 'headers': json.loads(row[4]), 'body': row[5]}
+
+    def touch(self, key):
+        self.connect().execute('UPDATE responses SET used=? WHERE key=?', (time.time(), key))
+
+    def store(self, key, response):
+        headers = dict((k, v) for (k, v) in response.headers.items() if k.lower() not in SKIP_HEADERS)
+        body = response.content
+        size = len(body) + len(key) + sum(len(k) + len(v) for (k, v) in headers.items())
+        if size > self.max_size / 10:
+            return
+        db = self.connect()
+        db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (key, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.status_code,
+                    response.reason, json.dumps(headers), body, size, time.time()))
+        self.evict()
+
+    def evict(self):
+        db = self.connect()
+        total = db.execute('SELECT SUM(size) FROM responses').fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        # Make some room, so we don't need to do this on every store
+        excess = total - 0.9 * self.max_size
+        for key, size in db.execute('SELECT key, size FROM responses ORDER BY used').fetchall():
+            if excess <= 0:
+                break
+            db.execute('DELETE FROM responses WHERE key=?', (key,))
+            excess -= size
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """A transport adapter that revalidates GET requests against the cache.
+       Mount it on a session for both http:// and https://."""
+    def __init__(self, max_size, *args, **kwargs):
+        super(CachingAdapter, self).__init__(*args, **kwargs)
+        self.cache = HTTPCache(max_size)
+
+    def cache_key(self, request):
+        # Different credentials or media types get different responses
+        headers = sorted((k.lower(), v) for (k, v) in request.headers.items() if k.lower() not in CONDITIONAL_HEADERS)
+        return gitspindle.cache.digest(json.dumps([request.method, request.url, headers]))
+
+    def send(self, request, **kwargs):
+        # Streamed downloads can be big and callers that do their own
+        # revalidation want to see the 304
+        if request.method != 'GET' or kwargs.get('stream') or any(h.lower() in CONDITIONAL_HEADERS for h in request.headers):
+            return super(CachingAdapter, self).send(request, **kwargs)
+        key = self.cache_key(request)
+        try:
+            entry = self.cache.get(key)
+        except (sqlite3.Error, OSError, ValueError):
+            return super(CachingAdapter, self).send(request, **kwargs)
+        if entry:
+            # Leave the caller's request alone, it may be sent again
+            request = request.copy()
+            if entry['etag']:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+        response = super(CachingAdapter, self).send(request, **kwargs)
+        try:
+            if entry and response.status_code == 304:
+                self.cache.touch(key)
+                return self.cached_response(request, response, entry)
+            if response.status_code == 200 and (response.headers.get('ETag') or response.headers.get('Last-Modified')) \
+               and 'no-store' not in response.headers.get('Cache-Control', ''):
+                self.cache.store(key, response)
+        except (sqlite3.Error, OSError):
+            pass
+        return response
+
+    def cached_response(self, request, not_modified, entry):
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        # The 304 has the current rate limit, date and such
+        for header, value in not_modified.headers.items():
+            if header.lower() not in SKIP_HEADERS:
+                response.headers[header] = value
+        response._content = entry['body']
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        response.cookies = not_modified.cookies
+        response.from_cache = True
+        not_modified.close()
+        return response
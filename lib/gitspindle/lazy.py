@@ -0,0 +1,81 @@
+# Lazy imports for the heavy API libraries. Most invocations of git-spindle
+# (--help, config, add-account, shell completion) never talk to an API, so
+# they shouldn't pay for importing github3, gitlab or requests.
+#
+# Set GIT_SPINDLE_IMPORT_PROFILE=1 to see what got imported, when and why.
+
+import atexit
+import importlib
+import os
+import sys
+import time
+import types
+
+__all__ = ['lazy_import']
+
+started = time.perf_counter()
+profile = []
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute access"""
+    def __init__(self, name, hook=None):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_hook'] = hook
+        self.__dict__['_lazy_module'] = None
+
+    def __getattr__(self, attr):
+        module = self._lazy_module
+        if module is None:
+            module = self._lazy_load(attr)
+        return getattr(module, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_module or self._lazy_load(attr), attr, value)
+        self.__dict__[attr] = value
+
+    def __dir__(self):
+        return dir(self._lazy_module or self._lazy_load('__dir__'))
+
+    def __repr__(self):
+        if self._lazy_module is None:
+            return "<lazy module '%s'>" % self.__name__
+        return repr(self._lazy_module)
+
+    def _lazy_load(self, attr):
+        start = time.perf_counter()
+        module = importlib.import_module(self.__name__)
+        if self._lazy_hook:
+            self._lazy_hook(module)
+        # Copy what's there now so later lookups don't go through __getattr__
+        self.__dict__.update(module.__dict__)
+        self.__dict__['_lazy_module'] = module
+        if profile_enabled():
+            profile.append((self.__name__, time.perf_counter() - start, attr))
+        return module
+
+def lazy_import(name, hook=None):
+    """Return a proxy for the named module, the hook is called with the real
+       module right after it has been imported"""
+    if name in sys.modules and not hook:
+        return sys.modules[name]
+    return LazyModule(name, hook)
+
+def profile_enabled():
+    return os.environ.get('GIT_SPINDLE_IMPORT_PROFILE', '') not in ('', '0')
+
+def mark(what):
+    """Record how long it took to get to a certain point"""
+    if profile_enabled():
+        profile.append((what, time.perf_counter() - started, None))
+
+def report():
+    sys.stderr.write("Import profile:\n")
+    for (what, duration, attr) in profile:
+        if attr is None:
+            sys.stderr.write("  %8.1fms  %s\n" % (duration * 1000, what))
+        else:
+            sys.stderr.write("  %8.1fms  lazy import of %s (needed for %s.%s)\n" % (duration * 1000, what, what, attr))
+    sys.stderr.write("  %8.1fms  total\n" % ((time.perf_counter() - started) * 1000))
+
+if profile_enabled():
+    atexit.register(report)
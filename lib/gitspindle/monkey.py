@@ -1,16 +1,5 @@
-# Set the spindle attribute
-import github3.gists
-
-# Monkeypatch github3.gists.Gist to behave more like a repo
-github3.gists.gist._Gist.ssh_url = property(lambda self: 'git@gist.github.com:/%s.git' % self.id)
-github3.gists.gist._Gist.clone_url = property(lambda self: self.git_pull_url)
-github3.gists.gist._Gist.git_url = property(lambda self: 'git://gist.github.com/%s.git' % self.id)
-github3.gists.gist._Gist.name = property(lambda self: self.id)
-github3.gists.gist._Gist.private = property(lambda self: not self.public)
-github3.gists.gist._Gist.create_fork = github3.gists.Gist.fork
-# XXX - There is nothing in the API output that indicates forkedness
-github3.gists.gist._Gist.fork = False
-github3.gists.gist._Gist.issues = lambda self, *args, **kwargs: []
+# Monkeypatch github3.gists.Gist to behave more like a repo. This is applied
+# when github3 is first used, see gitspindle.lazy
 def _gist_events(self, number=300):
     for event in self.history[:number]:
         yield GistEvent(event, self)
@@ -24,7 +13,6 @@ class GistEvent(object):
         if not self.actor.login:
             self.actor = gist.owner
         self.repo = ('gist', gist.name)
-github3.gists.Gist.events = _gist_events
 class Content(object):
     def __init__(self, file):
         self.decoded = file.content()
@@ -33,12 +21,26 @@ def _gist_contents(self, path, ref):
     for f in self.files():
         if f.filename == path:
             return Content(f)
-github3.gists.Gist.file_contents = _gist_contents
 
-# This is needed when working with the device authentication flow, as we're
-# getting fewer attributes back
-import github3.users
-github3.users.AuthenticatedUser._update_attributes = github3.users.User._update_attributes
+def patch_github3(github3):
+    import github3.gists
+    import github3.session
+    import github3.users
+    github3.gists.gist._Gist.ssh_url = property(lambda self: 'git@gist.github.com:/%s.git' % self.id)
+    github3.gists.gist._Gist.clone_url = property(lambda self: self.git_pull_url)
+    github3.gists.gist._Gist.git_url = property(lambda self: 'git://gist.github.com/%s.git' % self.id)
+    github3.gists.gist._Gist.name = property(lambda self: self.id)
+    github3.gists.gist._Gist.private = property(lambda self: not self.public)
+    github3.gists.gist._Gist.create_fork = github3.gists.Gist.fork
+    # XXX - There is nothing in the API output that indicates forkedness
+    github3.gists.gist._Gist.fork = False
+    github3.gists.gist._Gist.issues = lambda self, *args, **kwargs: []
+    github3.gists.Gist.events = _gist_events
+    github3.gists.Gist.file_contents = _gist_contents
+
+    # This is needed when working with the device authentication flow, as we're
+    # getting fewer attributes back
+    github3.users.AuthenticatedUser._update_attributes = github3.users.User._update_attributes
 
 # Monkeypatch docopt to support our git-clone-options-hack
 import docopt
@@ -0,0 +1,276 @@
+# Stay within the rate limits of the APIs we talk to, instead of failing halfway
+# through a long job. GitHub and GitLab tell us in every response how many
+# requests we have left until when, in x-ratelimit-* or ratelimit-* headers.
+# While plenty are left, requests go out as fast as we make them. When the
+# budget runs low, requests are paced so that what's left is spread until the
+# limit resets. Reads are paced first and the last part of the budget is kept
+# for writes, which also go first when both are waiting. Processes that make
+# many requests, like each or mirroring all repositories, are bulk jobs: they
+# back off first, so one-off commands still have requests left.
+#
+# Processes on one host that use the same credentials share their budget via a
+# small file-locked ledger in the cache directory, so a cron job and a
+# developer's shell don't both think they can use all of it.
+#
+# When we're limited anyway, by a 429, a 403 with Retry-After, GitHub's
+# secondary limits or by running out, we wait as long as the server asks and
+# try again. Bitbucket only sends 429s, without saying for how long, so there we
+# back off exponentially. Waits longer than the rate-limit-wait setting aren't
+# worth it, the response is returned as-is then.
+
+import contextlib
+import email.utils
+import fcntl
+import hashlib
+import os
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests.adapters
+
+import gitspindle.cache
+import gitspindle.trace
+
+__all__ = ['RateLimitAdapter', 'MAX_WAIT']
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Per lane, below which part of the limit requests are paced, and which part
+# they leave for the others
+LANES = {
+    'bulk': (0.3, 0.1),
+    'read': (0.2, 0.05),
+    'write': (0.05, 0),
+}
+# Set when this process is a bulk job
+bulk = False
+MAX_RETRIES = 5
+MAX_WAIT = 900
+# Waits shorter than this aren't worth mentioning
+QUIET_WAIT = 5
+
+class Budget(object):
+    """What's left of the rate limit of one API, shared by all threads and, via
+       a ledger, by other processes"""
+    def __init__(self, name, ledger=None):
+        self.name = name
+        self.ledger = ledger
+        self.limit = self.remaining = self.reset = None
+        self.blocked_until = 0
+        self.last = 0
+        self.writes_waiting = 0
+        self.told = 0
+        self.condition = threading.Condition()
+
+    def merge(self, limit, remaining, reset, last=0, blocked_until=0):
+        """Take in what a response or another process knows. Responses can
+           arrive out of order, so within a window the lowest number wins."""
+        if limit:
+            if self.reset is None or reset > self.reset + 1:
+                self.limit, self.remaining, self.reset = limit, remaining, reset
+            elif reset >= self.reset - 1:
+                self.remaining = min(self.remaining, remaining)
+        self.last = max(self.last, last)
+        self.blocked_until = max(self.blocked_until, blocked_until)
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.condition:
+            if not self.ledger:
+                yield
+                return
+            with self.ledger.locked(self):
+                yield
+
+    def update(self, limit, remaining, reset):
+        with self.shared():
+            self.merge(limit, remaining, reset)
+            self.condition.notify_all()
+
+    def block(self, until):
+        with self.shared():
+            self.blocked_until = max(self.blocked_until, until)
+
+    def delay(self, lane, now):
+        """How long a request has to wait before it may be sent"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.remaining is None or now >= self.reset:
+            return 0
+        pace, reserve = LANES[lane]
+        if self.remaining > self.limit * pace:
+            return 0
+        left = self.remaining - self.limit * reserve
+        if left <= 0:
+            return self.reset - now
+        # Spread what's left evenly until the reset
+        return max(0, self.last + (self.reset - now) / left - now)
+
+    def acquire(self, write, max_wait):
+        lane = 'write' if write else 'bulk' if bulk else 'read'
+        with self.condition:
+            if write:
+                self.writes_waiting += 1
+            try:
+                while True:
+                    with self.shared():
+                        now = time.time()
+                        delay = self.delay(lane, now)
+                        # Waiting longer than max_wait is pointless, the
+                        # server can tell the caller no
+                        go = delay > max_wait or (delay <= 0 and (write or not self.writes_waiting))
+                        if go:
+                            self.last = now
+                            if self.remaining:
+                                self.remaining -= 1
+                    if go:
+                        break
+                    # Once per wait, not once per thread
+                    if delay > QUIET_WAIT and now + delay > self.told + 1:
+                        self.told = now + delay
+                        sys.stderr.write("Rate limit of %s reached, waiting until %s\n" %
+                                         (self.name, time.strftime("%H:%M:%S", time.localtime(now + delay))))
+                    with gitspindle.trace.span('rate limit', 'wait', budget=self.name, lane=lane):
+                        self.condition.wait(delay if delay > 0 else None)
+            finally:
+                if write:
+                    self.writes_waiting -= 1
+                    self.condition.notify_all()
+
+class Ledger(object):
+    """The state of a budget in a file, locked with flock while in use. Like
+       the other caches it's best-effort: if the file can't be used, the
+       budget is only shared between threads."""
+    record = struct.Struct('<qqddd')
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.path = path
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def locked(self, budget):
+        # Forked processes, like git-spindle daemon's workers, share the open
+        # file and with that the lock, so they need their own
+        if self.pid != os.getpid():
+            os.close(self.fd)
+            self.open()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            data = os.pread(self.fd, self.record.size, 0)
+            if len(data) == self.record.size:
+                budget.merge(*self.record.unpack(data))
+            yield
+            os.pwrite(self.fd, self.record.pack(budget.limit or 0, budget.remaining or 0, budget.reset or 0,
+                                                budget.last, budget.blocked_until), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+def ledger(key):
+    path = os.path.join(gitspindle.cache.cache_dir(), 'ratelimit',
+                        hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32])
+    try:
+        return Ledger(path)
+    except OSError:
+        return None
+
+budgets = {}
+budgets_lock = threading.Lock()
+
+def budget(request):
+    url = urllib.parse.urlparse(request.url)
+    # GitHub has separate limits for searching and graphql
+    resource = 'core'
+    if url.path.endswith('/graphql'):
+        resource = 'graphql'
+    elif '/search/' in url.path:
+        resource = 'search'
+    # Limits are per account, or per address when not logged in
+    account = gitspindle.cache.digest(request.headers.get('Authorization', ''))
+    key = (url.scheme, url.netloc, resource, account)
+    with budgets_lock:
+        if key not in budgets:
+            budgets[key] = Budget(url.netloc if resource == 'core' else '%s %s' % (url.netloc, resource), ledger(key))
+        return budgets[key]
+
+def limits(headers, now):
+    """The limit, remaining requests and reset time from GitHub's or GitLab's
+       headers, or None"""
+    for prefix in ('x-ratelimit-', 'ratelimit-'):
+        try:
+            limit = int(headers[prefix + 'limit'])
+            remaining = int(headers[prefix + 'remaining'])
+            reset = float(headers[prefix + 'reset'])
+        except (KeyError, ValueError):
+            continue
+        if not limit:
+            continue
+        # An epoch, or seconds from now
+        if reset < 1e9:
+            reset += now
+        return limit, remaining, reset
+
+def retry_after(value, now):
+    try:
+        return now + float(value)
+    except ValueError:
+        pass
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def limited_until(response, attempt, now):
+    """If a response says we were rate limited, until when. None if not."""
+    status = response.status_code
+    if status not in (403, 429):
+        return None
+    headers = response.headers
+    if 'retry-after' in headers:
+        until = retry_after(headers['retry-after'], now)
+        if until is not None:
+            return until
+    if status == 403:
+        info = limits(headers, now)
+        if info and info[1] == 0:
+            return info[2]
+        # GitHub's secondary limits, it asks to wait a minute
+        if b'secondary rate limit' in response.content.lower():
+            return now + 60
+        return None
+    return now + min(5 * 2 ** attempt, 60)
+
+class RateLimitAdapter(requests.adapters.BaseAdapter):
+    """A transport adapter that paces the requests of the adapter it wraps to
+       stay within rate limits, and waits and tries again when limited."""
+    def __init__(self, adapter, max_wait=MAX_WAIT):
+        super(RateLimitAdapter, self).__init__()
+        self.adapter = adapter
+        self.max_wait = max_wait
+
+    def send(self, request, **kwargs):
+        budget_ = budget(request)
+        write = request.method not in READ_METHODS
+        # Only bodies we still have can be sent again
+        retries = MAX_RETRIES if isinstance(request.body, (type(None), str, bytes)) else 0
+        for attempt in range(retries + 1):
+            budget_.acquire(write, self.max_wait)
+            response = self.adapter.send(request, **kwargs)
+            now = time.time()
+            info = limits(response.headers, now)
+            if info:
+                budget_.update(*info)
+            until = limited_until(response, attempt, now)
+            if until is None or attempt == retries or until - now > self.max_wait:
+                return response
+            budget_.block(until)
+            response.close()
+
+    def close(self):
+        self.adapter.close()
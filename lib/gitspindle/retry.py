@@ -0,0 +1,98 @@
+# Try requests again when they fail for reasons that are likely to go away, so
+# a long job doesn't have to start over because of one 502. That's 502, 503 and
+# 504 responses, connection errors and timeouts, for requests that are safe to
+# send again: idempotent ones, or any request that never reached the server.
+#
+# Some services also refuse requests for a while, without doing anything, in
+# ways that are specific to an endpoint. Those are listed in RULES and are
+# retried whatever their method.
+#
+# Attempts back off exponentially, with jitter, until a deadline. Rate limits
+# are not handled here but in gitspindle.ratelimit, which paces every attempt.
+
+import re
+import urllib.parse
+
+import requests.adapters
+import requests.exceptions
+import urllib3.exceptions
+
+import gitspindle.trace
+from gitspindle.backoff import Backoff
+
+__all__ = ['RetryAdapter']
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+TRANSIENT_STATUSES = (502, 503, 504)
+TIMEOUT = 60
+
+# (method, path regex, status, text in the response, how long to keep trying)
+RULES = [
+    # GitLab refuses to create a project, or a fork, with the name of a project
+    # that it's still deleting
+    ('POST', re.compile(r'/projects$'), 400, b'The project is still being deleted', 120),
+    ('POST', re.compile(r'/projects/[^/]+/fork$'), 409, b'The project is still being deleted', 120),
+]
+
+def never_sent(error):
+    """Whether a request failed before the server could have seen it"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+def retry_after(response):
+    try:
+        return min(float(response.headers.get('Retry-After', 0)), TIMEOUT)
+    except ValueError:
+        return 0
+
+class RetryAdapter(requests.adapters.BaseAdapter):
+    """A transport adapter that sends requests again via the adapter it
+       wraps when they fail for transient reasons"""
+    def __init__(self, adapter):
+        super(RetryAdapter, self).__init__()
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        # Only bodies we still have can be sent again
+        if not isinstance(request.body, (type(None), str, bytes)):
+            return self.adapter.send(request, **kwargs)
+        idempotent = request.method in IDEMPOTENT_METHODS
+        path = urllib.parse.urlparse(request.url).path
+        backoff = None
+        while True:
+            try:
+                response = self.adapter.send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # TLS failures, like a certificate that doesn't match or a
+                # server that doesn't speak https, won't go away by waiting
+                if isinstance(e, requests.exceptions.SSLError) or not (idempotent or never_sent(e)):
+                    raise
+                backoff = backoff or Backoff(timeout=TIMEOUT, initial=0.5)
+                with gitspindle.trace.span('retry', 'wait', method=request.method, url=request.url, error=str(e)):
+                    if not backoff.wait():
+                        raise
+                continue
+
+            timeout = self.retry_timeout(request.method, path, idempotent, response)
+            if not timeout:
+                return response
+            backoff = backoff or Backoff(timeout=timeout, initial=0.5)
+            with gitspindle.trace.span('retry', 'wait', method=request.method, url=request.url, status=response.status_code):
+                if not backoff.wait(retry_after(response)):
+                    return response
+            response.close()
+
+    def retry_timeout(self, method, path, idempotent, response):
+        """For how long a request that got this response may be retried, or
+           None if it shouldn't be"""
+        status = response.status_code
+        if status in TRANSIENT_STATUSES and idempotent:
+            return TIMEOUT
+        for (method_, path_, status_, text, timeout) in RULES:
+            if method == method_ and status == status_ and path_.search(path) and text in response.content:
+                return timeout
+
+    def close(self):
+        self.adapter.close()
@@ -0,0 +1,124 @@
+# Count the API requests and processes a command needs, so commands that make a
+# request per issue or per event stand out. Requests are counted per endpoint,
+# with the owner, repository, number and such in the url replaced by
+# placeholders. Processes are counted per git subcommand.
+#
+# --stats shows the counts when git-spindle exits, GIT_SPINDLE_STATS=<file>
+# writes them to a file as json. The test suite uses that to check that
+# commands stay within their budget, see test/lib/budget.py.
+
+import collections
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import urllib.parse
+
+__all__ = ['install', 'endpoint', 'report', 'enabled']
+
+requests = collections.Counter()
+processes = collections.Counter()
+# Commands can make requests from several threads
+lock = threading.Lock()
+installed = False
+reported = False
+show = False
+
+# How many path components after these name something
+NAMES = {
+    'repos': ('{owner}', '{repo}'),
+    'repositories': ('{owner}', '{repo}'),
+    'users': ('{user}',),
+    'orgs': ('{org}',),
+    'workspaces': ('{workspace}',),
+    'teams': ('{team}',),
+    'projects': ('{project}',),
+    'groups': ('{group}',),
+    'gists': ('{gist}',),
+}
+
+def endpoint(method, url):
+    """The request, with the names and numbers in its url replaced"""
+    parts = urllib.parse.urlparse(url).path.split('/')
+    names = ()
+    for num, part in enumerate(parts):
+        if names:
+            parts[num], names = names[0], names[1:]
+        elif part.isdigit():
+            parts[num] = '{number}'
+        elif re.match('^[0-9a-f]{40}$', part):
+            parts[num] = '{sha}'
+        elif part in NAMES and num + 1 < len(parts) and parts[num+1]:
+            names = NAMES[part]
+    return '%s %s' % (method, '/'.join(parts))
+
+def process(args):
+    if isinstance(args, (str, bytes)):
+        args = [args]
+    args = [os.fsdecode(arg) for arg in args]
+    name = os.path.basename(args[0])
+    if name == 'git':
+        # Skip options like -C <dir> and -c <key>=<value>
+        args = iter(args[1:])
+        for arg in args:
+            if arg in ('-C', '-c'):
+                next(args, None)
+            elif not arg.startswith('-'):
+                return 'git %s' % arg
+    return name
+
+def enabled():
+    # Checked before the arguments are parsed, so processes started while
+    # starting up are counted too
+    return bool(os.environ.get('GIT_SPINDLE_STATS')) or '--stats' in sys.argv[1:]
+
+def install():
+    """Start counting if --stats or GIT_SPINDLE_STATS asks for it"""
+    global installed, show
+    if installed or not enabled():
+        return
+    installed = True
+    show = '--stats' in sys.argv[1:]
+    import atexit
+    import requests as requests_
+    atexit.register(report)
+
+    session_send = requests_.Session.send
+    def send(self, request, **kwargs):
+        name = endpoint(request.method, request.url)
+        with lock:
+            requests[name] += 1
+        return session_send(self, request, **kwargs)
+    requests_.Session.send = send
+
+    # Not Popen.__init__, whelk inspects its signature
+    execute_child = subprocess.Popen._execute_child
+    def _execute_child(self, args, *rest, **kwargs):
+        name = process(args)
+        with lock:
+            processes[name] += 1
+        return execute_child(self, args, *rest, **kwargs)
+    subprocess.Popen._execute_child = _execute_child
+
+def report():
+    """Show and save the counts, once"""
+    global reported
+    if not installed or reported:
+        return
+    reported = True
+    if show:
+        for (what, counts) in (('API requests', requests), ('Processes', processes)):
+            sys.stderr.write("%s: %d\n" % (what, sum(counts.values())))
+            for name, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+                sys.stderr.write("%7d %s\n" % (count, name))
+    path = os.environ.get('GIT_SPINDLE_STATS')
+    if path:
+        try:
+            with open(path, 'w') as fd:
+                json.dump({'argv': sys.argv, 'requests': requests, 'processes': processes}, fd, indent=4, sort_keys=True)
+        except OSError as e:
+            sys.stderr.write("Could not write stats: %s\n" % e)
+
+install()
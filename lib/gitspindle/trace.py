@@ -0,0 +1,97 @@
+# Record a timeline of what git-spindle spends its time on: subprocesses,
+# HTTP requests, logging in and running the command. Set
+# GIT_SPINDLE_TRACE=<file> to write it in Chrome's trace event format, which
+# https://ui.perfetto.dev and chrome://tracing can display.
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+import gitspindle.lazy
+
+__all__ = ['span', 'enabled']
+
+events = []
+installed = False
+# Trace timestamps are in microseconds since the epoch, so traces of nested
+# invocations line up
+offset = time.time_ns() // 1000 - time.perf_counter_ns() // 1000
+
+def enabled():
+    return bool(os.environ.get('GIT_SPINDLE_TRACE'))
+
+def now():
+    return offset + time.perf_counter_ns() // 1000
+
+@contextlib.contextmanager
+def span(name, cat='spindle', **args):
+    """Record how long the with block takes. Callers can add details to the
+       dict this yields."""
+    if not installed:
+        yield args
+        return
+    start = now()
+    try:
+        yield args
+    finally:
+        events.append({'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': now() - start,
+                       'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+def install():
+    """Start tracing if GIT_SPINDLE_TRACE is set"""
+    global installed
+    if installed or not enabled():
+        return
+    installed = True
+    events.append({'name': 'startup', 'cat': 'spindle', 'ph': 'X', 'ts': offset + int(gitspindle.lazy.started * 1e6),
+                   'dur': now() - offset - int(gitspindle.lazy.started * 1e6), 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {}})
+    import atexit
+    import requests
+    import whelk
+    atexit.register(save)
+
+    whelk_call = whelk.Command.__call__
+    def call(self, *args, **kwargs):
+        name = self.name
+        if os.path.basename(name) == 'git':
+            name = 'git %s' % next((arg for arg in args if not str(arg).startswith('-')), '')
+        with span(name, 'subprocess', argv=[self.name] + [str(arg) for arg in args]) as info:
+            ret = whelk_call(self, *args, **kwargs)
+            info['returncode'] = getattr(ret, 'returncode', None)
+            return ret
+    whelk.Command.__call__ = call
+
+    session_send = requests.Session.send
+    def send(self, request, **kwargs):
+        # The API libraries don't tell us which URL template they expanded,
+        # so spans are named after the path
+        url = urllib.parse.urlparse(request.url)
+        with span('%s %s' % (request.method, url.path), 'http', method=request.method, url=request.url) as info:
+            response = session_send(self, request, **kwargs)
+            info['status'] = response.status_code
+            if kwargs.get('stream'):
+                info['bytes'] = response.headers.get('Content-Length')
+            else:
+                info['bytes'] = len(response.content)
+            for header, value in response.headers.items():
+                if 'ratelimit' in header.lower():
+                    info[header] = value
+            return response
+    requests.Session.send = send
+
+def save():
+    if not events or not enabled():
+        return
+    meta = {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': ' '.join(sys.argv)}}
+    try:
+        with open(os.environ['GIT_SPINDLE_TRACE'], 'w') as fd:
+            json.dump({'traceEvents': [meta] + events, 'displayTimeUnit': 'ms'}, fd)
+    except (OSError, KeyError) as e:
+        sys.stderr.write("Could not write trace: %s\n" % e)
+    del events[:]
+
+install()
@@ -14,6 +14,7 @@ setup(name='git-spindle',
             'git-lab=gitspindle:lab',
             'git-bucket=gitspindle:bucket',
             'git-bb=gitspindle:bb',
+            'git-spindle=gitspindle.daemon:main',
         ]
     },
     classifiers=[
@@ -15,6 +15,40 @@ test_expect_success "Testing config unsetting" "
     git_hub_1 config --unset level &&
     test -z \"\$(git_hub_1 config level)\"
 "
+test_expect_success "Values are readable by git config" "
+    git_hub_1 config level 'over 9000; really' &&
+    test \"\$(git config -f \"\$HOME/.gitspindle\" github.github-test-1.level)\" = 'over 9000; really' &&
+    git_hub_1 config --unset level
+"
+test_expect_success "Setting config keeps comments intact" "
+    echo '# keep me' >> \"\$HOME/.gitspindle\" &&
+    git_hub_1 config level over_9000 &&
+    git_hub_1 config --unset level &&
+    grep -q '^# keep me' \"\$HOME/.gitspindle\"
+"
+test_expect_success "Continued values are read like git reads them" "
+    cp \"\$HOME/.gitspindle\" gitspindle.orig &&
+    printf '[github \"github-test-1\"]\\n\\tlevel = a b \\\\\\\\\\\\\\n\\t  c \\\\\\\\\\\\\\\\\\\\\\n\\td\\n' >> \"\$HOME/.gitspindle\" &&
+    test \"\$(git_hub_1 config level)\" = \"\$(git config -f \"\$HOME/.gitspindle\" github.github-test-1.level)\" &&
+    cp gitspindle.orig \"\$HOME/.gitspindle\"
+"
+test_expect_success "Config file with credentials is private" "
+    test \"\$(stat -c %a \"\$HOME/.gitspindle\")\" = 600
+"
+test_expect_success "Writing a repository's config keeps its mode" "
+    git init -q shared &&
+    chmod 664 shared/.git/config &&
+    GIT_SPINDLE_DEBUG=1 git_hub_1 run-shell -c \"from gitspindle.config import ConfigFile; ConfigFile('\$PWD/shared/.git/config').set('spindle.test', 'yes')\" &&
+    test \"\$(git -C shared config spindle.test)\" = yes &&
+    test \"\$(stat -c %a shared/.git/config)\" = 664
+"
+test_expect_success "Config does not load API libraries" "
+    for spindle in git_hub_1 git_lab_1 git_bb_1; do
+        GIT_SPINDLE_IMPORT_PROFILE=1 \$spindle config level 2>profile &&
+        grep -q total profile &&
+        ! grep 'lazy import' profile || return 1
+    done
+"
 
 test_done
 
@@ -0,0 +1,38 @@
+#!/bin/sh
+
+test_description="Testing git spindle daemon"
+
+. ./setup.sh
+
+git_spindle() { "$PYTHON" "$SHARNESS_BUILD_DIRECTORY/bin/git-spindle" "$@"; }
+
+test_expect_success "Starting the daemon" "
+    git_spindle daemon --detach &&
+    for i in 1 2 3 4 5 6 7 8 9 10; do
+        test -S .cache/git-spindle/daemon-socket && break
+        sleep 1
+    done &&
+    test -S .cache/git-spindle/daemon-socket
+"
+
+for spindle in hub lab bb; do
+    test_expect_success $spindle "Running commands through the daemon ($spindle)" "
+        git_${spindle}_1 whoami > expected &&
+        GIT_SPINDLE_NO_DAEMON=1 git_${spindle}_1 whoami > actual &&
+        test_cmp expected actual
+    "
+done
+
+test_expect_success "Exit codes are passed on" "
+    git_hub_1 config --unset no-such-key; test \$? -eq 5
+"
+
+test_expect_success "Stopping the daemon" "
+    git_spindle stop &&
+    sleep 1 &&
+    test_must_fail git_spindle stop
+"
+
+test_done
+
+# vim: set syntax=sh:
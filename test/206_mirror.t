@@ -5,6 +5,18 @@ test_description="Testing mirror"
 . ./setup.sh
 
 test_expect_failure "Testing mirror" "false"
+
+for spindle in lab hub bb; do
+    test_expect_success $spindle "Mirroring with each shows git's output per repository ($spindle)" "
+        src=\$(username git_${spindle}_1) &&
+        git_${spindle}_1 each \"\$src/whelk\" -- mirror > output 2> summary &&
+        test \"\$(head -n 1 output)\" = \"\$src/whelk\" &&
+        grep -q '^Cloning into bare repository' output &&
+        test -d whelk.git &&
+        rm -rf whelk.git
+    "
+done
+
 test_done
 
 # vim: set syntax=sh:
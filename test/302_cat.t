@@ -30,6 +30,13 @@ for spindle in lab hub bb; do
         test_cmp expected.binary actual
     "
 
+    test_expect_success $spindle "Testing cat for many repositories ($spindle)" "
+        src=\$(username git_${spindle}_1) &&
+        git_${spindle}_1 each \"\$src/whelk\" -- cat master:/docs/presentation/whelk.jpg > output 2> summary &&
+        tail -n +2 output | md5sum > actual &&
+        test_cmp expected.binary actual
+    "
+
     test_expect_success $spindle "Testing cat inside repo ($spindle)" "
         (cd whelk &&
         git_${spindle}_1 cat setup.py | md5sum > actual &&
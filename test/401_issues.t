@@ -36,6 +36,28 @@ for spindle in lab hub bb; do
         grep -q 'Test issue (inside) $id' issues
     "
 
+    test_expect_success $spindle "Listing issues doesn't fetch issues one by one ($spindle)" "
+        GIT_SPINDLE_STATS=stats.json git_${spindle}_1 issues whelk > issues &&
+        test_budget requests 0 '*/{number}'
+    "
+
+    test_expect_success $spindle "Listing issues of many repositories ($spindle)" "
+        src=\$(username git_${spindle}_1) &&
+        git_${spindle}_1 each \"\$src/whel*\" -- issues > issues 2> summary &&
+        grep -q 'Test issue (outside) $id' issues &&
+        grep -q \"^\$src/whelk .* ok\$\" summary &&
+        grep -q '^0 of 1 failed' summary
+    "
+
+    test_expect_success $spindle "Listing issues of repositories in a file ($spindle)" "
+        src=\$(username git_${spindle}_1) &&
+        printf '# Repositories\n\$src/whelk\n\$src/no-such-repo-$id\n' > manifest &&
+        test_must_fail git_${spindle}_1 each manifest -- issues > issues 2> summary &&
+        grep -q 'Test issue (outside) $id' issues &&
+        grep -q \"^\$src/no-such-repo-$id .* failed\" summary &&
+        grep -q '^1 of 2 failed' summary
+    "
+
     test_expect_success $spindle "Listing issues inside the repo ($spindle)" "
         (cd whelk &&
         git_${spindle}_1 issues whelk > issues &&
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+"""Time git-spindle commands against a local fake forge
+
+Usage:
+  benchmark.py [options] [<benchmark>...]
+
+Options:
+  --runs=<n>             How often to run each command [default: 3]
+  --warm                 Keep git-spindle's caches between runs
+  --endpoints            Show how often each API endpoint was used
+  --json=<file>          Also write the results to a file
+  --repos=<n>            Repositories owned by the user [default: 100]
+  --issues=<n>           Issues per repository [default: 100]
+  --forks=<n>            Forks of the first repository and of each fork [default: 2]
+  --fork-depth=<n>       Depth of that fork network [default: 3]
+  --events=<n>           Events for the user and for each repository [default: 100]
+  --followers=<n>        Followers of the user [default: 10]
+  --commits=<n>          Commits in the repository that is cloned [default: 10]
+  --latency=<ms>         Time every API request takes [default: 0]
+  --rate-limit=<n>       API requests allowed per minute, 0 for no limit [default: 0]
+  --flaky=<n>            Fail every nth API request with a 502, 0 for never [default: 0]
+
+Benchmarks are named after the command they run, e.g. hub-issues or bb-mirror.
+Without arguments, all of them are run. The fake forge is started with the
+given size, see lib/fakeforge.py for what it serves.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+build_dir = os.path.dirname(test_dir)
+sys.path[:0] = [os.path.join(build_dir, 'lib'), os.path.join(test_dir, 'lib')]
+import docopt
+import fakeforge
+
+USER = 'bench'
+BENCHMARKS = [
+    ('hub-repos',    'git-hub', ['repos']),
+    ('hub-issues',   'git-hub', ['issues', USER + '/repo-00000']),
+    ('hub-log',      'git-hub', ['log']),
+    ('hub-network',  'git-hub', ['network']),
+    ('hub-mirror',   'git-hub', ['mirror', USER + '/*']),
+    ('hub-clone',    'git-hub', ['clone', USER + '/repo-00000']),
+    ('lab-repos',    'git-lab', ['repos']),
+    ('lab-issues',   'git-lab', ['issues', USER + '/repo-00000']),
+    ('lab-log',      'git-lab', ['log', USER + '/repo-00000']),
+    ('lab-mirror',   'git-lab', ['mirror', USER + '/repo-00000']),
+    ('lab-clone',    'git-lab', ['clone', USER + '/repo-00000']),
+    ('bb-repos',     'git-bb',  ['repos']),
+    ('bb-issues',    'git-bb',  ['issues', USER + '/repo-00000']),
+    ('bb-mirror',    'git-bb',  ['mirror', USER + '/*']),
+    ('bb-clone',     'git-bb',  ['clone', USER + '/repo-00000']),
+]
+
+CONFIG = """[github]
+    user = %(user)s
+    token = fake-token
+    host = %(root)s
+[gitlab]
+    user = %(user)s
+    token = fake-token
+    host = %(root)s
+[bitbucket]
+    user = %(user)s
+    password = fake-password
+    host = %(root)s
+"""
+
+def stats(forge):
+    with urllib.request.urlopen(forge.root + '/_stats?reset=1') as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def run(forge, home, script, args, warm):
+    work = tempfile.mkdtemp(dir=home)
+    env = dict(os.environ, HOME=home, XDG_CACHE_HOME=os.path.join(home, 'cache'), XDG_CONFIG_HOME=os.path.join(home, 'config'),
+               PYTHONPATH=os.path.join(build_dir, 'lib'), GIT_SPINDLE_NO_DAEMON='1', GIT_CONFIG_NOSYSTEM='1',
+               PYTHONWARNINGS='ignore')
+    env.pop('GITSPINDLE_ACCOUNT', None)
+    if not warm:
+        shutil.rmtree(env['XDG_CACHE_HOME'], ignore_errors=True)
+    stats(forge)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.join(build_dir, 'bin', script)] + args, cwd=work, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(work)
+    if proc.returncode:
+        sys.stderr.write(proc.stderr.decode('utf-8', 'replace'))
+        raise RuntimeError("%s %s exited with status %d" % (script, ' '.join(args), proc.returncode))
+    return elapsed, stats(forge)
+
+def main():
+    opts = docopt.docopt(__doc__)
+    names = [name for (name, _, _) in BENCHMARKS]
+    for name in opts['<benchmark>']:
+        if name not in names:
+            sys.stderr.write("Unknown benchmark: %s, choose from %s\n" % (name, ', '.join(names)))
+            sys.exit(1)
+    world = dict((key, int(opts['--' + key.replace('_', '-')])) for key in ('repos', 'issues', 'forks', 'fork_depth', 'events', 'followers'))
+    runs = int(opts['--runs'])
+
+    tmp = tempfile.mkdtemp(prefix='git-spindle-benchmark-')
+    results = {}
+    failed = False
+    try:
+        forge = fakeforge.start(git_dir=os.path.join(tmp, 'forge', 'repo.git'), commits=int(opts['--commits']), latency=int(opts['--latency']),
+                                rate_limit=int(opts['--rate-limit']), flaky=int(opts['--flaky']), user=USER, **world)
+        home = os.path.join(tmp, 'home')
+        os.makedirs(home)
+        with open(os.path.join(home, '.gitspindle'), 'w') as fd:
+            fd.write(CONFIG % {'user': USER, 'root': forge.root})
+
+        print("%-14s %9s %9s %9s" % ('benchmark', 'median', 'min', 'requests'))
+        for name, script, args in BENCHMARKS:
+            if opts['<benchmark>'] and name not in opts['<benchmark>']:
+                continue
+            times = []
+            try:
+                for num in range(runs):
+                    elapsed, endpoints = run(forge, home, script, args, opts['--warm'])
+                    times.append(elapsed)
+            except RuntimeError as e:
+                print("%-14s failed: %s" % (name, e))
+                failed = True
+                continue
+            times.sort()
+            median = times[len(times) // 2]
+            requests = sum(endpoints.values())
+            results[name] = {'command': ' '.join([script] + args), 'times': times, 'median': median, 'requests': requests, 'endpoints': endpoints}
+            print("%-14s %8.3fs %8.3fs %9d" % (name, median, times[0], requests))
+            if opts['--endpoints']:
+                for endpoint, count in sorted(endpoints.items(), key=lambda item: -item[1]):
+                    print("    %6d %s" % (count, endpoint))
+    finally:
+        shutil.rmtree(tmp)
+
+    if opts['--json']:
+        with open(opts['--json'], 'w') as fd:
+            json.dump({'world': world, 'runs': runs, 'warm': opts['--warm'], 'results': results}, fd, indent=4, sort_keys=True)
+    sys.exit(failed)
+
+if __name__ == '__main__':
+    main()
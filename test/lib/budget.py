@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+"""Check that a git-spindle command stayed within its budget
+
+Usage:
+  budget.py <stats-file> (requests|processes) <max> [<pattern>]
+
+The stats file is what git-spindle writes when GIT_SPINDLE_STATS is set. Only
+API requests or processes that match the shell-style pattern are counted, e.g.
+'GET */issues/{number}' or 'git config'. If there are more than <max>, all
+counts are shown and the exit status is 1.
+"""
+
+import fnmatch
+import json
+import sys
+
+def load(path):
+    with open(path) as fd:
+        return json.load(fd)
+
+def count(stats, what, pattern='*'):
+    return sum(num for (name, num) in stats[what].items() if fnmatch.fnmatchcase(name, pattern))
+
+def check(stats, what, maximum, pattern='*'):
+    """Raise an AssertionError if the command went over budget"""
+    used = count(stats, what, pattern)
+    if used > maximum:
+        details = ''.join('\n%7d %s' % (num, name) for (name, num) in sorted(stats[what].items()))
+        raise AssertionError("%s used %d %s matching %s, at most %d allowed:%s" %
+                             (' '.join(stats['argv']), used, what, pattern, maximum, details))
+
+def main():
+    if len(sys.argv) not in (4, 5) or sys.argv[2] not in ('requests', 'processes') or not sys.argv[3].isdigit():
+        sys.stderr.write(__doc__[__doc__.index('Usage:'):])
+        sys.exit(2)
+    try:
+        check(load(sys.argv[1]), sys.argv[2], int(sys.argv[3]), *sys.argv[4:])
+    except AssertionError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
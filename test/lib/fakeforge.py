@@ -0,0 +1,781 @@
+#!/usr/bin/python3
+"""A stand-in for GitHub, GitLab and Bitbucket that runs locally
+
+Usage:
+  fakeforge.py [options]
+
+Options:
+  --port=<port>          Port to listen on [default: 0]
+  --user=<user>          The user that is logged in [default: bench]
+  --repos=<n>            Repositories owned by the user [default: 100]
+  --issues=<n>           Issues (every fifth is a pull request) per repository [default: 100]
+  --forks=<n>            Forks of the first repository and of each fork [default: 2]
+  --fork-depth=<n>       Depth of that fork network [default: 3]
+  --events=<n>           Events for the user and for each repository [default: 100]
+  --followers=<n>        Followers of the user [default: 10]
+  --commits=<n>          Commits in the repository that all clone urls point to [default: 10]
+  --latency=<ms>         Time every API request takes, to simulate a real network [default: 0]
+  --rate-limit=<n>       API requests allowed per API per window, 0 for no limit [default: 0]
+  --rate-window=<s>      Seconds after which the rate limits reset [default: 60]
+  --flaky=<n>            Fail every nth API request with a 502, 0 for never [default: 0]
+
+It serves the subset of the REST APIs that github3.py, python-gitlab and
+gitspindle.bbapi use for git-spindle's commands, with pagination and ETags,
+filled with generated data. Point git-spindle at it by setting the host of an
+account to the url it prints. All repositories share a single git repository
+that is served over file://, so clone, mirror and fetch work.
+
+GET /_stats returns how many requests were made for each endpoint. Add ?reset=1
+to start counting again.
+
+With --rate-limit, GitHub and GitLab send rate limit headers and refuse requests
+over the limit like the real ones do, with a 403 and a 429 with Retry-After.
+Bitbucket sends a bare 429.
+
+With --flaky, some requests fail with a 502 Bad Gateway, like they sometimes do
+behind the load balancers of the real ones.
+"""
+
+import base64
+import collections
+import hashlib
+import http.server
+import json
+import math
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+TIMESTAMP = '2020-01-01T12:00:00Z'
+
+def ident(name):
+    return zlib.crc32(name.encode('utf-8'))
+
+class World(object):
+    """The generated users, repositories, forks, issues and events. Nothing
+       is stored, everything is derived from its name or number, so large
+       worlds are cheap."""
+    def __init__(self, user='bench', repos=100, issues=100, forks=2, fork_depth=3, events=100, followers=10, git_dir=None):
+        self.user = user
+        self.nrepos = repos
+        self.nissues = issues
+        self.nevents = events
+        self.nfollowers = followers
+        self.git_dir = git_dir
+        # Forks are identified by their path in the fork network of the first
+        # repository, their owner is named after it
+        self.forks = {}
+        paths = [()]
+        for level in range(fork_depth):
+            paths = [path + (num,) for path in paths for num in range(forks)]
+            for path in paths:
+                self.forks['fork-' + '-'.join(str(num) for num in path)] = path
+        self.fork_owners = dict((path, owner) for (owner, path) in self.forks.items())
+
+    def repo_name(self, num):
+        return 'repo-%05d' % num
+
+    def repo_num(self, name):
+        m = re.match(r'^repo-(\d+)$', name)
+        if m and int(m.group(1)) < self.nrepos:
+            return int(m.group(1))
+
+    def user_exists(self, login):
+        return login == self.user or login in self.forks or re.match(r'^follower-\d+$', login)
+
+    def repos_of(self, login):
+        """(owner, name) of the repositories a user owns"""
+        if login == self.user:
+            return [(login, self.repo_name(num)) for num in range(self.nrepos)]
+        if login in self.forks and self.nrepos:
+            return [(login, self.repo_name(0))]
+        return []
+
+    def repo_exists(self, owner, name):
+        if owner == self.user:
+            return self.repo_num(name) is not None
+        return owner in self.forks and self.nrepos > 0 and name == self.repo_name(0)
+
+    def parent(self, owner, name):
+        if owner not in self.forks:
+            return None
+        path = self.forks[owner][:-1]
+        return (self.fork_owners[path] if path else self.user, name)
+
+    def children(self, owner, name):
+        if not self.repo_exists(owner, name) or name != self.repo_name(0):
+            return []
+        path = self.forks.get(owner, ())
+        ret = []
+        while path + (len(ret),) in self.fork_owners:
+            ret.append((self.fork_owners[path + (len(ret),)], name))
+        return ret
+
+    def git_url(self, owner, name):
+        # Every repository is a link to the same one, but clones should still
+        # be named after the repository
+        path = os.path.join(os.path.dirname(self.git_dir), owner, name + '.git')
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.symlink(self.git_dir, path)
+            except FileExistsError:
+                pass
+        return 'file://' + path
+
+    def is_pull(self, number):
+        return number % 5 == 0
+
+class Forge(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, world, port=0, latency=0, rate_limit=0, rate_window=60, flaky=0):
+        super(Forge, self).__init__(('127.0.0.1', port), Handler)
+        self.world = world
+        self.latency = latency / 1000.0
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.rate_reset = 0
+        self.rate_used = collections.Counter()
+        self.flaky = flaky
+        self.requests = 0
+        self.root = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.apis = [GitHubAPI(self), GitLabAPI(self), BitbucketAPI(self)]
+
+    def count(self, endpoint):
+        with self.lock:
+            self.stats[endpoint] += 1
+
+    def fail(self, api):
+        """Whether this request should fail, with --flaky"""
+        if not self.flaky:
+            return False
+        with self.lock:
+            self.requests += 1
+            fail = self.requests % self.flaky == 0
+        if fail:
+            self.count('%s failed' % api.name)
+        return fail
+
+    def rate(self, api):
+        """Count a request against the rate limit of an API. Returns the
+           error to send instead of a response when over the limit, and the
+           rate limit headers to send."""
+        if not self.rate_limit:
+            return None, {}
+        with self.lock:
+            now = time.time()
+            if now >= self.rate_reset:
+                self.rate_reset = now + self.rate_window
+                self.rate_used.clear()
+            self.rate_used[api.name] += 1
+            remaining = self.rate_limit - self.rate_used[api.name]
+            reset = int(math.ceil(self.rate_reset))
+        if remaining < 0:
+            self.count('%s limited' % api.name)
+        if api.name == 'github':
+            headers = {'X-RateLimit-Limit': self.rate_limit, 'X-RateLimit-Remaining': max(remaining, 0),
+                       'X-RateLimit-Reset': reset, 'X-RateLimit-Resource': 'core'}
+            error = (403, {'message': 'API rate limit exceeded'}, headers)
+        elif api.name == 'gitlab':
+            headers = {'RateLimit-Limit': self.rate_limit, 'RateLimit-Remaining': max(remaining, 0), 'RateLimit-Reset': reset}
+            error = (429, {'message': 'Retry later'}, dict(headers, **{'Retry-After': max(reset - int(now), 1)}))
+        else:
+            headers = {}
+            error = (429, {'type': 'error', 'error': {'message': 'Rate limit for this resource has been exceeded'}}, headers)
+        return (error if remaining < 0 else None), headers
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one go, so we don't measure delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        query = dict(urllib.parse.parse_qsl(query))
+        if path == '/_stats':
+            with self.server.lock:
+                stats = dict(self.server.stats)
+                if query.get('reset'):
+                    self.server.stats.clear()
+            return self.respond(200, stats)
+        for api in self.server.apis:
+            if path.startswith(api.prefix + '/'):
+                for pattern, endpoint, func in api.routes:
+                    m = pattern.match(path[len(api.prefix):])
+                    if m:
+                        self.server.count('%s GET %s' % (api.name, endpoint))
+                        if self.server.latency:
+                            time.sleep(self.server.latency)
+                        if self.server.fail(api):
+                            return self.respond(502, {'message': 'Bad Gateway'})
+                        error, limits = self.server.rate(api)
+                        if error:
+                            return self.respond(*error)
+                        args = [urllib.parse.unquote(arg) for arg in m.groups()]
+                        status, data, headers = func(query, *args)
+                        return self.respond(status, data, dict(limits, **headers))
+        self.server.count('unknown GET %s' % path)
+        self.respond(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        self.server.count('unknown %s %s' % (self.command, self.path.partition('?')[0]))
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.respond(405, {'message': 'The fake forge is read-only'})
+    do_PUT = do_PATCH = do_DELETE = do_POST
+
+    def respond(self, status, data, headers={}):
+        body = json.dumps(data).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def route(pattern):
+    def decorator(func):
+        func.pattern = pattern
+        return func
+    return decorator
+
+class API(object):
+    def __init__(self, forge):
+        self.forge = forge
+        self.world = forge.world
+        self.api = forge.root + self.prefix
+        self.routes = []
+        for name in dir(self):
+            func = getattr(self, name)
+            if hasattr(func, 'pattern'):
+                regex = re.sub(r'\{\w+\}', '([^/]+)', func.pattern)
+                self.routes.append((re.compile('^%s/?$' % regex), func.pattern, func))
+        # Most specific first, so /users/{login} doesn't shadow /user/repos
+        self.routes.sort(key=lambda route: (-route[1].count('/'), route[1].count('{')))
+
+    def page(self, query, total, default, maximum, per_page='per_page'):
+        per_page = min(int(query.get(per_page, default)), maximum)
+        page = max(int(query.get('page', 1)), 1)
+        start = (page - 1) * per_page
+        return page, per_page, range(start, min(start + per_page, total))
+
+    def not_found(self):
+        return 404, {'message': 'Not Found'}, {}
+
+class GitHubAPI(API):
+    name = 'github'
+    prefix = '/api/v3'
+
+    def paginate(self, query, total, make, path):
+        page, per_page, items = self.page(query, total, 30, 100)
+        headers = {}
+        links = []
+        last = max((total + per_page - 1) // per_page, 1)
+        if page < last:
+            links.append('<%s%s?per_page=%d&page=%d>; rel="next"' % (self.api, path, per_page, page + 1))
+            links.append('<%s%s?per_page=%d&page=%d>; rel="last"' % (self.api, path, per_page, last))
+        if links:
+            headers['Link'] = ', '.join(links)
+        return 200, [make(num) for num in items], headers
+
+    def user(self, login, full=False):
+        url = '%s/users/%s' % (self.api, login)
+        data = {'login': login, 'id': ident(login), 'avatar_url': '%s/avatars/%s' % (self.forge.root, login), 'gravatar_id': '',
+                'url': url, 'html_url': '%s/%s' % (self.forge.root, login), 'followers_url': url + '/followers',
+                'following_url': url + '/following{/other_user}', 'gists_url': url + '/gists{/gist_id}',
+                'starred_url': url + '/starred{/owner}{/repo}', 'subscriptions_url': url + '/subscriptions',
+                'organizations_url': url + '/orgs', 'repos_url': url + '/repos', 'events_url': url + '/events{/privacy}',
+                'received_events_url': url + '/received_events', 'type': 'User', 'site_admin': False}
+        if full:
+            data.update({'name': login.title(), 'company': None, 'blog': '', 'location': None, 'email': None,
+                         'hireable': None, 'bio': None, 'public_repos': len(self.world.repos_of(login)), 'public_gists': 0,
+                         'followers': self.world.nfollowers if login == self.world.user else 0, 'following': 0,
+                         'created_at': TIMESTAMP, 'updated_at': TIMESTAMP})
+        return data
+
+    def repo(self, owner, name, family=True):
+        url = '%s/repos/%s/%s' % (self.api, owner, name)
+        templates = {'archive_url': '/{archive_format}{/ref}', 'assignees_url': '/assignees{/user}', 'blobs_url': '/git/blobs{/sha}',
+                     'branches_url': '/branches{/branch}', 'collaborators_url': '/collaborators{/collaborator}',
+                     'comments_url': '/comments{/number}', 'commits_url': '/commits{/sha}', 'compare_url': '/compare/{base}...{head}',
+                     'contents_url': '/contents/{+path}', 'contributors_url': '/contributors', 'deployments_url': '/deployments',
+                     'downloads_url': '/downloads', 'events_url': '/events', 'forks_url': '/forks', 'git_commits_url': '/git/commits{/sha}',
+                     'git_refs_url': '/git/refs{/sha}', 'git_tags_url': '/git/tags{/sha}', 'hooks_url': '/hooks',
+                     'issue_comment_url': '/issues/comments{/number}', 'issue_events_url': '/issues/events{/number}',
+                     'issues_url': '/issues{/number}', 'keys_url': '/keys{/key_id}', 'labels_url': '/labels{/name}',
+                     'languages_url': '/languages', 'merges_url': '/merges', 'milestones_url': '/milestones{/number}',
+                     'notifications_url': '/notifications{?since,all,participating}', 'pulls_url': '/pulls{/number}',
+                     'releases_url': '/releases{/id}', 'stargazers_url': '/stargazers', 'statuses_url': '/statuses/{sha}',
+                     'subscribers_url': '/subscribers', 'subscription_url': '/subscription', 'tags_url': '/tags',
+                     'teams_url': '/teams', 'trees_url': '/git/trees{/sha}'}
+        data = dict((key, url + value) for (key, value) in templates.items())
+        parent = self.world.parent(owner, name)
+        forks = len(self.world.children(owner, name))
+        git_url = self.world.git_url(owner, name)
+        data.update({'url': url, 'id': ident(owner + '/' + name), 'name': name, 'full_name': '%s/%s' % (owner, name),
+                     'owner': self.user(owner), 'private': False, 'fork': bool(parent), 'description': 'Repository %s of %s' % (name, owner),
+                     'html_url': '%s/%s/%s' % (self.forge.root, owner, name), 'archived': False, 'clone_url': git_url,
+                     'git_url': git_url, 'ssh_url': git_url, 'svn_url': git_url, 'mirror_url': None,
+                     'created_at': TIMESTAMP, 'updated_at': TIMESTAMP, 'pushed_at': TIMESTAMP, 'default_branch': 'master',
+                     'forks_count': forks, 'forks': forks, 'network_count': forks, 'stargazers_count': 0, 'watchers_count': 0, 'watchers': 0,
+                     'subscribers_count': 0, 'open_issues': self.world.nissues,
+                     'open_issues_count': self.world.nissues, 'size': 1, 'homepage': None, 'language': 'Python',
+                     'has_downloads': True, 'has_issues': True, 'has_pages': False, 'has_projects': False, 'has_wiki': False})
+        if parent and family:
+            data['parent'] = self.repo(*parent, family=False)
+            source = parent
+            while self.world.parent(*source):
+                source = self.world.parent(*source)
+            data['source'] = self.repo(*source, family=False)
+        return data
+
+    def issue(self, owner, name, number):
+        url = '%s/repos/%s/%s/issues/%d' % (self.api, owner, name, number)
+        html_url = '%s/%s/%s/issues/%d' % (self.forge.root, owner, name, number)
+        data = {'url': url, 'id': number, 'number': number, 'title': 'Issue %d' % number, 'body': 'Something is wrong',
+                'state': 'open', 'user': self.user(self.world.user), 'assignee': None, 'assignees': [], 'labels': [],
+                'labels_url': url + '/labels{/name}', 'comments': 0, 'comments_url': url + '/comments', 'events_url': url + '/events',
+                'html_url': html_url, 'locked': False, 'milestone': None, 'closed_at': None,
+                'created_at': TIMESTAMP, 'updated_at': TIMESTAMP}
+        if self.world.is_pull(number):
+            pull = '%s/repos/%s/%s/pulls/%d' % (self.api, owner, name, number)
+            data['pull_request'] = {'url': pull, 'html_url': html_url.replace('/issues/', '/pull/'),
+                                    'diff_url': pull + '.diff', 'patch_url': pull + '.patch'}
+        return data
+
+    def pull(self, owner, name, number):
+        data = self.issue(owner, name, number)
+        url = data['pull_request']['url']
+        dest = lambda ref: {'label': '%s:%s' % (owner, ref), 'ref': ref, 'sha': '0' * 40, 'user': self.user(owner), 'repo': self.repo(owner, name, False)}
+        data.update({'url': url, 'html_url': data['pull_request']['html_url'], 'diff_url': url + '.diff', 'patch_url': url + '.patch',
+                     'issue_url': data['url'], 'commits_url': url + '/commits', 'review_comments_url': url + '/comments',
+                     'review_comment_url': '%s/repos/%s/%s/pulls/comments{/number}' % (self.api, owner, name),
+                     'statuses_url': '%s/repos/%s/%s/statuses/%s' % (self.api, owner, name, '0' * 40), 'head': dest('feature-%d' % number),
+                     'base': dest('master'), '_links': {}, 'active_lock_reason': None, 'body_html': '', 'body_text': '',
+                     'merge_commit_sha': None, 'merged_at': None, 'additions': 1, 'deletions': 1, 'author_association': 'OWNER',
+                     'commits': 1, 'draft': False, 'mergeable': True, 'mergeable_state': 'clean', 'merged': False, 'merged_by': None,
+                     'requested_reviewers': [], 'requested_teams': [], 'review_comments': 0})
+        return data
+
+    def event(self, login, num):
+        actor = {'id': ident(login), 'login': login, 'display_login': login, 'url': '%s/users/%s' % (self.api, login),
+                 'avatar_url': '%s/avatars/%s' % (self.forge.root, login)}
+        name = self.world.repo_name(num % max(self.world.nrepos, 1))
+        number = num % max(self.world.nissues, 1) + 1
+        kind = ['PushEvent', 'IssuesEvent', 'CreateEvent', 'WatchEvent'][num % 4]
+        payload = {
+            'PushEvent': {'ref': 'refs/heads/master', 'before': '0' * 40, 'head': '1' * 40, 'commits': [{}]},
+            'IssuesEvent': {'action': 'opened', 'issue': {'id': number, 'number': number, 'title': 'Issue %d' % number, 'state': 'open',
+                                                           'locked': False, 'url': '%s/repos/%s/%s/issues/%d' % (self.api, login, name, number)}},
+            'CreateEvent': {'ref_type': 'branch', 'ref': 'branch-%d' % num},
+            'WatchEvent': {'action': 'started'},
+        }[kind]
+        return {'id': str(num), 'type': kind, 'actor': actor, 'repo': {'id': ident(login + '/' + name), 'name': '%s/%s' % (login, name),
+                'url': '%s/repos/%s/%s' % (self.api, login, name)}, 'payload': payload, 'public': True, 'created_at': TIMESTAMP}
+
+    @route('/user')
+    def authenticated_user(self, query):
+        return 200, self.user(self.world.user, True), {}
+
+    # Like GitHub, lists don't include parent and source repositories
+    @route('/user/repos')
+    def my_repos(self, query):
+        repos = self.world.repos_of(self.world.user)
+        return self.paginate(query, len(repos), lambda num: self.repo(*repos[num], family=False), '/user/repos')
+
+    @route('/user/emails')
+    def emails(self, query):
+        return 200, [], {}
+
+    @route('/user/keys')
+    def keys(self, query):
+        return 200, [], {}
+
+    @route('/user/orgs')
+    def orgs(self, query):
+        return 200, [], {}
+
+    @route('/users/{login}')
+    def get_user(self, query, login):
+        if not self.world.user_exists(login):
+            return self.not_found()
+        return 200, self.user(login, True), {}
+
+    @route('/users/{login}/repos')
+    def user_repos(self, query, login):
+        repos = self.world.repos_of(login)
+        return self.paginate(query, len(repos), lambda num: self.repo(*repos[num], family=False), '/users/%s/repos' % login)
+
+    @route('/users/{login}/followers')
+    def followers(self, query, login):
+        total = self.world.nfollowers if login == self.world.user else 0
+        return self.paginate(query, total, lambda num: self.user('follower-%d' % num), '/users/%s/followers' % login)
+
+    @route('/users/{login}/following')
+    def following(self, query, login):
+        return 200, [], {}
+
+    @route('/users/{login}/gists')
+    def gists(self, query, login):
+        return 200, [], {}
+
+    @route('/users/{login}/events')
+    def user_events(self, query, login):
+        return self.paginate(query, self.world.nevents, lambda num: self.event(login, num), '/users/%s/events' % login)
+
+    @route('/users/{login}/orgs')
+    def user_orgs(self, query, login):
+        return 200, [], {}
+
+    @route('/users/{login}/keys')
+    def user_keys(self, query, login):
+        return 200, [], {}
+
+    @route('/repos/{owner}/{repo}')
+    def get_repo(self, query, owner, name):
+        if not self.world.repo_exists(owner, name):
+            return self.not_found()
+        return 200, self.repo(owner, name), {}
+
+    @route('/repos/{owner}/{repo}/readme')
+    def readme(self, query, owner, name):
+        if not self.world.repo_exists(owner, name):
+            return self.not_found()
+        content = ('# %s\n\nRepository %s of %s\n' % (name, name, owner)).encode('utf-8')
+        url = '%s/repos/%s/%s/contents/README.md' % (self.api, owner, name)
+        return 200, {'type': 'file', 'encoding': 'base64', 'size': len(content), 'name': 'README.md', 'path': 'README.md',
+                     'content': base64.b64encode(content).decode('ascii'), 'sha': hashlib.sha1(content).hexdigest(),
+                     'url': url, 'git_url': None, 'html_url': None, 'download_url': None,
+                     '_links': {'self': url, 'git': None, 'html': None}}, {}
+
+    @route('/repos/{owner}/{repo}/forks')
+    def forks(self, query, owner, name):
+        forks = self.world.children(owner, name)
+        return self.paginate(query, len(forks), lambda num: self.repo(*forks[num], family=False), '/repos/%s/%s/forks' % (owner, name))
+
+    @route('/repos/{owner}/{repo}/issues')
+    def issues(self, query, owner, name):
+        if not self.world.repo_exists(owner, name):
+            return self.not_found()
+        total = self.world.nissues if owner == self.world.user else 0
+        return self.paginate(query, total, lambda num: self.issue(owner, name, total - num), '/repos/%s/%s/issues' % (owner, name))
+
+    @route('/repos/{owner}/{repo}/pulls/{number}')
+    def get_pull(self, query, owner, name, number):
+        number = int(number)
+        if owner != self.world.user or not self.world.is_pull(number) or number > self.world.nissues:
+            return self.not_found()
+        return 200, self.pull(owner, name, number), {}
+
+class GitLabAPI(API):
+    name = 'gitlab'
+    prefix = '/api/v4'
+
+    def paginate(self, query, total, make, path):
+        page, per_page, items = self.page(query, total, 20, 100)
+        pages = max((total + per_page - 1) // per_page, 1)
+        headers = {'X-Page': str(page), 'X-Per-Page': str(per_page), 'X-Total': str(total), 'X-Total-Pages': str(pages)}
+        if page < pages:
+            headers['X-Next-Page'] = str(page + 1)
+            headers['Link'] = '<%s%s?per_page=%d&page=%d>; rel="next"' % (self.api, path, per_page, page + 1)
+        return 200, [make(num) for num in items], headers
+
+    def project_id(self, owner, name):
+        if owner == self.world.user:
+            return self.world.repo_num(name) + 1
+        return 1000000 + sorted(self.world.forks).index(owner)
+
+    def project_by_id(self, id):
+        if id <= self.world.nrepos:
+            return self.world.user, self.world.repo_name(id - 1)
+        forks = sorted(self.world.forks)
+        if 1000000 <= id < 1000000 + len(forks) and self.world.nrepos:
+            return forks[id - 1000000], self.world.repo_name(0)
+
+    def find_project(self, id):
+        if id.isdigit():
+            return self.project_by_id(int(id))
+        owner, _, name = id.partition('/')
+        if self.world.repo_exists(owner, name):
+            return owner, name
+
+    def user(self, login):
+        return {'id': ident(login), 'username': login, 'name': login.title(), 'state': 'active',
+                'web_url': '%s/%s' % (self.forge.root, login), 'avatar_url': None}
+
+    def project(self, owner, name, family=True):
+        data = {'id': self.project_id(owner, name), 'name': name, 'path': name, 'path_with_namespace': '%s/%s' % (owner, name),
+                'namespace': {'id': ident(owner), 'name': owner, 'path': owner, 'full_path': owner, 'kind': 'user'},
+                'description': 'Repository %s of %s' % (name, owner), 'visibility': 'public', 'default_branch': 'master',
+                'ssh_url_to_repo': self.world.git_url(owner, name), 'http_url_to_repo': self.world.git_url(owner, name),
+                'web_url': '%s/%s/%s' % (self.forge.root, owner, name), 'last_activity_at': TIMESTAMP, 'created_at': TIMESTAMP}
+        parent = self.world.parent(owner, name)
+        if parent and family:
+            data['forked_from_project'] = self.project(*parent, family=False)
+        return data
+
+    def issue(self, owner, name, iid, kind='issues'):
+        return {'id': ident('%s/%s#%d' % (owner, name, iid)), 'iid': iid, 'project_id': self.project_id(owner, name),
+                'title': 'Issue %d' % iid, 'description': 'Something is wrong', 'state': 'opened', 'author': self.user(owner),
+                'web_url': '%s/%s/%s/-/%s/%d' % (self.forge.root, owner, name, kind, iid), 'created_at': TIMESTAMP}
+
+    def event(self, owner, name, num):
+        iid = num % max(self.world.nissues, 1) + 1
+        data = {'id': num, 'project_id': self.project_id(owner, name), 'author_username': owner, 'author_id': ident(owner),
+                'created_at': '2020-01-01T12:00:00.000Z', 'target_type': None, 'target_iid': None}
+        if num % 3 == 0:
+            data.update({'action_name': 'pushed to', 'push_data': {'commit_count': 1, 'ref': 'master', 'ref_type': 'branch'}})
+        elif num % 3 == 1:
+            iid -= self.world.is_pull(iid)
+            data.update({'action_name': 'opened', 'target_type': 'Issue', 'target_iid': iid, 'target_title': 'Issue %d' % iid})
+        else:
+            iid = (iid // 5 + 1) * 5
+            data.update({'action_name': 'opened', 'target_type': 'MergeRequest', 'target_iid': iid, 'target_title': 'Issue %d' % iid})
+        return data
+
+    @route('/user')
+    def authenticated_user(self, query):
+        return 200, self.user(self.world.user), {}
+
+    @route('/users')
+    def users(self, query):
+        login = query.get('username')
+        users = [self.user(login)] if login and self.world.user_exists(login) else []
+        return 200, users, {}
+
+    @route('/users/{id}/projects')
+    def user_projects(self, query, id):
+        login = next((login for login in [self.world.user] + sorted(self.world.forks) if str(ident(login)) == id), None)
+        repos = self.world.repos_of(login) if login else []
+        return self.paginate(query, len(repos), lambda num: self.project(*repos[num]), '/users/%s/projects' % id)
+
+    @route('/projects')
+    def projects(self, query):
+        repos = self.world.repos_of(self.world.user)
+        return self.paginate(query, len(repos), lambda num: self.project(*repos[num]), '/projects')
+
+    @route('/projects/{id}')
+    def get_project(self, query, id):
+        project = self.find_project(id)
+        if not project:
+            return self.not_found()
+        return 200, self.project(*project), {}
+
+    def list_issues(self, query, id, kind):
+        project = self.find_project(id)
+        if not project:
+            return self.not_found()
+        iids = [iid for iid in range(self.world.nissues, 0, -1) if self.world.is_pull(iid) == (kind == 'merge_requests')] if project[0] == self.world.user else []
+        path = '/projects/%s/%s' % (urllib.parse.quote(id, safe=''), kind)
+        return self.paginate(query, len(iids), lambda num: self.issue(project[0], project[1], iids[num], kind), path)
+
+    def get_issue(self, query, id, iid, kind):
+        project = self.find_project(id)
+        iid = int(iid)
+        if not project or project[0] != self.world.user or iid > self.world.nissues or self.world.is_pull(iid) != (kind == 'merge_requests'):
+            return self.not_found()
+        return 200, self.issue(project[0], project[1], iid, kind), {}
+
+    @route('/projects/{id}/issues')
+    def issues(self, query, id):
+        return self.list_issues(query, id, 'issues')
+
+    @route('/projects/{id}/merge_requests')
+    def merge_requests(self, query, id):
+        return self.list_issues(query, id, 'merge_requests')
+
+    @route('/projects/{id}/issues/{iid}')
+    def issue_(self, query, id, iid):
+        return self.get_issue(query, id, iid, 'issues')
+
+    @route('/projects/{id}/merge_requests/{iid}')
+    def merge_request(self, query, id, iid):
+        return self.get_issue(query, id, iid, 'merge_requests')
+
+    @route('/projects/{id}/events')
+    def events(self, query, id):
+        project = self.find_project(id)
+        if not project:
+            return self.not_found()
+        path = '/projects/%s/events' % urllib.parse.quote(id, safe='')
+        return self.paginate(query, self.world.nevents, lambda num: self.event(project[0], project[1], num), path)
+
+    @route('/projects/{id}/forks')
+    def forks(self, query, id):
+        project = self.find_project(id)
+        forks = self.world.children(*project) if project else []
+        path = '/projects/%s/forks' % urllib.parse.quote(id, safe='')
+        return self.paginate(query, len(forks), lambda num: self.project(*forks[num]), path)
+
+class BitbucketAPI(API):
+    name = 'bitbucket'
+    prefix = '/api/2.0'
+
+    def paginate(self, query, total, make, path):
+        page, per_page, items = self.page(query, total, 10, 100, 'pagelen')
+        data = {'page': page, 'pagelen': per_page, 'size': total, 'values': [make(num) for num in items]}
+        if items and items[-1] < total - 1:
+            args = dict(query, page=page + 1)
+            data['next'] = '%s%s?%s' % (self.api, path, urllib.parse.urlencode(args))
+        return 200, data, {}
+
+    def account_id(self, login):
+        return '557058:%08x' % ident(login)
+
+    def user(self, login):
+        return {'account_id': self.account_id(login), 'uuid': '{%08x}' % ident(login), 'nickname': login, 'username': login,
+                'display_name': login.title(), 'type': 'user', 'location': None,
+                'links': {'self': {'href': '%s/users/%s' % (self.api, self.account_id(login))}, 'html': {'href': '%s/%s' % (self.forge.root, login)}}}
+
+    def repo(self, owner, name, family=True):
+        url = '%s/repositories/%s/%s' % (self.api, owner, name)
+        data = {'uuid': '{%08x}' % ident(owner + '/' + name), 'name': name, 'slug': name, 'full_name': '%s/%s' % (owner, name),
+                'description': 'Repository %s of %s' % (name, owner), 'is_private': False, 'scm': 'git', 'owner': self.user(owner),
+                'workspace': {'slug': owner}, 'updated_on': TIMESTAMP, 'created_on': TIMESTAMP, 'has_issues': True,
+                'links': {'self': {'href': url}, 'forks': {'href': url + '/forks'}, 'html': {'href': '%s/%s/%s' % (self.forge.root, owner, name)},
+                          'clone': [{'name': 'https', 'href': self.world.git_url(owner, name)}, {'name': 'ssh', 'href': self.world.git_url(owner, name)}]}}
+        parent = self.world.parent(owner, name)
+        if parent and family:
+            data['parent'] = {'full_name': '%s/%s' % parent, 'name': parent[1], 'uuid': '{%08x}' % ident('/'.join(parent)),
+                              'links': {'self': {'href': '%s/repositories/%s/%s' % ((self.api,) + parent)}}}
+        return data
+
+    def issue(self, owner, name, id, kind='issues'):
+        return {'id': id, 'title': 'Issue %d' % id, 'state': 'open', 'reporter': self.user(owner),
+                'links': {'self': {'href': '%s/repositories/%s/%s/%s/%d' % (self.api, owner, name, kind, id)},
+                          'html': {'href': '%s/%s/%s/%s/%d' % (self.forge.root, owner, name, kind, id)}}}
+
+    @route('/user')
+    def authenticated_user(self, query):
+        return 200, self.user(self.world.user), {}
+
+    @route('/teams/{username}')
+    def team(self, query, login):
+        if not self.world.user_exists(login):
+            return 404, {'error': {'message': 'Not Found'}}, {}
+        return 200, self.user(login), {}
+
+    @route('/users/{id}')
+    def get_user(self, query, id):
+        login = next((login for login in [self.world.user] + sorted(self.world.forks) if id in (login, self.account_id(login))), None)
+        if not login:
+            return 404, {'error': {'message': 'Not Found'}}, {}
+        return 200, self.user(login), {}
+
+    @route('/users/{id}/ssh-keys')
+    def user_keys(self, query, id):
+        return 200, {'page': 1, 'pagelen': 10, 'size': 0, 'values': []}, {}
+
+    @route('/workspaces/{workspace}')
+    def workspace(self, query, workspace):
+        if not self.world.user_exists(workspace):
+            return 404, {'error': {'message': 'Not Found'}}, {}
+        return 200, {'slug': workspace, 'name': workspace.title(), 'uuid': '{%08x}' % ident(workspace), 'type': 'workspace'}, {}
+
+    @route('/repositories')
+    def my_repos(self, query):
+        repos = self.world.repos_of(self.world.user)
+        return self.paginate(query, len(repos), lambda num: self.repo(*repos[num]), '/repositories')
+
+    @route('/repositories/{workspace}')
+    def repos(self, query, workspace):
+        repos = self.world.repos_of(workspace)
+        return self.paginate(query, len(repos), lambda num: self.repo(*repos[num]), '/repositories/%s' % workspace)
+
+    @route('/repositories/{workspace}/{slug}')
+    def get_repo(self, query, owner, name):
+        if not self.world.repo_exists(owner, name):
+            return 404, {'error': {'message': 'Repository %s/%s not found' % (owner, name)}}, {}
+        return 200, self.repo(owner, name), {}
+
+    @route('/repositories/{workspace}/{slug}/forks')
+    def forks(self, query, owner, name):
+        forks = self.world.children(owner, name)
+        return self.paginate(query, len(forks), lambda num: self.repo(*forks[num]), '/repositories/%s/%s/forks' % (owner, name))
+
+    def list_issues(self, query, owner, name, kind):
+        if not self.world.repo_exists(owner, name):
+            return 404, {'error': {'message': 'Not Found'}}, {}
+        ids = [id for id in range(self.world.nissues, 0, -1) if self.world.is_pull(id) == (kind == 'pullrequests')] if owner == self.world.user else []
+        path = '/repositories/%s/%s/%s' % (owner, name, kind)
+        return self.paginate(query, len(ids), lambda num: self.issue(owner, name, ids[num], kind), path)
+
+    @route('/repositories/{workspace}/{slug}/issues')
+    def issues(self, query, owner, name):
+        return self.list_issues(query, owner, name, 'issues')
+
+    @route('/repositories/{workspace}/{slug}/pullrequests')
+    def pull_requests(self, query, owner, name):
+        return self.list_issues(query, owner, name, 'pullrequests')
+
+def make_git_repo(path, commits):
+    """A bare repository with a few commits, that every clone url points to"""
+    env = dict(os.environ, GIT_AUTHOR_NAME='Fake Forge', GIT_AUTHOR_EMAIL='forge@example.com', GIT_COMMITTER_NAME='Fake Forge',
+               GIT_COMMITTER_EMAIL='forge@example.com', GIT_AUTHOR_DATE=TIMESTAMP, GIT_COMMITTER_DATE=TIMESTAMP)
+    work = path + '.work'
+    subprocess.check_call(['git', 'init', '-q', '-b', 'master', work], env=env)
+    for num in range(commits):
+        with open(os.path.join(work, 'file-%d.txt' % num), 'w') as fd:
+            fd.write('Commit %d\n' % num)
+        subprocess.check_call(['git', '-C', work, 'add', '.'], env=env)
+        subprocess.check_call(['git', '-C', work, 'commit', '-q', '-m', 'Commit %d' % num], env=env)
+    subprocess.check_call(['git', 'clone', '-q', '--bare', work, path], env=env)
+    shutil.rmtree(work)
+
+def start(port=0, git_dir=None, commits=10, latency=0, rate_limit=0, rate_window=60, flaky=0, **kwargs):
+    """Start a forge in a background thread, returns the server"""
+    if not git_dir:
+        git_dir = os.path.join(tempfile.mkdtemp(prefix='fakeforge-'), 'repo.git')
+    make_git_repo(git_dir, commits)
+    world = World(git_dir=git_dir, **kwargs)
+    forge = Forge(world, port, latency, rate_limit, rate_window, flaky)
+    forge.start()
+    return forge
+
+def main():
+    import docopt
+    opts = docopt.docopt(__doc__)
+    kwargs = dict((key, int(opts['--' + key.replace('_', '-')])) for key in ('repos', 'issues', 'forks', 'fork_depth', 'events', 'followers'))
+    tmp = tempfile.mkdtemp(prefix='fakeforge-')
+    # Clean up when killed, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        forge = start(int(opts['--port']), os.path.join(tmp, 'repo.git'), int(opts['--commits']), int(opts['--latency']),
+                      int(opts['--rate-limit']), int(opts['--rate-window']), int(opts['--flaky']), user=opts['--user'], **kwargs)
+        print(forge.root)
+        sys.stdout.flush()
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
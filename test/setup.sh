@@ -114,6 +114,12 @@ username() {(
     $1 run-shell -c 'print(self.my_login)'
 )}
 
+# Check the API requests or processes used by the last command that was run with
+# GIT_SPINDLE_STATS=stats.json, e.g. test_budget requests 0 '*/{number}'
+test_budget() {
+    "$PYTHON" "$SHARNESS_TEST_DIRECTORY/lib/budget.py" stats.json "$@"
+}
+
 commit_count=0
 test_commit() {
     commit_count=$(expr $commit_count + 1) &&